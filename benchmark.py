@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import sqlite3
+import platform
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+
+import nlsy
+import ingest_data
+import instrumentation
+import reference_data
+
+BENCHMARK_DIR = "benchmark_data"
+RESULTS_DIR = "benchmark_results"
+
+# The share of responses that are one of the NLSY's missing-value codes
+# (-1 to -5: refused, don't know, invalid skip, valid skip, non-interview).
+MISSING_SHARE = .08
+
+
+def _question_year(question_name, year):
+    """
+    Returns the survey year a question belongs to, working out the year of
+    the 1997 cohort's constructed ("XRND") variables as Cohort does. Returns
+    None for questions from the 1978 screener ("78SCRN"), which are static.
+    """
+    if year.isdigit():
+        return int(year)
+    if year != "XRND":
+        return None
+    return int(("19" if question_name[-2] == "9" else "20") + question_name[-2:])
+
+
+def _field_values(field, cohort_year, year, n, random_state, dictionary, crosswalks):
+    """
+    Returns `n` plausible responses to a question for a given wrangled field.
+    """
+    if field == "adjusted_income":
+        values = random_state.randint(1000, 120000, n)
+        values[random_state.random_sample(n) < .1] = 0
+
+        # Some incomes are top-coded, with a value the codebook translates.
+        top_codes = dictionary["dynamic_question_values"][str(cohort_year)]["adjusted_income"].get(str(year))
+        if top_codes:
+            values[random_state.random_sample(n) < .02] = int(list(top_codes)[0])
+        return values
+
+    if field in ("industry", "occupation"):
+        if cohort_year == 1979:
+            codes = crosswalks[field]["1970"] if year <= 2002 - (field == "occupation") else crosswalks[field]["later"]
+        else:
+            codes = crosswalks[field]["later"]
+        return random_state.choice(codes, n)
+
+    (low, high) = {
+        "age": (14, 60),
+        "curr_pregnant": (0, 1),
+        "work_kind_limited": (0, 1),
+        "work_amount_limited": (0, 1),
+        "family_size": (1, 10),
+        "hours_worked_last_year": (0, 5000),
+        "weeks_worked_last_year": (0, 52),
+        "urban_or_rural": (0, 2),
+        "region": (1, 4),
+        "highest_grade": (0, 20),
+        "marital_status": (0, 6),
+        "number_of_kids": (0, 6),
+        "race": (1, 4),
+        "sex": (1, 2),
+        "sample_id": (1, 20)
+    }.get(field, (0, 100))
+    return random_state.randint(low, high + 1, n)
+
+
+def generate_cohort(cohort_year, output_dir, n_respondents=1000, extra_rnums=0, years=None, seed=0, dictionary="translate.json"):
+    """
+    Writes a synthetic NLSY extract for a cohort (an RNUM file, a question
+    name file, and a responses CSV) to `output_dir`, and returns their paths.
+
+    The extract has the same layout as the cohort's real one in data/,
+    including the 1997 cohort's constructed XRND variables, restricted to
+    the survey rounds in `years` (default: all of them). `extra_rnums`
+    columns of questions that aren't used are added, as in a bigger extract.
+    The responses are random but plausible (including missing-value codes,
+    top-coded incomes, and industry and occupation codes from the
+    crosswalks), and the same seed always gives the same data.
+    """
+    (rnum_path, qname_path) = [(rnum_path, qname_path) for (year, rnum_path, qname_path, responses_path) in ingest_data.COHORTS
+        if year == cohort_year][0]
+    dictionary = reference_data.registry.json_file(dictionary)
+    question_names = dict(dictionary["static_question_names"][str(cohort_year)])
+    question_names.update(dictionary["dynamic_question_names"][str(cohort_year)])
+
+    with open(rnum_path) as rnum_file:
+        rnums = [line.strip() for line in rnum_file if line.strip()]
+    with open(qname_path) as qname_file:
+        questions = [line.strip().split(",") for line in qname_file if line.strip()]
+
+    # Static questions (like the case ID) are kept whatever the years.
+    static_question_names = dictionary["static_question_names"][str(cohort_year)]
+    columns = [(rnum, question_name, year) for (rnum, (question_name, year)) in zip(rnums, questions)
+        if years is None or question_name in static_question_names or _question_year(question_name, year) in years]
+
+    survey_years = sorted(set(year for (rnum, question_name, year) in columns if question_name not in static_question_names))
+    if not survey_years:
+        raise ValueError("The {} cohort has no survey rounds in the given years".format(cohort_year))
+
+    random_state = np.random.RandomState(seed + cohort_year)
+    columns.extend(("Z{:07d}".format(position), "FILLER-{}".format(position), random_state.choice(survey_years))
+        for position in range(extra_rnums))
+
+    crosswalks = {
+        "industry": pd.read_csv("industry_crosswalk.csv", encoding="utf-8-sig"),
+        "occupation": pd.read_csv("occupation_crosswalk.csv", encoding="utf-8-sig")
+    }
+    crosswalks = {
+        "industry": {"1970": crosswalks["industry"]["1970"].dropna().astype(int).values,
+            "later": crosswalks["industry"]["ACS 2003-"].dropna().astype(int).values},
+        "occupation": {"1970": crosswalks["occupation"]["1970"].dropna().astype(int).values,
+            "later": crosswalks["occupation"]["2000" if cohort_year == 1979 else "ACS 2003-2009"].dropna().astype(int).values}
+    }
+
+    responses = np.empty((n_respondents, len(columns)), dtype=np.int64)
+    for (position, (rnum, question_name, year)) in enumerate(columns):
+        if rnum == "R0000100":
+            responses[:, position] = np.arange(1, n_respondents + 1)
+            continue
+        field = question_names.get(question_name)
+        responses[:, position] = _field_values(field, cohort_year, _question_year(question_name, year), n_respondents,
+            random_state, dictionary, crosswalks)
+        missing = random_state.random_sample(n_respondents) < MISSING_SHARE
+        responses[missing, position] = random_state.randint(-5, 0, missing.sum())
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    suffix = str(cohort_year)[2:]
+    paths = (os.path.join(output_dir, "dataset_rnum.NLSY{}".format(suffix)),
+        os.path.join(output_dir, "dataset_qname_with_year.NLSY{}".format(suffix)),
+        os.path.join(output_dir, "NLSY{}.csv".format(suffix)))
+    with open(paths[0], "w") as rnum_file:
+        rnum_file.writelines("{}\n".format(rnum) for (rnum, question_name, year) in columns)
+    with open(paths[1], "w") as qname_file:
+        qname_file.writelines("{},{}\n".format(question_name, year) for (rnum, question_name, year) in columns)
+    pd.DataFrame(responses, columns=[rnum for (rnum, question_name, year) in columns]).to_csv(paths[2], index=False)
+
+    return paths
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(cohort_years=(1979, 1997), n_respondents=1000, extra_rnums=0, years=None, seed=0, chunksize=1000,
+        keep_responses=True, all_columns=False, work_dir=BENCHMARK_DIR, verbose=True):
+    """
+    Generates synthetic data for each cohort and ingests it into a fresh
+    database in `work_dir`, timing each stage of the ingest (see
+    PIPELINE_STAGES) and Cohort.data(), and measuring each one's peak memory.
+    Returns the results as a dictionary.
+    """
+    results = {"cohorts": {}}
+    paths = {}
+    for cohort_year in cohort_years:
+        start = time.time()
+        paths[cohort_year] = generate_cohort(cohort_year, os.path.join(work_dir, str(cohort_year)), n_respondents,
+            extra_rnums, years, seed)
+        if verbose:
+            print("Generated {} cohort data in {:.2f} seconds".format(cohort_year, time.time() - start))
+
+    db_path = os.path.join(work_dir, "benchmark.db")
+    start = time.time()
+    NLSY_db = nlsy.NLSY_database(db_path, True, overwrite=True)
+    NLSY_db.add_years_data(ingest_data.YEAR_PATH)
+    NLSY_db.add_region_data(ingest_data.REGION_PATH)
+    results["years_data_seconds"] = time.time() - start
+
+    for cohort_year in cohort_years:
+        (rnum_path, qname_path, responses_path) = paths[cohort_year]
+        cohort = NLSY_db.add_cohort(cohort_year)
+        cohort.add_cohort_data(rnum_path, qname_path, responses_path, verbose=False, keep_responses=keep_responses,
+            chunksize=chunksize, all_columns=all_columns)
+        stages = dict((name, {"seconds": cohort.stage_timings[name], "peak_memory": cohort.stage_memory[name]})
+            for name in nlsy.PIPELINE_STAGES)
+
+        instrumentation.reset_peak_memory()
+        start = time.time()
+        df = cohort.data()
+        stages["data"] = {"seconds": time.time() - start, "peak_memory": instrumentation.peak_memory()}
+
+        results["cohorts"][str(cohort_year)] = {
+            "stages": stages,
+            "respondents": n_respondents,
+            "rnums": sum(1 for line in open(rnum_path)),
+            "responses_bytes": os.path.getsize(responses_path),
+            "column_projection": cohort.column_projection,
+            "data_rows": len(df),
+            "data_columns": len(df.columns)
+        }
+        if verbose:
+            print("{} cohort:".format(cohort_year))
+            for (name, stage) in stages.items():
+                print("    {:<22}{:>8.2f} seconds {:>8.1f} MB peak".format(name, stage["seconds"], stage["peak_memory"] / 1e6))
+
+    NLSY_db.conn.close()
+    results["database_bytes"] = os.path.getsize(db_path)
+    return results
+
+
+def run_suite(repeat=1, verbose=True, **kwargs):
+    """
+    Runs the benchmark `repeat` times, keeping each stage's fastest time (and
+    largest peak memory), and returns the results along with the settings,
+    commit, and platform they were measured with.
+    """
+    runs = []
+    for run in range(repeat):
+        if verbose and repeat > 1:
+            print("Run {} of {}".format(run + 1, repeat))
+        runs.append(run_benchmark(verbose=verbose, **kwargs))
+
+    results = runs[0]
+    for (cohort_year, cohort) in results["cohorts"].items():
+        for (name, stage) in cohort["stages"].items():
+            stage["seconds"] = min(run["cohorts"][cohort_year]["stages"][name]["seconds"] for run in runs)
+            stage["peak_memory"] = max(run["cohorts"][cohort_year]["stages"][name]["peak_memory"] for run in runs)
+            stage["runs"] = [run["cohorts"][cohort_year]["stages"][name]["seconds"] for run in runs]
+
+    settings = dict(kwargs)
+    settings.pop("work_dir", None)
+    settings["repeat"] = repeat
+    if settings.get("years") is not None:
+        settings["years"] = sorted(settings["years"])
+    results.update({
+        "commit": _commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": settings,
+        "platform": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "system": platform.system()
+        }
+    })
+    return results
+
+
+def compare(baseline, results):
+    """
+    Prints each stage's time and peak memory in two sets of results side by
+    side.
+    """
+    print("{:<8}{:<22}{:>10}{:>10}{:>9}{:>12}{:>12}".format("cohort", "stage", "before", "after", "ratio", "MB before", "MB after"))
+    for (cohort_year, cohort) in results["cohorts"].items():
+        for (name, stage) in cohort["stages"].items():
+            before = baseline["cohorts"].get(cohort_year, {}).get("stages", {}).get(name)
+            if before is None:
+                continue
+            print("{:<8}{:<22}{:>10.2f}{:>10.2f}{:>8.2f}x{:>12.1f}{:>12.1f}".format(cohort_year, name, before["seconds"],
+                stage["seconds"], before["seconds"] / stage["seconds"] if stage["seconds"] else float("inf"),
+                before["peak_memory"] / 1e6, stage["peak_memory"] / 1e6))
+
+
+def _parse_years(years):
+    """
+    Parses a list of years like "1979-1990,1994,1996".
+    """
+    parsed = set()
+    for part in years.split(","):
+        if "-" in part:
+            (first, last) = part.split("-")
+            parsed.update(range(int(first), int(last) + 1))
+        else:
+            parsed.add(int(part))
+    return parsed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks the ingest and feature pipeline on synthetic NLSY data.")
+    parser.add_argument("--respondents", type=int, default=1000,
+        help="number of respondents in each cohort (default: 1000)")
+    parser.add_argument("--extra-rnums", type=int, default=0,
+        help="number of unused questions to add to each cohort's extract (default: 0)")
+    parser.add_argument("--years",
+        help="survey rounds to include, e.g. 1979-1990,1994 (default: all of them)")
+    parser.add_argument("--cohorts", type=int, nargs="+", default=[year for (year, rnum_path, qname_path, responses_path) in ingest_data.COHORTS],
+        help="cohorts to benchmark (default: all of them)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunksize", type=int, default=1000,
+        help="number of respondents to read from the response files at a time")
+    parser.add_argument("--skip-responses", action="store_true",
+        help="don't keep the raw responses tables")
+    parser.add_argument("--all-columns", action="store_true",
+        help="load every column of the response files, including the unused questions")
+    parser.add_argument("--repeat", type=int, default=1,
+        help="number of times to run the benchmark, keeping each stage's fastest time")
+    parser.add_argument("--work-dir", default=BENCHMARK_DIR,
+        help="directory for the synthetic data and database (default: {})".format(BENCHMARK_DIR))
+    parser.add_argument("--output",
+        help="JSON file to write the results to (default: {}/<commit>.json)".format(RESULTS_DIR))
+    parser.add_argument("--compare", metavar="BASELINE",
+        help="JSON results to compare against, e.g. from an earlier commit")
+    args = parser.parse_args()
+
+    results = run_suite(args.repeat, cohort_years=args.cohorts, n_respondents=args.respondents, extra_rnums=args.extra_rnums,
+        years=_parse_years(args.years) if args.years else None, seed=args.seed, chunksize=args.chunksize,
+        keep_responses=not args.skip_responses, all_columns=args.all_columns, work_dir=args.work_dir)
+
+    output = args.output or os.path.join(RESULTS_DIR, "{}.json".format(results["commit"] or time.strftime("%Y%m%d%H%M%S")))
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, "w") as json_file:
+        json.dump(results, json_file, indent=2)
+    print("Results written to {}".format(output))
+
+    if args.compare:
+        with open(args.compare) as json_file:
+            baseline = json.load(json_file)
+        print()
+        compare(baseline, results)
@@ -0,0 +1,290 @@
+import numpy as np
+import pandas as pd
+
+# Stand-ins for the open ends of a year range.
+FIRST_YEAR = -9999
+LAST_YEAR = 9999
+
+
+def _normalize(value):
+    """
+    Normalizes a survey code the way SQLite's INTEGER affinity would store it,
+    so that "5", 5, and 5.0 are all treated as the same code.
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return value
+    if number.is_integer():
+        return int(number)
+    return number
+
+
+class Translator(object):
+    """
+    Translates the values of a single field to conform to our standard codebook.
+
+    Rules are added in the order they should be applied, optionally restricted
+    to a range of survey years, and are compiled into a lookup table that
+    gives the same result in a single pass as applying every rule in turn
+    (including cases where one rule's output is picked up by a later rule).
+    """
+
+    def __init__(self, field):
+        self._field = field
+        self._rules = []
+
+    @property
+    def field(self):
+        return self._field
+
+    def add_rule(self, find_value, replace_value, first_year=FIRST_YEAR, last_year=LAST_YEAR):
+        self._rules.append((int(first_year), int(last_year), _normalize(find_value), _normalize(replace_value)))
+
+    def lookup_table(self):
+        """
+        Returns the compiled translations as (first_year, last_year, find_value,
+        replace_value) rows, with non-overlapping year ranges for each value.
+        """
+        # Split the years into ranges in which the same set of rules applies.
+        boundaries = set([FIRST_YEAR, LAST_YEAR + 1])
+        for (first_year, last_year, find_value, replace_value) in self._rules:
+            boundaries.update([first_year, last_year + 1])
+        boundaries = sorted(boundaries)
+
+        rows = []
+        for (range_start, range_end) in zip(boundaries, boundaries[1:]):
+            # Working backwards through the rules, each one only changes the
+            # outcome for its own find_value: it becomes whatever the later
+            # rules would do to its replace_value.
+            lookup = {}
+            for (first_year, last_year, find_value, replace_value) in reversed(self._rules):
+                if first_year <= range_start and range_end - 1 <= last_year:
+                    lookup[find_value] = lookup.get(replace_value, replace_value)
+
+            for find_value, replace_value in lookup.items():
+                if find_value != replace_value:
+                    rows.append((range_start, range_end - 1, find_value, replace_value))
+
+        return rows
+
+    @staticmethod
+    def create_table(cursor):
+        """
+        Creates the (empty) temporary table that compiled translations are
+        loaded into.
+        """
+        cursor.execute("DROP TABLE IF EXISTS temp.translation")
+        cursor.execute("""CREATE TEMP TABLE translation (
+            first_year INTEGER NOT NULL,
+            last_year INTEGER NOT NULL,
+            find_value INTEGER NOT NULL,
+            replace_value INTEGER,
+            PRIMARY KEY (find_value, first_year)
+        ) WITHOUT ROWID""")
+
+    def update_query(self, table, by_year=True):
+        """
+        Returns the UPDATE statement that translates the field in the given
+        table using the temporary translation table.
+        """
+        condition = "temp.translation.find_value = {table}.{field}".format(table = table, field = self._field)
+        if by_year:
+            condition = "{condition} AND {table}.year BETWEEN temp.translation.first_year AND temp.translation.last_year".format(
+                condition = condition, table = table)
+
+        return """UPDATE {table}
+            SET {field} = (SELECT replace_value FROM temp.translation WHERE {condition})
+            WHERE EXISTS (SELECT 1 FROM temp.translation WHERE {condition})""".format(
+                table = table,
+                field = self._field,
+                condition = condition
+                )
+
+    def apply(self, cursor, table, by_year=True):
+        """
+        Translates the field in the given table with a single UPDATE, joined
+        against a temporary table holding the compiled lookup table.
+        """
+        rows = self.lookup_table()
+        if not rows:
+            return 0
+
+        self.create_table(cursor)
+        cursor.executemany("INSERT INTO temp.translation VALUES (?, ?, ?, ?)", rows)
+        cursor.execute(self.update_query(table, by_year))
+        changed = cursor.rowcount
+
+        cursor.execute("DROP TABLE temp.translation")
+        return changed
+
+
+def codebook_translators(translations):
+    """
+    Compiles one cohort's static_question_values or dynamic_question_values from
+    translate.json into Translators. If a field's translation value is itself a
+    dictionary, it's keyed by year and only applies to responses from that year.
+    """
+    translators = []
+    for field, translate_dict in translations.items():
+        translator = Translator(field)
+        for key, value in translate_dict.items():
+            if isinstance(value, dict):
+                for find_value, replace_value in value.items():
+                    translator.add_rule(find_value, replace_value, key, key)
+            else:
+                translator.add_rule(key, value)
+        translators.append(translator)
+
+    return translators
+
+
+def crosswalk_translators(cohort_year, industry_crosswalk, occupation_crosswalk):
+    """
+    Compiles the census industry and occupation crosswalks into Translators
+    mapping each cohort's census codes onto the IND1990 and OCC2010 codes.
+    """
+    cohort_year = int(cohort_year)
+    industry = Translator("industry")
+    occupation = Translator("occupation")
+
+    for (new_code, code_1970, code_acs) in zip(industry_crosswalk["IND1990"], industry_crosswalk["1970"], industry_crosswalk["ACS 2003-"]):
+        # The 1979 data is coded using two different sets of census codes, depending on the year.
+        if cohort_year == 1979:
+            if not pd.isna(code_1970):
+                industry.add_rule(code_1970, new_code, last_year=2002)
+            if not pd.isna(code_acs):
+                industry.add_rule(code_acs, new_code, first_year=2003)
+
+        if cohort_year == 1997:
+            if not pd.isna(code_acs):
+                industry.add_rule(code_acs, new_code)
+
+    for (new_code, code_1970, code_2000, code_acs) in zip(occupation_crosswalk["OCC2010"], occupation_crosswalk["1970"], occupation_crosswalk["2000"], occupation_crosswalk["ACS 2003-2009"]):
+        if cohort_year == 1979:
+            if not pd.isna(code_1970):
+                occupation.add_rule(code_1970, new_code, last_year=2001)
+            if not pd.isna(code_2000):
+                occupation.add_rule(code_2000, new_code, first_year=2002)
+
+        if cohort_year == 1997:
+            if not pd.isna(code_acs):
+                occupation.add_rule(code_acs, new_code)
+
+    return [industry, occupation]
+
+
+def crosswalk_bins(crosswalk, code_column, description_column, bins=None):
+    """
+    Derives bins from a census crosswalk, in which each major category starts
+    with a header row (coded "#", with an all-caps description). Each bin runs
+    from the first code in its category up to the start of the next one, and
+    the last bin is open-ended. Returns a dictionary in the same "bottom~top":
+    name form as translate.json's binned_values, extending `bins` if given.
+    """
+    bin_names = dict(bins or {})
+    bin_bottom = False
+    reset_bin = False
+    for (code, description) in zip(crosswalk[code_column], crosswalk[description_column]):
+        if reset_bin and code != "#":
+            reset_bin = False
+            bin_bottom = code
+        if code == "#" and description.isupper():
+            reset_bin = True
+            if bin_bottom:
+                bin_names[bin_bottom] = curr_description
+            curr_description = description.strip()
+    bin_names[bin_bottom] = curr_description
+
+    bin_bottoms = list(bin_names.keys())
+    bin_tops = [int(bin_bottom) - 1 for bin_bottom in bin_bottoms[1:]] + [99998]
+    return dict(("{}~{}".format(bin_bottom, bin_top), bin_names[bin_bottom]) for (bin_bottom, bin_top) in zip(bin_bottoms, bin_tops))
+
+
+class Binner(object):
+    """
+    Bins columns of survey data, replacing each value with the bottom of the
+    bin it falls in. Values outside every bin (and missing values) are left
+    alone.
+
+    Bins are given in translate.json's binned_values form, e.g. {"highest_grade":
+    {"0~4": "Less than elementary school", ...}}, and are compiled into sorted
+    boundary arrays, so each column is binned in a single pass.
+    """
+
+    def __init__(self, binned_values):
+        self._bins = {}
+        for col, bin_dict in binned_values.items():
+            bins = []
+            for bin_range, bin_name in bin_dict.items():
+                (bin_bottom, bin_top) = bin_range.split("~")
+                bins.append((int(bin_bottom), int(bin_top), bin_name))
+            bins.sort()
+
+            for (lower_bin, upper_bin) in zip(bins, bins[1:]):
+                if upper_bin[0] <= lower_bin[1]:
+                    raise ValueError("Overlapping {} bins: {}~{} and {}~{}".format(col, lower_bin[0], lower_bin[1], upper_bin[0], upper_bin[1]))
+
+            bin_bottoms = np.array([bin_bottom for (bin_bottom, bin_top, bin_name) in bins])
+            bin_tops = np.array([bin_top for (bin_bottom, bin_top, bin_name) in bins])
+            # A Binner can be shared (see reference_data), so its bins are read-only.
+            bin_bottoms.setflags(write=False)
+            bin_tops.setflags(write=False)
+            self._bins[col] = (bin_bottoms, bin_tops, tuple(bin_name for (bin_bottom, bin_top, bin_name) in bins))
+
+    @classmethod
+    def from_crosswalks(cls, binned_values, industry_crosswalk, occupation_crosswalk):
+        """
+        Creates a Binner from translate.json's binned_values, with the industry
+        and occupation bins derived from the crosswalks.
+        """
+        binned_values = dict(binned_values)
+        binned_values["industry"] = crosswalk_bins(industry_crosswalk, "IND1990", "Industry category description",
+            binned_values.get("industry"))
+        binned_values["occupation"] = crosswalk_bins(occupation_crosswalk, "OCC2010", "Occupation category description",
+            binned_values.get("occupation"))
+        return cls(binned_values)
+
+    @classmethod
+    def from_files(cls, binned_values, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv"):
+        """
+        Creates a Binner from translate.json's binned_values, with the industry
+        and occupation bins derived from the crosswalk files. (To load them
+        only once, use reference_data.registry.binner() instead.)
+        """
+        return cls.from_crosswalks(binned_values, pd.read_csv(industry_file), pd.read_csv(occupation_file))
+
+    @property
+    def columns(self):
+        return list(self._bins.keys())
+
+    def labels(self, col):
+        """
+        Returns a dictionary of each of a column's bins (by its bottom value) and its name.
+        """
+        (bin_bottoms, bin_tops, bin_names) = self._bins[col]
+        return dict(zip(bin_bottoms.tolist(), bin_names))
+
+    def bin_values(self, col, values):
+        """
+        Returns the binned version of an array or Series of values.
+        """
+        (bin_bottoms, bin_tops, bin_names) = self._bins[col]
+        array = np.asarray(values)
+
+        index = np.searchsorted(bin_bottoms, array, side="right") - 1
+        in_bin = (index >= 0) & (array <= bin_tops[index.clip(0)])
+        binned = np.where(in_bin, bin_bottoms[index.clip(0)], array).astype(array.dtype)
+
+        if isinstance(values, pd.Series):
+            return pd.Series(binned, index=values.index, name=values.name)
+        return binned
+
+    def transform(self, df):
+        """
+        Bins every column of the DataFrame that the Binner has bins for.
+        """
+        for col in self._bins:
+            if col in df.columns:
+                df[col] = self.bin_values(col, df[col])
+        return df
@@ -0,0 +1,165 @@
+import json
+import pickle
+import argparse
+import warnings
+import numpy as np
+
+# Rows of inputs the original model's predictions are recorded for, so the
+# converted model can be checked against them.
+CHECK_ROWS = 70000
+
+
+def _check_inputs(thresholds, n_features, seed=0):
+    """
+    Returns inputs that reach every branch of the model: each feature is
+    either 0, 1, or just either side of one of the thresholds it's split on.
+    """
+    random_state = np.random.RandomState(seed)
+    X = random_state.randint(0, 2, (CHECK_ROWS, n_features)).astype(np.float64)
+    for feature in range(n_features):
+        values = thresholds[thresholds[:, 0] == feature, 1]
+        if len(values):
+            values = np.concatenate([values - 1e-3, values + 1e-3, [0., 1.]])
+            X[:, feature] = random_state.choice(values, CHECK_ROWS)
+    return X
+
+
+def export_model(model_path, output_path):
+    """
+    Saves the arrays behind a pickled scikit-learn 0.20 GradientBoostingClassifier
+    (its trees' nodes and values, its settings, and its predictions on a set
+    of check inputs) to a .npz file. Run this under Python 3.7 with
+    scikit-learn 0.20.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with open(model_path, "rb") as model_file:
+            model = pickle.load(model_file)
+
+    arrays = {}
+    thresholds = []
+    for (position, estimator) in enumerate(model.estimators_[:, 0]):
+        state = estimator.tree_.__getstate__()
+        arrays["nodes_{}".format(position)] = state["nodes"]
+        arrays["values_{}".format(position)] = state["values"]
+        arrays["max_depth_{}".format(position)] = np.array(state["max_depth"])
+        is_split = estimator.tree_.children_left >= 0
+        thresholds.append(np.column_stack([estimator.tree_.feature[is_split], estimator.tree_.threshold[is_split]]))
+
+    X = _check_inputs(np.concatenate(thresholds), model.n_features_)
+    settings = {
+        "params": model.get_params(),
+        "n_features": model.n_features_,
+        "max_features": model.max_features_,
+        "n_estimators": model.n_estimators_,
+        "tree_params": model.estimators_[0, 0].get_params(),
+        "tree_max_features": model.estimators_[0, 0].max_features_
+    }
+    np.savez(output_path, settings=json.dumps(settings, default=str), prior=np.array(model.init_.prior),
+        classes=model.classes_, train_score=model.train_score_, check_inputs=X, check_proba=model.predict_proba(X),
+        **arrays)
+
+
+def _dummy_prior(log_odds, n_features, classes):
+    """
+    Returns the prior DummyClassifier whose initial raw score is as close as
+    possible to the 0.20 LogOddsEstimator's `log_odds`. It computes
+    log(p / (1 - p)), which can only match it to within an ulp or so.
+    """
+    from sklearn.dummy import DummyClassifier
+
+    def raw_score(p):
+        return np.log(p / (1 - p))
+
+    p = 1 / (1 + np.exp(-log_odds))
+    candidates = [p]
+    for direction in (1, -1):
+        candidate = p
+        for step in range(64):
+            candidate = np.nextafter(candidate, direction)
+            candidates.append(candidate)
+    p = min(candidates, key=lambda candidate: abs(raw_score(candidate) - log_odds))
+
+    init = DummyClassifier(strategy="prior").fit(np.zeros((2, n_features)), classes)
+    init.class_prior_ = np.array([1 - p, p])
+    return init
+
+
+def convert_model(arrays_path, output_path):
+    """
+    Rebuilds a GradientBoostingClassifier exported by export_model() with the
+    installed scikit-learn (1.2), pickles it to `output_path`, and returns
+    how far its predictions are from the original model's on the check
+    inputs, as (the share of class predictions that differ, the largest
+    difference in probability).
+    """
+    from sklearn.ensemble import GradientBoostingClassifier
+    from sklearn.ensemble._gb_losses import BinomialDeviance
+    from sklearn.tree import DecisionTreeRegressor
+    from sklearn.tree._tree import Tree
+
+    arrays = np.load(arrays_path)
+    settings = json.loads(str(arrays["settings"]))
+    params = settings["params"]
+    n_features = settings["n_features"]
+    classes = arrays["classes"]
+
+    # The deviance loss was renamed log_loss in sklearn 1.1.
+    model = GradientBoostingClassifier(loss="log_loss", **dict((name, params[name]) for name in ("learning_rate",
+        "n_estimators", "subsample", "criterion", "min_samples_split", "min_samples_leaf", "min_weight_fraction_leaf",
+        "max_depth", "min_impurity_decrease", "max_features", "max_leaf_nodes", "tol", "validation_fraction")))
+    model.init_ = _dummy_prior(float(arrays["prior"]), n_features, classes)
+    model.classes_ = classes
+    model.n_classes_ = len(classes)
+    model._n_classes = len(classes)
+    model.n_features_in_ = n_features
+    model.max_features_ = settings["max_features"]
+    model.n_estimators_ = settings["n_estimators"]
+    model._loss = BinomialDeviance(len(classes))
+    model.train_score_ = arrays["train_score"]
+    model.oob_improvement_ = None
+
+    tree_params = settings["tree_params"]
+    model.estimators_ = np.empty((settings["n_estimators"], 1), dtype=object)
+    for position in range(settings["n_estimators"]):
+        estimator = DecisionTreeRegressor(**dict((name, tree_params[name]) for name in ("criterion", "splitter",
+            "max_depth", "min_samples_split", "min_samples_leaf", "min_weight_fraction_leaf", "max_features",
+            "max_leaf_nodes", "min_impurity_decrease")))
+        nodes = arrays["nodes_{}".format(position)]
+        estimator.tree_ = Tree(n_features, np.array([1], dtype=np.intp), 1)
+        estimator.tree_.__setstate__({"max_depth": int(arrays["max_depth_{}".format(position)]), "node_count": len(nodes),
+            "nodes": nodes, "values": arrays["values_{}".format(position)]})
+        estimator.n_features_in_ = n_features
+        estimator.n_outputs_ = 1
+        estimator.max_features_ = settings["tree_max_features"]
+        model.estimators_[position, 0] = estimator
+
+    with open(output_path, "wb") as model_file:
+        pickle.dump(model, model_file)
+
+    proba = model.predict_proba(arrays["check_inputs"])
+    check_proba = arrays["check_proba"]
+    return (np.mean(proba.argmax(axis=1) != check_proba.argmax(axis=1)), np.abs(proba - check_proba).max())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Converts finalized_model.sav from scikit-learn 0.20 to the installed scikit-learn, "
+        "in two steps: export (run under Python 3.7 with scikit-learn 0.20), then convert.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    export_parser = subparsers.add_parser("export", help="save the 0.20 model's arrays")
+    export_parser.add_argument("model", nargs="?", default="finalized_model.sav", help="scikit-learn 0.20 model (default: finalized_model.sav)")
+    export_parser.add_argument("output", nargs="?", default="finalized_model_arrays.npz", help="exported arrays (default: finalized_model_arrays.npz)")
+    convert_parser = subparsers.add_parser("convert", help="rebuild the model from the exported arrays")
+    convert_parser.add_argument("arrays", nargs="?", default="finalized_model_arrays.npz", help="exported arrays (default: finalized_model_arrays.npz)")
+    convert_parser.add_argument("output", nargs="?", default="finalized_model.sav", help="converted model (default: finalized_model.sav)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_model(args.model, args.output)
+        print("Exported {} to {}".format(args.model, args.output))
+    else:
+        (class_differences, max_difference) = convert_model(args.arrays, args.output)
+        print("Converted model saved to {}: {:.4%} of class predictions differ, probabilities are within {:.2g}".format(
+            args.output, class_differences, max_difference))
@@ -0,0 +1,342 @@
+import os
+import csv
+import json
+import time
+import errno
+import shutil
+import hashlib
+import argparse
+import warnings
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import brier_score_loss, log_loss, f1_score
+from sklearn.model_selection import KFold, GroupKFold
+from sklearn.preprocessing import StandardScaler
+
+import scoring
+import export_data
+
+CV_CACHE_DIR = "cv_cache"
+
+RESULT_FIELDS = ["model", "fold", "train_rows", "test_rows", "f1", "brier", "log_loss", "fit_seconds", "predict_seconds"]
+
+
+def training_data(frames, min_income=1000):
+    """
+    Prepares the cohorts' data (in the form Cohort.data() returns, e.g., read
+    from the exported CSVs) for training, as in Cross-Validation.ipynb: rows
+    with an adjusted_income of min_income or less are dropped and missing
+    values are filled with zeros. Returns the predictors (as a DataFrame),
+    the labels, and each row's respondent, which is unique across cohorts
+    (case IDs are only unique within a cohort).
+    """
+    merged_data = pd.concat(frames, sort=False)
+    cohort = np.concatenate([np.full(len(df), position) for (position, df) in enumerate(frames)])
+
+    keep = (merged_data["adjusted_income"] > min_income).values
+    merged_data = merged_data[keep].fillna(0)
+    cohort = cohort[keep]
+
+    predictors = scoring.FeatureSchema.from_frame(merged_data).predictors
+    groups = cohort * (int(merged_data["case_id"].max()) + 1) + merged_data["case_id"].values.astype(np.int64)
+
+    return (merged_data[predictors], np.ravel(merged_data["shock"]), groups)
+
+
+def make_folds(n_rows, n_folds, groups=None):
+    """
+    Returns each fold's (train, test) row indices. If `groups` is given (e.g.,
+    each row's respondent), all of a group's rows are kept in the same fold,
+    so that the model isn't tested on people it has already seen in other
+    years. Otherwise the folds are consecutive, as with KFold.
+    """
+    rows = np.zeros((n_rows, 1))
+    if groups is None:
+        return list(KFold(n_splits=n_folds).split(rows))
+    return list(GroupKFold(n_splits=n_folds).split(rows, groups=groups))
+
+
+class FoldCache(object):
+    """
+    Caches each fold's training and test matrices (scaled, if need be) on
+    disk as .npy files, so that they're only computed once, and so that the
+    worker processes fitting models can memory-map them rather than each
+    getting its own copy.
+
+    Entries are keyed on a hash of the data, the number of folds, the groups,
+    and whether the data is scaled.
+    """
+
+    def __init__(self, cache_dir=CV_CACHE_DIR):
+        self._cache_dir = cache_dir
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def key(self, X, y, n_folds, groups=None, scale=False):
+        digest = hashlib.sha256()
+        digest.update(json.dumps({"shape": X.shape, "n_folds": n_folds, "scale": bool(scale),
+            "grouped": groups is not None}).encode("utf-8"))
+        for array in (X, y, groups):
+            if array is not None:
+                digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()[:16]
+
+    def entry_dir(self, X, y, n_folds, groups=None, scale=False):
+        """
+        Returns the directory of the folds' matrices, building them first if
+        they aren't cached already.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y)
+        groups = None if groups is None else np.asarray(groups)
+
+        entry_dir = os.path.join(self._cache_dir, self.key(X, y, n_folds, groups, scale))
+        if os.path.exists(os.path.join(entry_dir, "folds.json")):
+            return entry_dir
+
+        # As in FeatureCache, the entry is written to a temporary directory first,
+        # so a half-written entry is never picked up.
+        partial_dir = "{}.{}.{}.partial".format(entry_dir, os.getpid(), threading.get_ident())
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        os.makedirs(partial_dir)
+
+        folds = make_folds(len(X), n_folds, groups)
+        for (fold, (train_index, test_index)) in enumerate(folds):
+            (X_train, X_test) = (X[train_index], X[test_index])
+            if scale:
+                scaler = StandardScaler().fit(X_train)
+                X_train = scaler.transform(X_train)
+                X_test = scaler.transform(X_test)
+
+            for (name, array) in (("train_index", train_index), ("test_index", test_index), ("X_train", X_train),
+                    ("X_test", X_test), ("y_train", y[train_index]), ("y_test", y[test_index])):
+                np.save(os.path.join(partial_dir, "{}_{}.npy".format(name, fold)), array)
+
+        with open(os.path.join(partial_dir, "folds.json"), "w") as json_file:
+            json.dump({"n_folds": n_folds, "rows": len(X), "grouped": groups is not None, "scale": bool(scale)}, json_file)
+
+        # An entry that's already there (e.g., built by another search sharing
+        # the cache in the meantime) has the same key, and so the same folds,
+        # and may be in use, so it's left alone. Anything else there is left
+        # over from a broken entry, and is moved aside before it's deleted, as
+        # in Panel.save().
+        while True:
+            try:
+                os.rename(partial_dir, entry_dir)
+                return entry_dir
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+            if os.path.exists(os.path.join(entry_dir, "folds.json")):
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                return entry_dir
+            stale_dir = "{}.{}.{}.stale".format(entry_dir, os.getpid(), threading.get_ident())
+            try:
+                os.rename(entry_dir, stale_dir)
+            except OSError:
+                continue
+            shutil.rmtree(stale_dir, ignore_errors=True)
+
+    @staticmethod
+    def load_fold(entry_dir, fold, mmap_mode="r"):
+        """
+        Returns a fold's X_train, X_test, y_train, and y_test.
+        """
+        return tuple(np.load(os.path.join(entry_dir, "{}_{}.npy".format(name, fold)), mmap_mode=mmap_mode)
+            for name in ("X_train", "X_test", "y_train", "y_test"))
+
+
+def _run_job(job):
+    (entry_dir, fold, name, estimator, fit_params, keep_estimator) = job
+    (X_train, X_test, y_train, y_test) = FoldCache.load_fold(entry_dir, fold)
+
+    estimator = clone(estimator)
+    start = time.time()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        estimator.fit(X_train, y_train, **fit_params)
+        fit_seconds = time.time() - start
+
+        start = time.time()
+        predicted_proba = estimator.predict_proba(X_test)[:, 1]
+        predicted = estimator.predict(X_test)
+        predict_seconds = time.time() - start
+
+        result = {
+            "model": name,
+            "fold": fold,
+            "train_rows": len(y_train),
+            "test_rows": len(y_test),
+            "f1": f1_score(y_test, predicted, average="weighted"),
+            "brier": brier_score_loss(y_test, predicted_proba),
+            "log_loss": log_loss(y_test, predicted_proba, labels=[0, 1]),
+            "fit_seconds": fit_seconds,
+            "predict_seconds": predict_seconds
+        }
+        if keep_estimator:
+            result["estimator"] = estimator
+        return result
+
+
+def model_names(models):
+    """
+    Names a list of models by their class, numbering any that would
+    otherwise share a name. Dictionaries of name and model are left as is.
+    """
+    if isinstance(models, dict):
+        return list(models.items())
+
+    classes = [model.__class__.__name__ for model in models]
+    names = []
+    for (position, model) in enumerate(models):
+        name = classes[position]
+        if classes.count(name) > 1:
+            name = "{}_{}".format(name, classes[:position + 1].count(name))
+        names.append((name, model))
+    return names
+
+
+def cross_validate(models, X, y, n_folds=12, groups=None, scale=False, n_jobs=None, cache_dir=CV_CACHE_DIR,
+        results_path=None, fit_params=None, fitted_fold=None, verbose=True):
+    """
+    Cross-validates each of the models (a list of estimators, or a dictionary
+    of name and estimator) on the same folds, fitting the (model, fold) pairs
+    in parallel over `n_jobs` processes (default: one per CPU). The folds are
+    split by `groups` if given (see make_folds()), and scaled if `scale` is
+    set, and cached in `cache_dir`.
+
+    Returns a DataFrame of each fold's F1 score, Brier score loss, log loss,
+    and fit and predict times. These are also written to `results_path` (as
+    CSV), if given, as each fold finishes. If `fitted_fold` is given, the
+    results also have an estimator column, holding each model as fitted on
+    that fold (and None for the other folds).
+    """
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+
+    start = time.time()
+    entry_dir = FoldCache(cache_dir).entry_dir(X, y, n_folds, groups, scale)
+    if verbose:
+        print("Prepared {} folds in {:.2f} seconds".format(n_folds, time.time() - start))
+
+    jobs = [(entry_dir, fold, name, model, fit_params or {}, fold == fitted_fold)
+        for (name, model) in model_names(models) for fold in range(n_folds)]
+
+    results = []
+    results_file = open(results_path, "w", newline="") if results_path is not None else None
+    try:
+        if results_file is not None:
+            writer = csv.DictWriter(results_file, RESULT_FIELDS)
+            writer.writeheader()
+
+        if n_jobs > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(n_jobs, len(jobs)))
+            job_results = pool.imap_unordered(_run_job, jobs)
+        else:
+            pool = None
+            job_results = (_run_job(job) for job in jobs)
+
+        try:
+            for result in job_results:
+                results.append(result)
+                if results_file is not None:
+                    writer.writerow(dict((field, result[field]) for field in RESULT_FIELDS))
+                    results_file.flush()
+                if verbose:
+                    print("    {} fold {} took {:.2f} seconds to fit".format(result["model"], result["fold"], result["fit_seconds"]))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    finally:
+        if results_file is not None:
+            results_file.close()
+
+    # Folds finish in any order, so the results are put back in the order of the models and folds.
+    order = dict((name, position) for (position, (name, model)) in enumerate(model_names(models)))
+    results.sort(key=lambda result: (order[result["model"]], result["fold"]))
+    return pd.DataFrame(results, columns=RESULT_FIELDS + (["estimator"] if fitted_fold is not None else []))
+
+
+def summarize(results):
+    """
+    Averages each model's per-fold results, keeping the models in order.
+    """
+    summary = results.groupby("model", sort=False)[["f1", "brier", "log_loss", "fit_seconds", "predict_seconds"]].mean()
+    return summary.reindex(results["model"].unique())
+
+
+def print_summary(results):
+    for (name, row) in summarize(results).iterrows():
+        print("Model: {}".format(name))
+        print("F1 score (higher is better): {:.03f}".format(row["f1"]))
+        print("Brier score loss (lower is better): {:.03f}".format(row["brier"]))
+        print("Log loss (lower is better): {:.03f}".format(row["log_loss"]))
+        print("Time to train each fold: {:.02f} seconds\n".format(row["fit_seconds"] + row["predict_seconds"]))
+
+
+def score_model(X, y, estimator, n_folds, scale=False, groups=None, n_jobs=None, **kwargs):
+    """
+    A drop-in replacement for the notebooks' score_model, which fits the folds
+    in parallel and prints the same summary. As before, `estimator` is left
+    fitted on the last fold's training data.
+    """
+    results = cross_validate([estimator], X, y, n_folds, groups, scale, n_jobs, fit_params=kwargs,
+        fitted_fold=n_folds - 1, verbose=False)
+    estimator.__setstate__(results["estimator"].iloc[-1].__getstate__())
+    results = results.drop(columns=["estimator"])
+    print_summary(results)
+    return results
+
+
+def default_models():
+    """
+    The models compared in Cross-Validation.ipynb.
+    """
+    from sklearn.linear_model import LogisticRegression, SGDClassifier
+    from sklearn.ensemble import BaggingClassifier, RandomForestClassifier, GradientBoostingClassifier
+    from sklearn.naive_bayes import GaussianNB
+    from sklearn.neural_network import MLPClassifier
+
+    # The logistic loss was renamed in sklearn 1.1.
+    sgd_loss = "log_loss" if "log_loss" in SGDClassifier.loss_functions else "log"
+
+    return [
+        SGDClassifier(loss=sgd_loss, max_iter=1000, tol=.001),
+        LogisticRegression(solver="lbfgs"),
+        GradientBoostingClassifier(),
+        RandomForestClassifier(n_estimators=100),
+        BaggingClassifier(),
+        GaussianNB(),
+        MLPClassifier(hidden_layer_sizes=(71,), activation='tanh', alpha=.001),
+        GradientBoostingClassifier(n_estimators=100, learning_rate=.3, max_features=30, max_depth=4, min_samples_leaf=75),
+    ]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Cross-validates the models from Cross-Validation.ipynb on exported cohort data.")
+    parser.add_argument("data", nargs="+", help="Parquet or CSV files of each cohort's data, as written by export_data.py")
+    parser.add_argument("--folds", type=int, default=12, help="number of folds (default: 12)")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+        help="number of folds to fit in parallel (default: one per CPU)")
+    parser.add_argument("--group", action="store_true",
+        help="keep each respondent's rows in the same fold")
+    parser.add_argument("--no-scale", action="store_true",
+        help="don't standardize the predictors")
+    parser.add_argument("--cache-dir", default=CV_CACHE_DIR,
+        help="directory to cache the folds in (default: {})".format(CV_CACHE_DIR))
+    parser.add_argument("--results", default="cv_results.csv",
+        help="CSV file to write each fold's results to (default: cv_results.csv)")
+    args = parser.parse_args()
+
+    (X, y, groups) = training_data([export_data.read_export(path) for path in args.data])
+    results = cross_validate(default_models(), X, y, args.folds, groups if args.group else None, not args.no_scale,
+        args.jobs, args.cache_dir, args.results)
+    print()
+    print_summary(results)
@@ -0,0 +1,170 @@
+import os
+import json
+import argparse
+import pandas as pd
+
+import nlsy
+
+EXPORT_FORMATS = ["parquet", "csv"]
+
+
+def _export_format(path):
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError("Can't tell the format of {} from its extension (expected one of: {})".format(path, ", ".join(EXPORT_FORMATS)))
+    return extension
+
+
+def schema_path(path):
+    """
+    Returns the path of the schema sidecar written alongside a CSV export.
+    """
+    return "{}.schema.json".format(path)
+
+
+def export_cohort(cohort, path, chunksize=10000, impute_values=True, categories=None):
+    """
+    Writes a cohort's data (as returned by Cohort.data()) to a Parquet or CSV
+    file, depending on the path's extension, a chunk at a time (see
+    Cohort.iter_data()), so memory use doesn't grow with the cohort's size.
+    Parquet files get a row group per chunk. CSV files get a sidecar
+    (see schema_path()) recording each column's dtype, so they can be read
+    back without type inference.
+
+    The file is written under a temporary name first, so a half-written
+    export is never picked up. Returns the number of rows written.
+    """
+    export_format = _export_format(path)
+    partial_path = "{}.partial".format(path)
+    chunks = cohort.iter_data(chunksize, impute_values, categories=categories)
+
+    rows = 0
+    if export_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, schema=writer.schema if writer is not None else None, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(partial_path, table.schema)
+                writer.write_table(table)
+                rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            raise ValueError("{} data is empty".format(cohort.cohort_year))
+    else:
+        dtypes = None
+        with open(partial_path, "w") as csv_file:
+            for chunk in chunks:
+                chunk.to_csv(csv_file, header=dtypes is None, index=False)
+                if dtypes is None:
+                    (columns, dtypes) = ([str(col) for col in chunk.columns], [str(dtype) for dtype in chunk.dtypes])
+                rows += len(chunk)
+        if dtypes is None:
+            raise ValueError("{} data is empty".format(cohort.cohort_year))
+
+        with open(schema_path(path), "w") as json_file:
+            json.dump({"cohort": cohort.cohort_year, "impute_values": impute_values, "rows": rows, "columns": columns,
+                "dtypes": dtypes}, json_file)
+
+    os.replace(partial_path, path)
+    return rows
+
+
+def _csv_dtypes(path, columns=None):
+    # CSVs exported before there were sidecars (e.g., by the old notebook)
+    # fall back on pandas' type inference.
+    if not os.path.exists(schema_path(path)):
+        return None
+    with open(schema_path(path)) as json_file:
+        schema = json.load(json_file)
+    dtypes = dict(zip(schema["columns"], schema["dtypes"]))
+    if columns is not None:
+        dtypes = {col: dtypes[col] for col in columns}
+    return dtypes
+
+
+def read_export(path, columns=None):
+    """
+    Reads an export back into a DataFrame, optionally only the given columns.
+    CSV exports are parsed with the dtypes recorded in their sidecar, if
+    they have one.
+    """
+    if _export_format(path) == "parquet":
+        return pd.read_parquet(path, columns=columns)
+
+    dtypes = _csv_dtypes(path, columns)
+    if dtypes is None:
+        return pd.read_csv(path, usecols=columns)
+    return pd.read_csv(path, usecols=list(dtypes), dtype=dtypes, engine="c", float_precision="round_trip")[list(dtypes)]
+
+
+def iter_export(path, chunksize=10000, columns=None):
+    """
+    Yields an export as DataFrames of up to `chunksize` rows each,
+    optionally only the given columns.
+    """
+    if _export_format(path) == "parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        dtypes = _csv_dtypes(path, columns)
+        if dtypes is None:
+            for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+                yield chunk
+            return
+        for chunk in pd.read_csv(path, usecols=list(dtypes), dtype=dtypes, engine="c", float_precision="round_trip", chunksize=chunksize):
+            yield chunk[list(dtypes)]
+
+
+def export_cohorts(NLSY_db, output_dir="data", export_format="parquet", cohort_years=None, chunksize=10000, impute_values=True, verbose=True):
+    """
+    Exports each of the database's cohorts (or only those in `cohort_years`)
+    to `output_dir`, as cohort79.parquet, cohort97.parquet, etc. The cohorts
+    share their dummy variables, with a column for every category found in
+    any of them. Returns the paths written.
+    """
+    cohorts = [cohort for cohort in NLSY_db.cohorts if cohort_years is None or str(cohort.cohort_year) in [str(year) for year in cohort_years]]
+    if not cohorts:
+        raise ValueError("No cohorts to export")
+
+    categories = {variable: set() for variable in nlsy.CATEGORICAL_VARIABLES}
+    for cohort in cohorts:
+        for (variable, values) in cohort.data_categories(impute_values, chunksize=chunksize).items():
+            categories[variable].update(values)
+    categories = {variable: sorted(values) for (variable, values) in categories.items()}
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    paths = []
+    for cohort in cohorts:
+        path = os.path.join(output_dir, "cohort{}.{}".format(str(cohort.cohort_year)[2:], export_format))
+        rows = export_cohort(cohort, path, chunksize, impute_values, categories)
+        if verbose:
+            print("Exported {} rows of {} data to {}".format(rows, cohort.cohort_year, path))
+        paths.append(path)
+
+    return paths
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Exports cohort data, ready for modeling, to Parquet or CSV files.")
+    parser.add_argument("--db", default="data.db", help="database to export from (default: data.db)")
+    parser.add_argument("--cohorts", nargs="+", help="cohort years to export (default: all of them)")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="parquet", help="file format (default: parquet)")
+    parser.add_argument("--output-dir", default="data", help="directory to write the files to (default: data)")
+    parser.add_argument("--chunksize", type=int, default=10000,
+        help="number of rows to read from the database at a time (default: 10000)")
+    parser.add_argument("--no-impute", action="store_true",
+        help="drop rows with missing values rather than imputing them")
+    args = parser.parse_args()
+
+    export_cohorts(nlsy.NLSY_database(args.db, read_only=True), args.output_dir, args.format, args.cohorts, args.chunksize, not args.no_impute)
@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import pickle
+import numpy as np
+import pandas as pd
+from pandas.core.internals import BlockManager
+from pandas.core.internals.api import make_block
+
+import reference_data
+
+# Bump this whenever Cohort.data() changes in a way that affects its output,
+# or the cache's layout changes, so that stale caches aren't picked up.
+CACHE_VERSION = 2
+
+# The number of rows read at a time when fingerprinting a table.
+FINGERPRINT_BATCH_SIZE = 10000
+
+
+def file_digest(path):
+    return reference_data.registry.digest(path)
+
+
+def table_fingerprint(conn, table):
+    """
+    Identifies a table's contents with a SHA-256 hash of its rows, in rowid
+    order, so that any change to any value (including values moved between
+    rows) changes the fingerprint. This reads the whole table.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info({})".format(table))
+    columns = [row[1] for row in cursor.fetchall()]
+
+    digest = hashlib.sha256()
+    cursor.execute("SELECT * FROM {} ORDER BY rowid".format(table))
+    rows = cursor.fetchmany(FINGERPRINT_BATCH_SIZE)
+    while rows:
+        digest.update(pickle.dumps(rows, protocol=4))
+        rows = cursor.fetchmany(FINGERPRINT_BATCH_SIZE)
+    cursor.close()
+    return [table, columns, digest.hexdigest()]
+
+
+class FeatureCache(object):
+    """
+    Caches the output of Cohort.data() on disk, as one 2-D .npy file per
+    dtype, so that the training data can be memory-mapped rather than rebuilt
+    (or re-parsed from CSV) every time.
+
+    Each entry is keyed on a hash of everything the output depends on: the
+    cohort's tables in the database, translate.json, db_structure.json, the
+    crosswalk files, and the impute_values flag. Entries that no longer match
+    are replaced automatically. Several threads or processes can share a
+    cache; if they build the same entry at the same time, the first one
+    written is kept.
+    """
+
+    def __init__(self, cache_dir="feature_cache"):
+        self._cache_dir = cache_dir
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def key(self, cohort, impute_values=True, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv"):
+        NLSY_db = cohort.NLSY_db
+        tables = [cohort.wrangled_respondents_table, cohort.wrangled_data_table, NLSY_db.years_table, NLSY_db.region_table]
+        inputs = {
+            "version": CACHE_VERSION,
+            "impute_values": bool(impute_values),
+            "tables": [table_fingerprint(NLSY_db.conn, table) for table in tables],
+            "dictionary": cohort.dictionary,
+            "db_structure": NLSY_db.db_structure,
+            "industry_file": file_digest(industry_file),
+            "occupation_file": file_digest(occupation_file)
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+    def _entry_prefix(self, cohort, impute_values):
+        return "cohort{}_{}".format(cohort.cohort_year, "imputed" if impute_values else "raw")
+
+    def _entry_dir(self, cohort, impute_values, key):
+        return os.path.join(self._cache_dir, "{}_{}".format(self._entry_prefix(cohort, impute_values), key))
+
+    def load(self, entry_dir, mmap_mode="c"):
+        """
+        Loads a cached DataFrame. With the default mmap_mode, its columns are
+        memory-mapped rather than read into memory up front: the DataFrame's
+        blocks are the mapped arrays themselves, so pages are only read when
+        they're used. Changes to the DataFrame are never written back to the
+        cache.
+        """
+        with open(os.path.join(entry_dir, "columns.json")) as json_file:
+            manifest = json.load(json_file)
+
+        # Each block holds every column of one dtype, as pandas stores them,
+        # so that the DataFrame can be built around the arrays without
+        # copying (or consolidating) them.
+        blocks = []
+        for position, placement in enumerate(manifest["blocks"]):
+            values = np.load(os.path.join(entry_dir, "block{}.npy".format(position)), mmap_mode=mmap_mode)
+            blocks.append(make_block(values.view(np.ndarray), placement=placement))
+
+        index = pd.Index(np.load(os.path.join(entry_dir, "index.npy")))
+        return pd.DataFrame(BlockManager(blocks, [pd.Index(manifest["columns"]), index]))
+
+    def store(self, entry_dir, df):
+        """
+        Writes a DataFrame to the cache. It's written to a temporary directory
+        first, so a half-written entry is never picked up.
+        """
+        partial_dir = "{}.{}.{}.partial".format(entry_dir, os.getpid(), threading.get_ident())
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        os.makedirs(partial_dir)
+
+        # Columns that pandas couldn't infer a type for (e.g., regional
+        # unemployment, when some regional figures were missing) are stored
+        # as numbers.
+        columns = dict((position, df.iloc[:, position]) for position in range(len(df.columns)))
+        for position, values in columns.items():
+            if values.dtype == object:
+                columns[position] = pd.to_numeric(values)
+
+        # The columns are grouped by dtype into a block each, written a
+        # column at a time.
+        placements = {}
+        for position, values in columns.items():
+            placements.setdefault(values.dtype, []).append(position)
+        for block, (dtype, placement) in enumerate(placements.items()):
+            block_values = np.lib.format.open_memmap(os.path.join(partial_dir, "block{}.npy".format(block)),
+                mode="w+", dtype=dtype, shape=(len(placement), len(df)))
+            for row, position in enumerate(placement):
+                block_values[row] = columns[position].values
+            block_values.flush()
+            del block_values
+        np.save(os.path.join(partial_dir, "index.npy"), df.index.values)
+
+        with open(os.path.join(partial_dir, "columns.json"), "w") as json_file:
+            json.dump({"columns": [str(column) for column in df.columns], "blocks": list(placements.values()),
+                "dtypes": [str(values.dtype) for values in columns.values()]}, json_file)
+
+        # An entry that's already there (e.g., written by another reader in
+        # the meantime) has the same key, and so the same contents, and may
+        # be in use, so it's left alone.
+        try:
+            os.rename(partial_dir, entry_dir)
+        except OSError:
+            if os.path.exists(os.path.join(entry_dir, "columns.json")):
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                return
+            # Anything else there is left over from a broken entry.
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(partial_dir, entry_dir)
+
+    def data(self, cohort, impute_values=True, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv"):
+        """
+        Returns the cohort's data from the cache, building (and caching) it
+        first if there's no up-to-date entry.
+        """
+        key = self.key(cohort, impute_values, industry_file, occupation_file)
+        entry_dir = self._entry_dir(cohort, impute_values, key)
+        if os.path.exists(os.path.join(entry_dir, "columns.json")):
+            return self.load(entry_dir)
+
+        # Clear out any stale entries for this cohort before adding the new
+        # one (leaving any that are being written with the same key).
+        if os.path.isdir(self._cache_dir):
+            prefix = "{}_".format(self._entry_prefix(cohort, impute_values))
+            for entry in os.listdir(self._cache_dir):
+                if entry.startswith(prefix) and not entry.startswith(os.path.basename(entry_dir)):
+                    shutil.rmtree(os.path.join(self._cache_dir, entry), ignore_errors=True)
+
+        df = cohort.data(impute_values, industry_file, occupation_file)
+        self.store(entry_dir, df)
+        return self.load(entry_dir)
@@ -0,0 +1,303 @@
+import json
+import math
+import time
+import sqlite3
+import argparse
+import warnings
+import multiprocessing
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.metrics import brier_score_loss, log_loss, f1_score
+
+import cross_validation
+import export_data
+
+SEARCH_DB_PATH = "search_results.db"
+
+# The settings of the final model in Cross-Validation.ipynb, which any
+# parameters that aren't searched over are left at.
+BASE_PARAMS = {"learning_rate": .3, "max_features": 30, "max_depth": 4, "min_samples_leaf": 75}
+
+# The default search space, with the values each parameter is sampled from.
+DEFAULT_SPACE = {
+    "learning_rate": [.03, .05, .1, .2, .3, .5],
+    "max_depth": [2, 3, 4, 5, 6],
+    "max_features": [10, 20, 30, 40, 50, None],
+    "min_samples_leaf": [25, 50, 75, 100, 200],
+    "subsample": [.5, .8, 1.]
+}
+
+# The numbers of trees to evaluate each candidate at. They're all evaluated
+# from a single fit, using the staged predictions of the largest.
+DEFAULT_N_ESTIMATORS = [25, 50, 75, 100, 150, 200, 300]
+
+# Whether lower (1) or higher (-1) is better for each metric.
+METRICS = {"log_loss": 1, "brier": 1, "f1": -1}
+
+
+def sample_candidates(space, n_candidates, seed=0):
+    """
+    Samples up to `n_candidates` distinct parameter settings from a search
+    space (a dictionary of parameter name and the values to choose from). If
+    the space has no more settings than that, all of them are returned, as in
+    a grid search. The same seed always gives the same candidates, so an
+    interrupted search can pick up where it left off.
+    """
+    names = sorted(space)
+    n_settings = int(np.prod([len(space[name]) for name in names]))
+    if n_settings <= n_candidates:
+        positions = [np.unravel_index(setting, [len(space[name]) for name in names]) for setting in range(n_settings)]
+    else:
+        random_state = np.random.RandomState(seed)
+        settings = random_state.choice(n_settings, n_candidates, replace=False)
+        positions = [np.unravel_index(setting, [len(space[name]) for name in names]) for setting in settings]
+
+    return [dict((name, space[name][position]) for (name, position) in zip(names, setting)) for setting in positions]
+
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+class SearchStore(object):
+    """
+    Records every trial of a search (a candidate's results on one fold at one
+    rung, for each number of trees) in a SQLite database, as it finishes, so
+    that an interrupted search can be resumed without rerunning them.
+    """
+
+    def __init__(self, path=SEARCH_DB_PATH):
+        self._conn = sqlite3.connect(path)
+
+        cursor = self._conn.cursor()
+        cursor.execute("""CREATE TABLE IF NOT EXISTS searches (
+                    name TEXT PRIMARY KEY,
+                    config TEXT,
+                    started TEXT
+                )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS trials (
+                    search TEXT,
+                    params TEXT,
+                    rung INTEGER,
+                    fold INTEGER,
+                    n_estimators INTEGER,
+                    train_rows INTEGER,
+                    f1 REAL,
+                    brier REAL,
+                    log_loss REAL,
+                    fit_seconds REAL,
+                    completed TEXT,
+                    PRIMARY KEY (search, rung, params, fold, n_estimators)
+                ) WITHOUT ROWID""")
+        self._conn.commit()
+        cursor.close()
+
+    @property
+    def conn(self):
+        return self._conn
+
+    def start_search(self, name, config):
+        """
+        Registers a search, or checks that a search being resumed has the same
+        configuration (otherwise its trials couldn't be reused).
+        """
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT config FROM searches WHERE name = ?", (name, ))
+        row = cursor.fetchone()
+        config = json.dumps(config, sort_keys=True)
+        if row is None:
+            cursor.execute("INSERT INTO searches (name, config, started) VALUES (?, ?, datetime('now'))", (name, config))
+            self._conn.commit()
+        elif row[0] != config:
+            cursor.close()
+            raise ValueError("A search named {} was already run with different settings".format(name))
+        cursor.close()
+
+    def completed_trials(self, name, rung):
+        """
+        Returns the (params, fold) pairs that have already been run at a rung.
+        """
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT DISTINCT params, fold FROM trials WHERE search = ? AND rung = ?", (name, rung))
+        completed = set(cursor.fetchall())
+        cursor.close()
+        return completed
+
+    def add_trial(self, name, rung, result):
+        cursor = self._conn.cursor()
+        cursor.executemany("""INSERT OR REPLACE INTO trials
+                    (search, params, rung, fold, n_estimators, train_rows, f1, brier, log_loss, fit_seconds, completed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+            [(name, result["params"], rung, result["fold"], stage["n_estimators"], result["train_rows"], stage["f1"],
+                stage["brier"], stage["log_loss"], result["fit_seconds"]) for stage in result["stages"]])
+        self._conn.commit()
+        cursor.close()
+
+    def rung_scores(self, name, rung, n_folds, metric="log_loss"):
+        """
+        Returns each candidate's best mean score over the folds at a rung, and
+        the number of trees it was reached with, best first.
+        """
+        order = "ASC" if METRICS[metric] > 0 else "DESC"
+        scores = pd.read_sql("""SELECT params, n_estimators, AVG({metric}) AS score
+                    FROM trials
+                    WHERE search = ? AND rung = ?
+                    GROUP BY params, n_estimators
+                    HAVING COUNT(*) = ?
+                    ORDER BY score {order}, params, n_estimators""".format(metric = metric, order = order),
+            self._conn, params=(name, rung, n_folds))
+        return scores.drop_duplicates("params").reset_index(drop=True)
+
+    def results(self, name):
+        """
+        Returns a DataFrame of each candidate's mean results over the folds,
+        for each rung and number of trees.
+        """
+        return pd.read_sql("""SELECT rung, params, n_estimators, MAX(train_rows) AS train_rows, COUNT(*) AS folds,
+                        AVG(f1) AS f1, AVG(brier) AS brier, AVG(log_loss) AS log_loss, AVG(fit_seconds) AS fit_seconds
+                    FROM trials
+                    WHERE search = ?
+                    GROUP BY rung, params, n_estimators
+                    ORDER BY rung, params, n_estimators""", self._conn, params=(name, ))
+
+    def close(self):
+        self._conn.close()
+
+
+def _run_trial(job):
+    """
+    Fits a candidate with the largest number of trees on (a subsample of) a
+    fold's training data, and scores its staged predictions for each of the
+    smaller numbers of trees too.
+    """
+    (entry_dir, fold, params, n_estimators, train_rows, seed) = job
+    (X_train, X_test, y_train, y_test) = cross_validation.FoldCache.load_fold(entry_dir, fold)
+
+    # Each rung's subsample contains the previous rung's.
+    if train_rows is not None and train_rows < len(y_train):
+        rows = np.sort(np.random.RandomState(seed + fold).permutation(len(y_train))[:train_rows])
+        (X_train, y_train) = (X_train[rows], y_train[rows])
+
+    model_params = dict(BASE_PARAMS)
+    model_params.update(json.loads(params))
+    model = GradientBoostingClassifier(n_estimators=max(n_estimators), random_state=seed, **model_params)
+
+    start = time.time()
+    model.fit(X_train, y_train)
+    fit_seconds = time.time() - start
+
+    stages = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for (stage, predicted_proba) in enumerate(model.staged_predict_proba(X_test), 1):
+            if stage in n_estimators:
+                predicted_proba = predicted_proba[:, 1]
+                stages.append({
+                    "n_estimators": stage,
+                    "f1": f1_score(y_test, predicted_proba > .5, average="weighted"),
+                    "brier": brier_score_loss(y_test, predicted_proba),
+                    "log_loss": log_loss(y_test, predicted_proba, labels=[0, 1])
+                })
+
+    return {"params": params, "fold": fold, "train_rows": len(y_train), "fit_seconds": fit_seconds, "stages": stages}
+
+
+def search(X, y, name="search", space=DEFAULT_SPACE, n_candidates=50, n_estimators=DEFAULT_N_ESTIMATORS, n_folds=3,
+        groups=None, factor=3, min_rows=None, metric="log_loss", n_jobs=None, seed=0, store_path=SEARCH_DB_PATH,
+        cache_dir=cross_validation.CV_CACHE_DIR, verbose=True):
+    """
+    Searches for the GradientBoostingClassifier settings with the best
+    cross-validated `metric`, using successive halving: all the candidates
+    sampled from `space` are first evaluated on `min_rows` rows of each
+    fold's training data, then the best 1/`factor` of them on `factor` times
+    as many rows, and so on until the rest are evaluated on all of it. With
+    no `min_rows`, this is a randomized search over all of the data. Each
+    candidate is evaluated at every number of trees in `n_estimators` from a
+    single fit.
+
+    Trials are run in parallel over `n_jobs` processes (default: one per CPU)
+    and recorded in a SearchStore at `store_path`; rerunning a search with
+    the same name and settings picks up where it left off. Returns the best
+    parameters (including n_estimators) and the search's results.
+    """
+    if metric not in METRICS:
+        raise ValueError("Unknown metric: {}".format(metric))
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    n_estimators = sorted(n_estimators)
+
+    store = SearchStore(store_path)
+    store.start_search(name, {"space": space, "n_candidates": n_candidates, "n_estimators": n_estimators,
+        "n_folds": n_folds, "grouped": groups is not None, "factor": factor, "min_rows": min_rows, "metric": metric,
+        "seed": seed, "rows": len(y)})
+
+    entry_dir = cross_validation.FoldCache(cache_dir).entry_dir(X, y, n_folds, groups)
+    full_rows = len(y) - len(y) // n_folds
+    n_rungs = 1 if not min_rows or min_rows >= full_rows else int(math.log(float(full_rows) / min_rows, factor)) + 1
+
+    candidates = [params_key(params) for params in sample_candidates(space, n_candidates, seed)]
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        for rung in range(n_rungs):
+            # The last rung uses all of each fold's training data.
+            train_rows = None if rung == n_rungs - 1 else min_rows * factor ** rung
+            completed = store.completed_trials(name, rung)
+            jobs = [(entry_dir, fold, params, n_estimators, train_rows, seed) for params in candidates
+                for fold in range(n_folds) if (params, fold) not in completed]
+
+            start = time.time()
+            if verbose:
+                print("Rung {}: {} candidates on {} training rows ({} trials already run)".format(
+                    rung, len(candidates), train_rows or "all", len(candidates) * n_folds - len(jobs)))
+            for result in (pool.imap_unordered(_run_trial, jobs) if pool is not None else map(_run_trial, jobs)):
+                store.add_trial(name, rung, result)
+            if verbose:
+                print("    took {:.2f} seconds".format(time.time() - start))
+
+            scores = store.rung_scores(name, rung, n_folds, metric)
+            scores = scores[scores["params"].isin(candidates)]
+            if rung < n_rungs - 1:
+                candidates = list(scores["params"][:max(1, int(math.ceil(len(candidates) / float(factor))))])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    best = json.loads(scores["params"].iloc[0])
+    best["n_estimators"] = int(scores["n_estimators"].iloc[0])
+    results = store.results(name)
+    store.close()
+    return (best, results)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Searches for the best GradientBoostingClassifier settings for the income shock model.")
+    parser.add_argument("data", nargs="+", help="Parquet or CSV files of each cohort's data, as written by export_data.py")
+    parser.add_argument("--name", default="search",
+        help="name of the search, under which its trials are stored (rerun with the same name to resume)")
+    parser.add_argument("--candidates", type=int, default=50, help="number of settings to sample (default: 50)")
+    parser.add_argument("--folds", type=int, default=3, help="number of folds (default: 3)")
+    parser.add_argument("--factor", type=int, default=3,
+        help="keep the best 1/factor candidates at each rung (default: 3)")
+    parser.add_argument("--min-rows", type=int,
+        help="training rows to evaluate the candidates on at the first rung (default: all of them, i.e., a randomized search)")
+    parser.add_argument("--metric", choices=sorted(METRICS), default="log_loss")
+    parser.add_argument("--group", action="store_true", help="keep each respondent's rows in the same fold")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+        help="number of trials to run in parallel (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--store", default=SEARCH_DB_PATH,
+        help="SQLite database to record the trials in (default: {})".format(SEARCH_DB_PATH))
+    args = parser.parse_args()
+
+    (X, y, groups) = cross_validation.training_data([export_data.read_export(path) for path in args.data])
+    (best, results) = search(X, y, args.name, n_candidates=args.candidates, n_folds=args.folds,
+        groups=groups if args.group else None, factor=args.factor, min_rows=args.min_rows, metric=args.metric,
+        n_jobs=args.jobs, seed=args.seed, store_path=args.store)
+
+    final_rung = results[results["rung"] == results["rung"].max()]
+    print()
+    print(final_rung.sort_values(args.metric, ascending=METRICS[args.metric] > 0).head(10).to_string(index=False))
+    print("\nBest settings: {}".format(best))
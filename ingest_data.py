@@ -1,30 +1,234 @@
 import os
+import sys
+import time
+import argparse
+import multiprocessing
 import nlsy
+import instrumentation
+
+
+# Each cohort's RNUM, question name, and response files.
+COHORTS = [
+    (1979, os.path.join('data', 'dataset_rnum.NLSY79'), os.path.join('data', 'dataset_qname_with_year.NLSY79'), os.path.join('data', 'NLSY79.csv')),
+    (1997, os.path.join('data', 'dataset_rnum.NLSY97'), os.path.join('data', 'dataset_qname_with_year.NLSY97'), os.path.join('data', 'NLSY97.csv'))
+]
+
+YEAR_PATH = os.path.join('data', 'years.csv')
+REGION_PATH = os.path.join('data', 'regional_data.csv')
+
+
+def ingest_cohort(db_path, cohort_year, rnum_path, qname_path, responses_path, keep_responses=True, chunksize=1000, verbose=True, resume=False, rerun_from=None, base_year=None, keep_nominal_income=False, instrumentation=None, all_columns=False, in_memory=False, staging_dir=None, pragmas=None):
+    """
+    Ingests and wrangles a single cohort into its own staging database (next
+    to `db_path`, or in `staging_dir`), which can then be merged into the main
+    database. If `resume` is set, an existing staging database (e.g., left
+    behind by a failed run) is picked up where it left off. If `in_memory` is
+    set, the cohort is wrangled in memory and the staging database is only
+    written once it's complete. `pragmas` are applied to the staging database,
+    and spans are recorded with `instrumentation`, if given (see
+    nlsy.NLSY_database).
+
+    Returns the staging database's path, the cohort's stage timings, the total
+    time taken, and how many of the response file's columns were skipped (see
+    nlsy.Cohort.column_projection).
+    """
+    start = time.time()
+    staging_path = staging_database_path(db_path, cohort_year, staging_dir)
+    staging = ":memory:" if in_memory else None
+    if resume and os.path.exists(staging_path):
+        staging_db = nlsy.NLSY_database(staging_path, instrumentation=instrumentation, staging=staging, pragmas=pragmas)
+    else:
+        staging_db = nlsy.NLSY_database(staging_path, True, overwrite=True, instrumentation=instrumentation, staging=staging, pragmas=pragmas)
+
+    # The years data is needed to adjust the cohort's income for inflation.
+    staging_db.add_years_data(YEAR_PATH)
+    staging_db.add_region_data(REGION_PATH)
+
+    cohort = find_cohort(staging_db, cohort_year) or staging_db.add_cohort(cohort_year)
+    cohort.add_cohort_data(rnum_path, qname_path, responses_path, verbose=verbose,
+        keep_responses=keep_responses, chunksize=chunksize, rerun_from=rerun_from,
+        base_year=base_year, keep_nominal_income=keep_nominal_income, all_columns=all_columns)
+    if staging_db.staged:
+        staging_db.publish()
+    staging_db.close()
+
+    return (staging_path, cohort.stage_timings, time.time() - start, cohort.column_projection)
+
+
+def staging_database_path(db_path, cohort_year, staging_dir=None):
+    staging_name = "{}.{}.staging".format(os.path.basename(db_path), cohort_year)
+    return os.path.join(staging_dir if staging_dir is not None else os.path.dirname(db_path), staging_name)
+
+
+def parse_pragmas(pragmas):
+    """
+    Parses NAME=VALUE pragma settings (e.g., from --pragma) into a dict.
+    """
+    parsed = {}
+    for pragma in pragmas or []:
+        (name, separator, value) = pragma.partition("=")
+        if not separator or not name.strip() or not value.strip():
+            raise ValueError("Expected a pragma in the form NAME=VALUE, got {}".format(pragma))
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def find_cohort(NLSY_db, cohort_year):
+    for cohort in NLSY_db.cohorts:
+        if str(cohort.cohort_year) == str(cohort_year):
+            return cohort
+    return None
+
+
+def _ingest_cohort(kwargs):
+    return ingest_cohort(**kwargs)
 
 
 if __name__ == '__main__':
 
-    print("Creating NLSY database...")
-    NLSY_db = nlsy.NLSY_database("data.db", True)
-
-    print("Ingesting years data...")
-    year_path = os.path.join('data', 'years.csv')
-    region_path = os.path.join('data', 'regional_data.csv')
-    NLSY_db.add_years_data(year_path)
-    NLSY_db.add_region_data(region_path)
-
-    print("Ingesting and wrangling 1979 cohort data...")
-    cohort_79 = NLSY_db.add_cohort(1979)
-    rnum_path = os.path.join('data', 'dataset_rnum.NLSY79')
-    qname_path = os.path.join('data', 'dataset_qname_with_year.NLSY79')
-    responses_path = os.path.join('data', 'NLSY79.csv')
-    cohort_79.add_cohort_data(rnum_path, qname_path, responses_path)
-
-    print("Ingesting and wrangling 1997 cohort data...")
-    cohort_97 = NLSY_db.add_cohort(1997)
-    rnum_path = os.path.join('data', 'dataset_rnum.NLSY97')
-    qname_path = os.path.join('data', 'dataset_qname_with_year.NLSY97')
-    responses_path = os.path.join('data', 'NLSY97.csv')
-    cohort_97.add_cohort_data(rnum_path, qname_path, responses_path)
+    parser = argparse.ArgumentParser(description="Ingests and wrangles NLSY data and saves it to a SQLite database.")
+    parser.add_argument("--skip-responses", action="store_true",
+        help="don't keep the raw responses tables, only the wrangled tables")
+    parser.add_argument("--chunksize", type=int, default=1000,
+        help="number of respondents to read from the response files at a time")
+    parser.add_argument("--jobs", type=int, default=min(len(COHORTS), multiprocessing.cpu_count()),
+        help="number of cohorts to ingest in parallel (default: one per cohort, up to the number of CPUs)")
+    parser.add_argument("--db", default="data.db",
+        help="path of the database to create (default: data.db)")
+    parser.add_argument("-y", "--yes", action="store_true",
+        help="delete an existing database without asking (for batch jobs)")
+    parser.add_argument("--resume", action="store_true",
+        help="update an existing database rather than starting over, only rerunning the stages that failed, or whose inputs (translate.json, years.csv, etc.) have changed, and those after them")
+    parser.add_argument("--append", nargs=4, action="append", metavar=("COHORT", "RNUM_FILE", "QNAME_FILE", "RESPONSES"),
+        help="add a new survey round to a cohort in an existing database, from an extract with the new round's questions, rather than reingesting the cohort (can be repeated)")
+    parser.add_argument("--rerun-from", choices=nlsy.PIPELINE_STAGES,
+        help="with --resume, rerun this stage and those after it regardless")
+    parser.add_argument("--base-year", type=int,
+        help="adjust income for inflation in terms of this year's dollars (default: the last year in years.csv)")
+    parser.add_argument("--keep-nominal-income", action="store_true",
+        help="keep unadjusted income in a nominal_income column, so income can be re-based on a different year without reingesting")
+    parser.add_argument("--all-columns", action="store_true",
+        help="load every column of the response files, not just those for the questions in translate.json")
+    parser.add_argument("--in-memory", action="store_true",
+        help="build the database (and each cohort's staging database) in memory, and only replace --db once it's complete, so readers never see a half-written database; a cohort that fails is restarted from the beginning by --resume")
+    parser.add_argument("--staging-dir",
+        help="directory for each cohort's staging database, e.g. a tmpfs mount (default: next to --db)")
+    parser.add_argument("--pragma", action="append", metavar="NAME=VALUE",
+        help="SQLite pragma to set on each database connection, e.g. journal_mode=WAL or cache_size=-1048576 (can be repeated)")
+    parser.add_argument("--trace", metavar="LOG",
+        help="append a JSON record of each stage (time, peak memory, rows in and out, SQL statements by type) to this file")
+    parser.add_argument("--profile", nargs="*", choices=nlsy.PIPELINE_STAGES, metavar="STAGE",
+        help="run these stages (or, with no stages listed, all of them) under cProfile, saving the stats to --profile-dir")
+    parser.add_argument("--trace-memory", nargs="*", choices=nlsy.PIPELINE_STAGES, metavar="STAGE",
+        help="trace these stages' (or all stages') memory allocations with tracemalloc, adding them to the --trace log")
+    parser.add_argument("--profile-dir", default="profiles",
+        help="directory to save --profile stats in (default: profiles)")
+    args = parser.parse_args()
+
+    # tracemalloc's results are added to the --trace log, so they're only kept if there is one.
+    sinks = [instrumentation.JSONLinesLog(args.trace)] if args.trace else []
+    tracer = instrumentation.Instrumentation(sinks,
+        profile=args.profile or (args.profile is not None),
+        trace_memory=args.trace_memory or (args.trace_memory is not None),
+        profile_dir=args.profile_dir)
+
+    if args.append and not os.path.exists(args.db):
+        parser.error("--append needs an existing database")
+
+    pragmas = parse_pragmas(args.pragma)
+    staging = ":memory:" if args.in_memory else None
+    if (args.resume or args.append) and os.path.exists(args.db):
+        print("Opening NLSY database...")
+        NLSY_db = nlsy.NLSY_database(args.db, instrumentation=tracer, staging=staging, pragmas=pragmas)
+    else:
+        # Unless told otherwise (e.g., by a batch job), ask before deleting an existing database.
+        if os.path.exists(args.db) and not args.yes:
+            if input("Continuing will delete your existing NLSY database. Continue (y/n)? ") != "y":
+                print("Exiting...")
+                sys.exit()
+        print("Creating NLSY database...")
+        NLSY_db = nlsy.NLSY_database(args.db, True, overwrite=True, instrumentation=tracer,
+            staging=staging, pragmas=pragmas)
+
+    # New survey rounds are appended to their cohorts in place (reloading the
+    # years data, which has to cover them), and nothing else is ingested.
+    for (cohort_year, rnum_path, qname_path, responses_path) in args.append or []:
+        cohort = find_cohort(NLSY_db, cohort_year)
+        if cohort is None:
+            parser.error("{} has no {} cohort to append to".format(args.db, cohort_year))
+        start = time.time()
+        years = cohort.append_survey_round(rnum_path, qname_path, responses_path, YEAR_PATH, REGION_PATH,
+            base_year=args.base_year, chunksize=args.chunksize)
+        print("    appending {} to {} cohort took {:.2f} seconds".format(", ".join(str(year) for year in years),
+            cohort_year, time.time() - start))
+
+    if not args.append:
+        print("Ingesting years data...")
+        NLSY_db.add_years_data(YEAR_PATH)
+        NLSY_db.add_region_data(REGION_PATH)
+
+    # Cohorts that are already in the database are brought up to date in
+    # place. Any others are ingested into their own staging databases (in
+    # parallel, if there's more than one job), and then merged into the main
+    # database.
+    jobs = []
+    for (cohort_year, rnum_path, qname_path, responses_path) in ([] if args.append else COHORTS):
+        cohort = find_cohort(NLSY_db, cohort_year)
+        if cohort is not None:
+            print("Updating {} cohort data...".format(cohort_year))
+            start = time.time()
+            cohort.add_cohort_data(rnum_path, qname_path, responses_path,
+                keep_responses=not args.skip_responses, chunksize=args.chunksize, rerun_from=args.rerun_from,
+                base_year=args.base_year, keep_nominal_income=args.keep_nominal_income, all_columns=args.all_columns)
+            print("    {} cohort took {:.2f} seconds to update".format(cohort_year, time.time() - start))
+            continue
+
+        jobs.append({
+            "db_path": args.db,
+            "cohort_year": cohort_year,
+            "rnum_path": rnum_path,
+            "qname_path": qname_path,
+            "responses_path": responses_path,
+            "keep_responses": not args.skip_responses,
+            "chunksize": args.chunksize,
+            "verbose": args.jobs == 1,
+            "resume": args.resume,
+            "rerun_from": args.rerun_from,
+            "base_year": args.base_year,
+            "keep_nominal_income": args.keep_nominal_income,
+            "instrumentation": tracer,
+            "all_columns": args.all_columns,
+            "in_memory": args.in_memory,
+            "staging_dir": args.staging_dir,
+            "pragmas": pragmas
+        })
+
+    if jobs:
+        print("Ingesting and wrangling {} cohort data ({} at a time)...".format(
+            " and ".join(str(job["cohort_year"]) for job in jobs), args.jobs))
+    if args.jobs > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = pool.map(_ingest_cohort, jobs)
+    else:
+        results = [ingest_cohort(**job) for job in jobs]
+
+    for (job, (staging_path, stage_timings, elapsed, column_projection)) in zip(jobs, results):
+        print("Merging {} cohort data...".format(job["cohort_year"]))
+        start = time.time()
+        NLSY_db.merge_cohort(staging_path, job["cohort_year"])
+        os.remove(staging_path)
+
+        print("    {} cohort took {:.2f} seconds to ingest and {:.2f} seconds to merge".format(
+            job["cohort_year"], elapsed, time.time() - start))
+        for stage, stage_time in stage_timings.items():
+            print("        {} took {:.2f} seconds".format(stage, stage_time))
+        if column_projection:
+            print("        read {columns_read} of {columns} response columns ({columns_skipped} skipped, about {mb_skipped:.1f} MB)".format(
+                mb_skipped = column_projection["bytes_skipped"] / 2 ** 20, **column_projection))
+
+    if NLSY_db.staged:
+        print("Publishing NLSY database to {}...".format(args.db))
+        NLSY_db.publish()
+    NLSY_db.close()
 
     print("Done!")
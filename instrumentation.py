@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import pandas as pd
+
+
+def peak_memory():
+    """
+    Returns the process's peak resident memory in bytes, since the last
+    reset_peak_memory() where that's supported (on Linux).
+    """
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname()[0] == "Darwin" else peak * 1024
+
+
+def reset_peak_memory():
+    """
+    Resets the process's peak resident memory to its current memory, so the
+    peak of a single step can be measured. Does nothing where that's not
+    supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except IOError:
+        pass
+
+
+class MemoryCollector(object):
+    """
+    Keeps every span's record in memory, e.g., for inspecting a run from a
+    notebook.
+    """
+
+    def __init__(self):
+        self._records = []
+
+    @property
+    def records(self):
+        return self._records
+
+    def emit(self, record):
+        self._records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self._records)
+
+    def clear(self):
+        del self._records[:]
+
+
+class JSONLinesLog(object):
+    """
+    Appends every span's record to a file as a line of JSON. The file is
+    opened for each record, so several processes (e.g., parallel cohort
+    ingests) can share a log.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def emit(self, record):
+        with open(self._path, "a") as log_file:
+            log_file.write(json.dumps(record, default=str) + "\n")
+
+
+class Span(object):
+    """
+    A timed step, such as a pipeline stage. Any attributes set on it (e.g.,
+    row counts) are included in its record.
+    """
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.statements = {}
+        self.start = time.time()
+        self.seconds = None
+        self.peak_memory = 0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record(self):
+        record = {"span": self.name, "parent": self.parent, "start": self.start, "seconds": self.seconds,
+            "peak_memory": self.peak_memory}
+        if self.statements:
+            record["statements"] = dict(self.statements)
+        record.update(self.attributes)
+        return record
+
+
+class Instrumentation(object):
+    """
+    Times spans (each pipeline stage, and the steps around them), recording
+    their peak memory and, if there are any sinks to emit records to (such as
+    a MemoryCollector or JSONLinesLog), the number of SQL statements of each
+    class (SELECT, INSERT, UPDATE, etc.) run on the watched connections
+    during the span, and any attributes like row counts.
+
+    Spans that are marked as profilable (the pipeline stages) can also be run
+    under cProfile, with the stats saved to `profile_dir`, or tracemalloc,
+    with the peak traced memory and the lines whose allocations are still
+    held at the end of the span added to the record. `profile` and
+    `trace_memory` are either True, for every profilable span, or a list of
+    span names.
+
+    Each thread has its own stack of spans, so spans in concurrent threads
+    (e.g., readers of a read-only database) nest independently. Peak memory
+    is the whole process's, though.
+    """
+
+    def __init__(self, sinks=(), profile=None, trace_memory=None, profile_dir="profiles"):
+        self._sinks = list(sinks)
+        self._profile = profile
+        self._trace_memory = trace_memory
+        self._profile_dir = profile_dir
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # An Instrumentation is passed to the workers of a parallel ingest,
+        # each of which starts with no open spans.
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def sinks(self):
+        return self._sinks
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def enabled(self):
+        """
+        Whether anything's listening. Measurements that cost more than a
+        timer (like counting rows) are only taken if so.
+        """
+        return bool(self._sinks)
+
+    def watch(self, conn):
+        """
+        Counts the statements run on a SQLite connection towards the current
+        span.
+        """
+        if self.enabled:
+            conn.set_trace_callback(self._count_statement)
+
+    def _count_statement(self, statement):
+        if self._stack:
+            words = statement.split(None, 1)
+            statement_class = words[0].upper() if words else ""
+            statements = self._stack[-1].statements
+            statements[statement_class] = statements.get(statement_class, 0) + 1
+
+    def _selected(self, option, name):
+        return option is True or (option and name in option)
+
+    @contextlib.contextmanager
+    def span(self, name, profilable=False, **attributes):
+        parent = self._stack[-1] if self._stack else None
+        span = Span(name, parent.name if parent is not None else None, attributes)
+
+        # The peak memory is reset for each span, so a parent's peak so far is
+        # saved first.
+        if parent is not None:
+            parent.peak_memory = max(parent.peak_memory, peak_memory())
+        reset_peak_memory()
+
+        profiler = None
+        if profilable and self._selected(self._profile, name):
+            import cProfile
+            profiler = cProfile.Profile()
+
+        tracing = False
+        if profilable and self._selected(self._trace_memory, name):
+            import tracemalloc
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+
+        self._stack.append(span)
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield span
+        except BaseException as error:
+            span.set(error=repr(error))
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            span.seconds = time.time() - span.start
+            span.peak_memory = max(span.peak_memory, peak_memory())
+            self._stack.pop()
+
+            # A parent's statements and peak memory include its children's.
+            if parent is not None:
+                parent.peak_memory = max(parent.peak_memory, span.peak_memory)
+                for (statement_class, count) in span.statements.items():
+                    parent.statements[statement_class] = parent.statements.get(statement_class, 0) + count
+
+            label = "_".join(str(part) for part in (attributes.get("cohort"), name) if part is not None)
+            if profiler is not None:
+                if not os.path.isdir(self._profile_dir):
+                    os.makedirs(self._profile_dir)
+                profile_path = os.path.join(self._profile_dir, "{}.prof".format(label))
+                profiler.dump_stats(profile_path)
+                span.set(profile=profile_path)
+
+            if tracing:
+                (current, traced_peak) = tracemalloc.get_traced_memory()
+                top_allocations = tracemalloc.take_snapshot().statistics("lineno")[:10]
+                tracemalloc.stop()
+                span.set(traced_peak_memory=traced_peak, retained_allocations=[{"location": "{}:{}".format(
+                    statistic.traceback[0].filename, statistic.traceback[0].lineno), "bytes": statistic.size}
+                    for statistic in top_allocations])
+
+            for sink in self._sinks:
+                sink.emit(span.record())
@@ -1,58 +1,277 @@
 import os
 import sqlite3
-import csv
 import json
+import hashlib
+import pathlib
+import tempfile
+import threading
+import contextlib
+import numpy as np
 import pandas as pd
-import pdb
 
-class NLSY_database(object):
+import codebook
+import feature_cache
+import reference_data
+from instrumentation import Instrumentation
+
+# Older SQLite builds cap the number of parameters bound to a single statement at 999.
+SQLITE_MAX_VARIABLES = 999
+
+
+def _insert_rows(cursor, table, columns, rows):
+    """
+    Inserts a 2-D array of rows into a table using multi-row INSERT statements,
+    which avoids paying SQLite's per-statement overhead for every row.
+    """
+    batch_size = SQLITE_MAX_VARIABLES // len(columns)
+    row_placeholder = "({})".format(", ".join(["?"] * len(columns)))
+    sql_query = "INSERT INTO {} ({}) VALUES ".format(table, ", ".join(columns))
+
+    batch_query = sql_query + ", ".join([row_placeholder] * batch_size)
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if len(batch) < batch_size:
+            batch_query = sql_query + ", ".join([row_placeholder] * len(batch))
+        cursor.execute(batch_query, np.asarray(batch).ravel().tolist())
+
+
+def _survey_years(questions):
+    """
+    Returns the survey year of each of a DataFrame of questions (with
+    question_name and year columns, as in the RNUMs table) as integers.
+    """
+    # The 1997 cohort data uses "XRND" as the year for constructed variables,
+    # whose year is given by the last two digits of the question name (e.g.,
+    # "97" or "98" for the 1990s, "05" for 2005).
+    constructed = questions["year"] == "XRND"
+    last_two_digits = questions["question_name"].str[-2:]
+    century = last_two_digits.str[0].map({"9": "19"}).fillna("20")
+    return questions["year"].where(~constructed, century + last_two_digits).astype(int)
+
+
+# The stages of a cohort's ingest, in the order they're run. Each completed
+# stage is checkpointed, so an interrupted ingest can pick up where it left off.
+PIPELINE_STAGES = ["load_responses", "wrangle_respondents", "wrangle_survey", "translate_respondents",
+    "translate_survey", "translate_employer", "adjust_for_inflation", "label_shocks"]
+
+# Stages that rebuild their tables from scratch, and so can safely be rerun.
+# The others update the wrangled tables in place, so rerunning one of them
+# means rebuilding the wrangled tables first.
+REPEATABLE_STAGES = ["load_responses", "wrangle_respondents", "wrangle_survey", "label_shocks"]
+
+# Categorical variables in the cohort data, which are expanded into dummy
+# variables (e.g., "race_1", "race_2") alongside the original column.
+CATEGORICAL_VARIABLES = ["region", "highest_grade", "industry", "occupation", "marital_status", "race"]
+
+
+def dummy_columns(df, categorical_variables=CATEGORICAL_VARIABLES):
+    """
+    Returns the names of the dummy variables in a DataFrame of cohort data.
+    """
+    prefixes = tuple("{}_".format(variable) for variable in categorical_variables)
+    return [col for col in df.columns if str(col).startswith(prefixes) and col not in categorical_variables]
+
+
+def memory_footprint(df):
+    """
+    Returns the number of bytes taken up by a DataFrame, including its index.
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def compact_frame(df, sparse_dummies=False, categorical_variables=CATEGORICAL_VARIABLES):
+    """
+    Returns a copy of a DataFrame of cohort data that uses as little memory as
+    possible without changing any of its values: integer columns are
+    downcast to the smallest type that fits, the original categorical
+    variables become pandas categoricals, and dummy variables are stored as
+    uint8 (or, if `sparse_dummies` is True, sparsely).
+    """
+    dummies = set(dummy_columns(df, categorical_variables))
+    compact = {}
+    for col in df.columns:
+        values = df[col]
+        if col in dummies:
+            values = values.astype("uint8")
+            if sparse_dummies:
+                values = values.astype(pd.SparseDtype("uint8", 0))
+        elif col in categorical_variables:
+            values = values.astype("category")
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            values = pd.to_numeric(values, downcast="integer")
+        compact[col] = values
+
+    return pd.DataFrame(compact, index=df.index, columns=df.columns)
+
+
+def dummy_matrix(df, categorical_variables=CATEGORICAL_VARIABLES):
+    """
+    Returns a DataFrame's dummy variables as a scipy.sparse CSR matrix, along
+    with the names of its columns.
+    """
+    import scipy.sparse
+
+    columns = dummy_columns(df, categorical_variables)
+    matrix = scipy.sparse.hstack([scipy.sparse.csr_matrix(np.asarray(df[col], dtype="uint8").reshape(-1, 1)) for col in columns], format="csr")
+    return (matrix, columns)
+
 
-    def __init__(self, path, initialize = False, db_structure="db_structure.json"):
+class NLSY_database(object):
+    """
+    A SQLite database of NLSY cohorts.
+
+    If `initialize` is set, a new database is created at `path`. An existing
+    one is only replaced if `overwrite` is True; otherwise a ValueError is
+    raised, so it's up to the caller (e.g., ingest_data.py) to ask first.
+
+    `pragmas` (e.g., {"journal_mode": "WAL", "synchronous": "NORMAL"}) are
+    applied to the connection when it's opened, and take precedence over the
+    ones bulk_load() sets.
+
+    If `staging` is given, the database is built somewhere other than `path`
+    -- in memory (":memory:"), or in a temporary file in a directory such as
+    a tmpfs mount -- and only written to `path` when it's published (see
+    publish()). An existing database at `path` is copied into the staging
+    database first, unless `initialize` is set, and is left as it is, for any
+    readers, until then.
+
+    If `read_only` is set, the database is opened for reading only, and can be
+    queried from several threads (or forked workers) at once: each one gets
+    its own read-only connection (see conn), so their queries, including
+    Cohort.data(), run concurrently rather than one at a time. With
+    `shared_cache`, the threads' connections share a single page cache, which
+    saves memory at the cost of some concurrency. A database that's written in
+    place while it's being read (rather than staged and published) should be
+    opened by the writer with pragmas={"journal_mode": "WAL"}, so readers
+    aren't blocked while it commits.
+    """
+
+    def __init__(self, path, initialize = False, db_structure="db_structure.json", overwrite=None, instrumentation=None, staging=None, pragmas=None, read_only=False, shared_cache=False):
 
         self._cohorts = []
+        self._path = path
+        self._staging = staging
+        self._staging_path = None
+        self._pragmas = dict(pragmas or {})
+        self._read_only = read_only
+        self._shared_cache = shared_cache
+        if read_only and (initialize or staging is not None):
+            raise ValueError("A read-only database can't be initialized or staged")
+        if read_only and not os.path.exists(path):
+            raise ValueError("{} doesn't exist".format(path))
+
+        # Read-only connections are opened by each thread as it needs one, and
+        # kept (as (connection, generation), by thread) until the thread
+        # finishes, or the database is closed or refreshed.
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._generation = 0
+        self._pid = os.getpid()
+
+        # Each pipeline stage (and the steps around them) is timed in a span;
+        # see instrumentation.Instrumentation for collecting more detail.
+        self._instrumentation = instrumentation if instrumentation is not None else Instrumentation()
 
         if initialize:
             if os.path.exists(path):
-                overwrite = input("Continuing will delete your existing NLSY database. Continue (y/n)? ")
-                if overwrite == "y":
+                if not overwrite:
+                    raise ValueError("{} already exists; pass overwrite=True to replace it".format(path))
+
+                # A staged database replaces the existing one when it's
+                # published, so it's left alone until then.
+                if staging is None:
                     os.remove(path)
-                    self._conn = sqlite3.connect(path)
-                else:
-                    print("Exiting...")
-                    exit()
-            else:
-                self._conn = sqlite3.connect(path)
+            self._conn = self._connect()
         else:
-            self._conn = sqlite3.connect(path)
-            cursor = self._conn.cursor()
-
-            # Check to see if years data exists in the database...
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'years'")
-            row = cursor.fetchone()
-            if row:
-                self._years_table = "years"
-            else:
-                self._years_table = False
-
-            # Check to see if region data exists in the database...
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'region_data'")
-            row = cursor.fetchone()
-            if row:
-                self._region_table = "region_data"
-            else:
-                self._region_table = False
+            self._conn = self._connect()
+            if staging is not None and os.path.exists(path):
+                source = sqlite3.connect(path)
+                source.backup(self._conn)
+                source.close()
+            self._find_tables()
 
-            # Check to see if cohort data has already been imported...
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'questions_%'")
-            rows = cursor.fetchall()
-            for row in rows:
-                cohort_year = row[0][-4:]
-                self.add_cohort(cohort_year, False)
+        if not read_only:
+            self._configure(self._conn)
 
         # This JSON file lays out the standard structure for each cohort's data, ensuring that
         # parallel data is collected on each of them.
-        with open(db_structure) as json_file:
-            self._db_structure = json.load(json_file)
+        self._db_structure = reference_data.registry.json_file(db_structure)
+
+    def _find_tables(self):
+        """
+        Finds the years and region tables and the cohorts in an existing
+        database.
+        """
+        cursor = self.conn.cursor()
+
+        # Check to see if years data exists in the database...
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'years'")
+        row = cursor.fetchone()
+        if row:
+            self._years_table = "years"
+        else:
+            self._years_table = False
+
+        # Check to see if region data exists in the database...
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'region_data'")
+        row = cursor.fetchone()
+        if row:
+            self._region_table = "region_data"
+        else:
+            self._region_table = False
+
+        # Check to see if cohort data has already been imported... (The list
+        # is replaced, rather than added to, as other threads may be reading
+        # it when a read-only database is refreshed.)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'questions_%'")
+        rows = cursor.fetchall()
+        self._cohorts = [Cohort(self, row[0][-4:], False) for row in rows]
+        cursor.close()
+
+    def _configure(self, conn):
+        for pragma, value in self._pragmas.items():
+            conn.execute("PRAGMA {} = {}".format(pragma, value))
+        self._instrumentation.watch(conn)
+
+    def _connect(self):
+        if self._read_only:
+            return self._thread_connection()
+        if self._staging is None:
+            return sqlite3.connect(self._path)
+        if self._staging == ":memory:":
+            return sqlite3.connect(":memory:")
+
+        (staging_file, self._staging_path) = tempfile.mkstemp(suffix=".db", dir=self._staging)
+        os.close(staging_file)
+        return sqlite3.connect(self._staging_path)
+
+    def _thread_connection(self):
+        """
+        Returns the calling thread's read-only connection, opening it if the
+        thread doesn't have one yet (or the database has been refreshed since).
+        """
+        # Connections can't be carried across a fork, so a forked worker
+        # opens its own.
+        if os.getpid() != self._pid:
+            self._lock = threading.Lock()
+            self._connections = {}
+            self._pid = os.getpid()
+
+        thread = threading.current_thread()
+        (conn, generation) = self._connections.get(thread, (None, None))
+        if conn is not None and generation == self._generation:
+            return conn
+
+        uri = "{}?mode=ro{}".format(pathlib.Path(self._path).resolve().as_uri(), "&cache=shared" if self._shared_cache else "")
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self._configure(conn)
+        with self._lock:
+            # The connections of threads that have finished (and this
+            # thread's, if the database's been refreshed) are closed.
+            for finished in [other for other in self._connections if other is thread or not other.is_alive()]:
+                self._connections.pop(finished)[0].close()
+            self._connections[thread] = (conn, self._generation)
+        return conn
 
     @property
     def cohorts(self):
@@ -60,12 +279,34 @@ class NLSY_database(object):
 
     @property
     def conn(self):
+        """
+        The database connection. For a read-only database, this is the
+        calling thread's own connection.
+        """
+        if self._read_only:
+            return self._thread_connection()
         return self._conn
 
+    @property
+    def read_only(self):
+        return self._read_only
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def staged(self):
+        return self._staging is not None
+
     @property
     def db_structure(self):
         return self._db_structure
 
+    @property
+    def instrumentation(self):
+        return self._instrumentation
+
     @property
     def years_table(self):
         return self._years_table
@@ -74,11 +315,142 @@ class NLSY_database(object):
     def region_table(self):
         return self._region_table
 
+    def query(self, sql_query, parameters=()):
+        """
+        Runs a query on the database (on the calling thread's connection, if
+        it's read-only), returning the results as a DataFrame.
+        """
+        return pd.read_sql(sql_query, self.conn, params=parameters)
+
+    def refresh(self):
+        """
+        Picks up a new version of a read-only database that's been published
+        (see publish()) since it was opened: each thread reopens the database
+        the next time it queries it, and the cohorts are found again. Queries
+        that are already running finish against the old version.
+        """
+        if not self._read_only:
+            raise ValueError("Only a read-only database can be refreshed")
+        with self._lock:
+            self._generation += 1
+        self._find_tables()
+
     def add_cohort(self, cohort_year, initialize=True):
         new_cohort = Cohort(self, cohort_year, initialize)
         self._cohorts.append(new_cohort)
         return new_cohort
 
+    def merge_cohort(self, staging_path, cohort_year):
+        """
+        Copies a cohort's tables (and their indexes) from a staging database,
+        such as one built by a separate ingest process, into this database and
+        adds the cohort.
+        """
+        with self._instrumentation.span("merge_cohort", cohort=cohort_year), self.bulk_load():
+            cursor = self.conn.cursor()
+            cursor.execute("ATTACH DATABASE ? AS staging", (staging_path, ))
+
+            # The cohort is copied in a single transaction, so it's merged either completely or not at all.
+            try:
+                cursor.execute("BEGIN")
+                cursor.execute("""SELECT type, name, sql FROM staging.sqlite_master
+                    WHERE type IN ('table', 'index') AND tbl_name GLOB ? AND sql IS NOT NULL
+                    ORDER BY type DESC""", ("*_{}".format(cohort_year), ))
+                for (object_type, name, sql) in cursor.fetchall():
+                    cursor.execute(sql)
+                    if object_type == "table":
+                        cursor.execute("INSERT INTO main.{table} SELECT * FROM staging.{table}".format(table = name))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            finally:
+                cursor.execute("DETACH DATABASE staging")
+                cursor.close()
+
+        return self.add_cohort(cohort_year, False)
+
+    @contextlib.contextmanager
+    def bulk_load(self, cache_size=-262144):
+        """
+        Relaxes SQLite's durability settings for the duration of a bulk load:
+        no fsync on commit, temporary tables and indexes in memory, and a larger
+        page cache (`cache_size` follows SQLite's convention, so negative values
+        are in KiB). Settings that were given as pragmas when the database was
+        opened are left alone. The previous settings are restored afterwards.
+        Whatever's been written is committed at the end, unless an exception
+        was raised, in which case it's rolled back.
+        """
+        settings = {"synchronous": "OFF", "temp_store": "MEMORY", "cache_size": int(cache_size)}
+        settings = dict((pragma, value) for (pragma, value) in settings.items() if pragma not in self._pragmas)
+
+        cursor = self.conn.cursor()
+        previous = {}
+        for pragma in settings:
+            cursor.execute("PRAGMA {}".format(pragma))
+            previous[pragma] = cursor.fetchone()[0]
+
+        for pragma, value in settings.items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+        try:
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            for pragma, value in previous.items():
+                cursor.execute("PRAGMA {} = {}".format(pragma, value))
+            cursor.close()
+
+    def publish(self):
+        """
+        Writes a staged database to its path, replacing whatever's there in a
+        single rename, so readers see either the old database or the new one,
+        and never a half-written one. Readers that already have the old
+        database open keep reading it until they reopen it. The published
+        database uses SQLite's default (rollback) journal, since a WAL file
+        left beside the old database would otherwise be taken for the new
+        one's. It can be published again after further changes.
+        """
+        if self._staging is None:
+            raise ValueError("{} isn't staged, so there's nothing to publish".format(self._path))
+
+        partial_path = "{}.partial".format(self._path)
+        with self._instrumentation.span("publish"):
+            self._conn.commit()
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+            # VACUUM INTO (SQLite 3.27+) writes a compacted copy; otherwise,
+            # the backup API copies the database page by page.
+            if sqlite3.sqlite_version_info >= (3, 27, 0):
+                self._conn.execute("VACUUM INTO ?", (partial_path, ))
+            else:
+                target = sqlite3.connect(partial_path)
+                self._conn.backup(target)
+                target.close()
+
+            with open(partial_path, "rb+") as partial_file:
+                os.fsync(partial_file.fileno())
+            os.replace(partial_path, self._path)
+
+    def close(self):
+        """
+        Closes the connection (or, for a read-only database, every thread's
+        connection), discarding a staged database that hasn't been published.
+        """
+        if self._read_only:
+            with self._lock:
+                for (conn, generation) in self._connections.values():
+                    conn.close()
+                self._connections = {}
+            return
+        self._conn.close()
+        if self._staging_path is not None and os.path.exists(self._staging_path):
+            os.remove(self._staging_path)
+
     def add_years_data(self, year_path):
             """
             Creates the years table and stores all year-specific data in it.
@@ -93,13 +465,13 @@ class NLSY_database(object):
                 inflation REAL NOT NULL
             )""")
 
-            with open(year_path) as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=',')
-                for row in csv_reader:
-                    cursor.execute("""INSERT INTO
-                        years (year, unemployment, gdp_growth, inflation)
-                        VALUES (?, ?, ?, ?)
-                        """, (row["year"], row["unemployment"],  row["gdp_growth"], row["inflation"]))
+            # Reloading the years data replaces what's already there.
+            cursor.execute("DELETE FROM years")
+
+            cursor.executemany("""INSERT INTO
+                years (year, unemployment, gdp_growth, inflation)
+                VALUES (?, ?, ?, ?)
+                """, reference_data.registry.csv_rows(year_path, ["year", "unemployment", "gdp_growth", "inflation"]))
 
             self._years_table = "years"
 
@@ -112,21 +484,20 @@ class NLSY_database(object):
             """
             cursor = self.conn.cursor()
 
-            # The region table contains year-specific regional data.
+            # The region table contains year-specific regional data, clustered
+            # on region and year (which is how it's looked up).
             cursor.execute("""CREATE TABLE IF NOT EXISTS region_data (
                 year INTEGER NOT NULL,
                 region INTEGER NOT NULL,
-                regional_unemployment REAL NOT NULL
-            )""")
+                regional_unemployment REAL NOT NULL,
+                PRIMARY KEY (region, year)
+            ) WITHOUT ROWID""")
+            cursor.execute("DELETE FROM region_data")
 
-            with open(region_path) as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=',')
-                for row in csv_reader:
-                    #pdb.set_trace()
-                    cursor.execute("""INSERT INTO
-                        region_data (year, region, regional_unemployment)
-                        VALUES (?, ?, ?)
-                        """, (row["year"], row["region"], row["regional_unemployment"]))
+            cursor.executemany("""INSERT INTO
+                region_data (year, region, regional_unemployment)
+                VALUES (?, ?, ?)
+                """, reference_data.registry.csv_rows(region_path, ["year", "region", "regional_unemployment"]))
 
             self._region_table = "region_data"
 
@@ -144,9 +515,40 @@ class Cohort(object):
         self._responses_table = "responses_{}".format(cohort_year)
         self._wrangled_respondents_table = "wrangled_respondents_{}".format(self._cohort_year)
         self._wrangled_data_table = "wrangled_data_{}".format(self._cohort_year)
-
-        with open(dictionary) as json_file:
-            self._dictionary = json.load(json_file)
+        self._checkpoints_table = "checkpoints_{}".format(self._cohort_year)
+        self._settings_table = "settings_{}".format(self._cohort_year)
+
+        # Secondary indexes on each table, as (name, columns, unique). These
+        # are dropped before each table is bulk-loaded and rebuilt afterwards.
+        self._indexes = {
+            self._rnums_table: [("{}_question_name".format(self._rnums_table), ["question_name"], False)],
+            self._responses_table: [("{}_rnum".format(self._responses_table), ["rnum"], False)],
+            self._wrangled_data_table: [
+                ("{}_case_id_year".format(self._wrangled_data_table), ["case_id", "year"], True),
+                ("{}_year".format(self._wrangled_data_table), ["year"], False)
+            ]
+        }
+
+        # The codebook is shared by every cohort, and read-only.
+        self._dictionary_path = dictionary
+        self._dictionary = reference_data.registry.json_file(dictionary)
+
+        # The table each pipeline stage reads from and writes to, for counting
+        # their rows.
+        self._stage_tables = {
+            "load_responses": (None, self._responses_table),
+            "wrangle_respondents": (self._responses_table, self._wrangled_respondents_table),
+            "wrangle_survey": (self._responses_table, self._wrangled_data_table),
+            "translate_respondents": (self._wrangled_respondents_table, self._wrangled_respondents_table),
+            "translate_survey": (self._wrangled_data_table, self._wrangled_data_table),
+            "translate_employer": (self._wrangled_data_table, self._wrangled_data_table),
+            "adjust_for_inflation": (self._wrangled_data_table, self._wrangled_data_table),
+            "label_shocks": (self._wrangled_data_table, self._wrangled_data_table)
+        }
+
+        self._stage_timings = {}
+        self._stage_memory = {}
+        self._column_projection = {}
 
         if initialize:
             self._create_data_tables()
@@ -155,6 +557,39 @@ class Cohort(object):
     def cohort_year(self):
         return self._cohort_year
 
+    @property
+    def NLSY_db(self):
+        return self._NLSY_db
+
+    @property
+    def dictionary(self):
+        return self._dictionary
+
+    @property
+    def wrangled_respondents_table(self):
+        return self._wrangled_respondents_table
+
+    @property
+    def wrangled_data_table(self):
+        return self._wrangled_data_table
+
+    @property
+    def stage_timings(self):
+        return self._stage_timings
+
+    @property
+    def stage_memory(self):
+        return self._stage_memory
+
+    @property
+    def column_projection(self):
+        """
+        How many of the response file's columns were read and skipped by the
+        last load, and about how many bytes were skipped (see
+        add_cohort_data()).
+        """
+        return self._column_projection
+
     def _create_data_tables(self):
         """
         Creates the individual RNUMs, responses, and questions tables. (Because RNUMs, which
@@ -168,14 +603,14 @@ class Cohort(object):
         cursor.execute("""CREATE TABLE {} (
             question_name TEXT PRIMARY KEY,
             description TEXT
-        )""".format(self._questions_table))
+        ) WITHOUT ROWID""".format(self._questions_table))
 
         # The RNUMs table associates NLSY-provided unique RNUMs with a specific question.
         cursor.execute("""CREATE TABLE {} (
             rnum TEXT PRIMARY KEY,
             question_name TEXT NOT NULL,
             year INTEGER NOT NULL
-        )""".format(self._rnums_table))
+        ) WITHOUT ROWID""".format(self._rnums_table))
 
         # The responses table contains all of the individual responses to each RNUM.
         cursor.execute("""CREATE TABLE {} (
@@ -201,68 +636,502 @@ class Cohort(object):
             sql_query = "{}, {} INTEGER".format(sql_query, field)
         cursor.execute("{})".format(sql_query))
 
+        self._create_checkpoints_table(cursor)
+        self._create_settings_table(cursor)
+
         self._NLSY_db.conn.commit()
         cursor.close()
 
-    def add_cohort_data(self, rnum_path, qname_path, responses_path, verbose=True):
+    def _drop_indexes(self, cursor, table, schema="main"):
+        for (name, columns, unique) in self._indexes[table]:
+            cursor.execute("DROP INDEX IF EXISTS {schema}.{name}".format(schema = schema, name = name))
+
+    def _create_indexes(self, cursor, table, schema="main"):
+        """
+        Builds a table's secondary indexes. It's much faster to build them
+        once the table is loaded than to keep them up to date while loading.
+        """
+        for (name, columns, unique) in self._indexes[table]:
+            cursor.execute("CREATE {unique}INDEX IF NOT EXISTS {schema}.{name} ON {table} ({columns})".format(
+                unique = "UNIQUE " if unique else "",
+                schema = schema,
+                name = name,
+                table = table,
+                columns = ", ".join(columns)
+                )
+            )
+
+    def _create_checkpoints_table(self, cursor):
+        """
+        Creates the checkpoints table, which records each completed stage of
+        the cohort's ingest, along with a hash of the inputs it was run with.
+        """
+        cursor.execute("""CREATE TABLE IF NOT EXISTS {} (
+            stage TEXT PRIMARY KEY,
+            inputs TEXT NOT NULL,
+            completed TEXT NOT NULL,
+            seconds REAL
+        )""".format(self._checkpoints_table))
+
+    def _create_settings_table(self, cursor):
+        """
+        Creates the settings table, which records how the cohort's data was
+        wrangled (e.g., the base year its income was adjusted to), so later
+        rounds can be wrangled the same way.
+        """
+        cursor.execute("""CREATE TABLE IF NOT EXISTS {} (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID""".format(self._settings_table))
+
+    def _setting(self, name):
         """
-        Ingests all of the RNUM, question, and response data for a given cohort.
+        Returns one of the cohort's settings, or None if it hasn't been
+        recorded (as in databases ingested before there were settings).
         """
         cursor = self._NLSY_db.conn.cursor()
+        self._create_settings_table(cursor)
+        cursor.execute("SELECT value FROM {} WHERE name = ?".format(self._settings_table), (name, ))
+        row = cursor.fetchone()
+        cursor.close()
+        return json.loads(row[0]) if row else None
 
-        # The RNUMs and associated question names are stored on equivalent line numbers in two different files.
+    def _set_setting(self, cursor, name, value):
+        self._create_settings_table(cursor)
+        cursor.execute("INSERT OR REPLACE INTO {} (name, value) VALUES (?, ?)".format(self._settings_table),
+            (name, json.dumps(value)))
+
+    def add_cohort_data(self, rnum_path, qname_path, responses_path, verbose=True, keep_responses=True, chunksize=1000, rerun_from=None, base_year=None, keep_nominal_income=False, all_columns=False):
+        """
+        Ingests all of the RNUM, question, and response data for a given cohort,
+        and wrangles it into shape.
+
+        The response file is read in chunks of `chunksize` respondents and
+        bulk-loaded into the responses table. If `keep_responses` is False, the
+        responses are only staged in a temporary table for the duration of the
+        ingest, and only the wrangled tables are written to the database.
+        Only the columns for the questions named in translate.json (and the
+        case ID) are read, unless `all_columns` is set; see column_projection
+        for how many were skipped.
+
+        Each stage (see PIPELINE_STAGES) is checkpointed as it completes, so
+        calling this again on the same cohort only runs the stages that haven't
+        completed, or whose inputs (the data files, translate.json, the
+        crosswalks, or the years data) have changed since, and every stage
+        after them. Pass `rerun_from` to force a stage and those after it to
+        be rerun.
+
+        Income is adjusted for inflation in terms of `base_year` dollars (see
+        adjust_for_inflation()).
+        """
+        stages = self._pipeline(rnum_path, qname_path, responses_path, keep_responses, chunksize, verbose, base_year, keep_nominal_income, all_columns)
+        messages = {
+            "load_responses": "Ingesting {} survey data...",
+            "wrangle_respondents": "Restructuring {} data into longitudinal form...",
+            "translate_respondents": "Updating {} data to match codebook...",
+            "label_shocks": "Labeling income shocks for {} cohort..."
+        }
+
+        with self._NLSY_db.instrumentation.span("ingest", cohort=self._cohort_year), self._NLSY_db.bulk_load():
+            first_stage = self._first_stage(stages, rerun_from)
+            if verbose and first_stage > 0:
+                print("{} cohort: skipping completed stages ({})".format(self._cohort_year,
+                    ", ".join(name for (name, stage, inputs) in stages[:first_stage])))
+
+            cursor = self._NLSY_db.conn.cursor()
+            cursor.execute("DELETE FROM {checkpoints} WHERE stage IN ({stages})".format(
+                checkpoints = self._checkpoints_table,
+                stages = ", ".join("?" * len(stages[first_stage:]))
+                ), [name for (name, stage, inputs) in stages[first_stage:]])
+            self._NLSY_db.conn.commit()
+            cursor.close()
+
+            # Loading the responses, then separating them out by year,
+            # normalizing survey codes to match our codebook, adjusting for
+            # inflation, and labeling income shocks.
+            for (name, stage, inputs) in stages[first_stage:]:
+                if verbose and name in messages:
+                    print(messages[name].format(self._cohort_year))
+                self._run_stage(name, stage, inputs, verbose)
+
+            if not keep_responses:
+                self._NLSY_db.conn.execute("DROP TABLE IF EXISTS temp.{}".format(self._responses_table))
+
+    def append_survey_round(self, rnum_path, qname_path, responses_path, year_path=None, region_path=None, base_year=None, chunksize=1000, verbose=True):
+        """
+        Adds a new survey round to a cohort that's already been ingested,
+        without reingesting the rounds before it. The RNUM, question name, and
+        response files are an extract with the new round's questions (and the
+        case ID); only the RNUMs of questions in translate.json whose year the
+        cohort doesn't have data for yet are loaded. Only those years' rows are
+        wrangled, translated, and adjusted for inflation before being added to
+        the wrangled data, and only the shock labels they affect are
+        recomputed (see label_shocks()).
+
+        If `year_path` or `region_path` are given, the years and region data
+        are reloaded from them first; the years data has to cover the new
+        round. Income is adjusted to the same base year as the rest of the
+        cohort's, unless `base_year` is given.
+
+        The new responses are added to the responses table if the cohort's
+        responses were kept, so that rebuilding the cohort (e.g., when
+        add_cohort_data() is called after translate.json changes) includes the
+        new round; otherwise, rebuilding the cohort from its original extract
+        drops it. Returns the years that were added.
+        """
+        conn = self._NLSY_db.conn
+        cohort_year = str(self._cohort_year)
+        question_names = self._dictionary["dynamic_question_names"][cohort_year]
+
+        with self._NLSY_db.instrumentation.span("append_survey_round", cohort=self._cohort_year) as span, self._NLSY_db.bulk_load():
+            # The base year has to be worked out before the years data is
+            # reloaded, as by default it's the last year in the years table.
+            if base_year is None:
+                base_year = self._setting("base_year")
+            if base_year is None:
+                base_year = max(self.deflators())
+            if year_path is not None:
+                self._NLSY_db.add_years_data(year_path)
+            if region_path is not None:
+                self._NLSY_db.add_region_data(region_path)
+            deflators = self.deflators(base_year)
+
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT year FROM {}".format(self._wrangled_data_table))
+            loaded_years = set(row[0] for row in cursor.fetchall())
+
+            rnums = pd.DataFrame(self._read_rnums(rnum_path, qname_path), columns=["rnum", "question_name", "year"])
+            rnums = rnums[rnums["question_name"].isin(list(question_names))]
+            rnums = rnums[~_survey_years(rnums).isin(loaded_years)]
+            years = sorted(set(_survey_years(rnums).tolist()))
+            if not years:
+                raise ValueError("{} has no survey rounds that the {} cohort doesn't already have".format(responses_path, self._cohort_year))
+            missing_years = [year for year in years if year not in deflators]
+            if missing_years:
+                raise ValueError("No inflation data for {}".format(", ".join(str(year) for year in missing_years)))
+            if verbose:
+                print("Appending {} to {} cohort ({} RNUMs)...".format(", ".join(str(year) for year in years), self._cohort_year, len(rnums)))
+
+            # Nothing's added to the wrangled data until the end, so if this
+            # fails partway through, it can simply be run again.
+            rnums = list(rnums.itertuples(index=False, name=None))
+            cursor.executemany("""INSERT OR IGNORE INTO
+                        {} (rnum, question_name, year)
+                        VALUES (?, ?, ?)
+                        """.format(self._rnums_table), rnums)
+            cursor.executemany("""INSERT OR IGNORE INTO
+                        {} (question_name)
+                        VALUES (?)
+                        """.format(self._questions_table), ((question_name, ) for (rnum, question_name, year) in rnums))
+
+            # The new responses are staged in a temporary table, so only
+            # they're wrangled.
+            cursor.execute("DROP TABLE IF EXISTS temp.new_responses")
+            cursor.execute("""CREATE TEMP TABLE new_responses (
+                response_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                rnum TEXT NOT NULL,
+                case_id INTEGER NOT NULL,
+                response INTEGER NOT NULL
+            )""")
+            usecols = self._required_rnums(rnums)
+            self._column_projection = self._project_columns(responses_path, usecols)
+            for responses in self._read_responses(responses_path, chunksize, usecols):
+                _insert_rows(cursor, "temp.new_responses", ("rnum", "case_id", "response"), responses)
+
+            # The new rows are wrangled into a temporary copy of the wrangled
+            # data table, so the translations and inflation adjustment only
+            # touch them.
+            data = self._survey_rows("temp.new_responses", verbose)
+            data_fields = [field for field in self._NLSY_db.db_structure["wrangled_data_fields"] if field in data.columns]
+            cursor.execute("DROP TABLE IF EXISTS temp.new_data")
+            cursor.execute("CREATE TEMP TABLE new_data AS SELECT * FROM main.{} WHERE 0".format(self._wrangled_data_table))
+            _insert_rows(cursor, "temp.new_data", data_fields, data[data_fields].values)
+
+            self._translate_survey_data("temp.new_data")
+            self._translate_employer_data(table="temp.new_data")
+            columns = self._data_columns()
+
+            # The new rows (and responses, if the cohort's were kept) are
+            # added and the shocks relabeled in a single transaction.
+            try:
+                self._apply_deflators(cursor, "temp.new_data", deflators, "nominal_income" in columns)
+                columns = [column for column in columns if column != "data_id"]
+                cursor.execute("""INSERT INTO main.{data} ({columns})
+                    SELECT {columns} FROM temp.new_data ORDER BY case_id, year""".format(
+                        data = self._wrangled_data_table,
+                        columns = ", ".join(columns)
+                    )
+                )
+
+                cursor.execute("SELECT 1 FROM main.{} LIMIT 1".format(self._responses_table))
+                if cursor.fetchone() is not None:
+                    cursor.execute("""INSERT INTO main.{responses} (rnum, case_id, response)
+                        SELECT rnum, case_id, response FROM temp.new_responses
+                        WHERE rnum != 'R0000100' ORDER BY response_id""".format(
+                            responses = self._responses_table
+                        )
+                    )
+
+                self.label_shocks(since_year=years[0])
+            except BaseException:
+                conn.rollback()
+                raise
+
+            cursor.execute("DROP TABLE temp.new_data")
+            cursor.execute("DROP TABLE temp.new_responses")
+            conn.commit()
+            cursor.close()
+            span.set(years=years, rows=len(data))
+
+        return years
+
+    def _pipeline(self, rnum_path, qname_path, responses_path, keep_responses, chunksize, verbose, base_year=None, keep_nominal_income=False, all_columns=False):
+        """
+        Returns each stage of the ingest as a (name, function, inputs) tuple,
+        where inputs is a hash of everything the stage's output depends on.
+        """
+        def file_stats(path):
+            return [os.path.basename(path), os.path.getsize(path), int(os.path.getmtime(path))]
+
+        cursor = self._NLSY_db.conn.cursor()
+        cursor.execute("SELECT year, inflation FROM {years} ORDER BY year".format(years = self._NLSY_db.years_table))
+        inflation = cursor.fetchall()
+        cursor.close()
+
+        cohort_year = str(self._cohort_year)
+        db_structure = self._NLSY_db.db_structure
+        stages = [
+            ("load_responses", lambda: self._load_responses(rnum_path, qname_path, responses_path, keep_responses, chunksize, all_columns, verbose),
+                [file_stats(rnum_path), file_stats(qname_path), file_stats(responses_path), keep_responses,
+                    None if all_columns else sorted(self._question_names())]),
+            ("wrangle_respondents", self._wrangle_respondents_data,
+                [self._dictionary["static_question_names"][cohort_year], db_structure["wrangled_respondents_fields"]]),
+            ("wrangle_survey", lambda: self._wrangle_survey_data(verbose),
+                [self._dictionary["dynamic_question_names"][cohort_year], db_structure["wrangled_data_fields"]]),
+            ("translate_respondents", self._translate_respondents_data,
+                self._dictionary["static_question_values"][cohort_year]),
+            ("translate_survey", self._translate_survey_data,
+                self._dictionary["dynamic_question_values"][cohort_year]),
+            ("translate_employer", self._translate_employer_data,
+                [reference_data.registry.digest("industry_crosswalk.csv"), reference_data.registry.digest("occupation_crosswalk.csv")]),
+            ("adjust_for_inflation", lambda: self.adjust_for_inflation(base_year, keep_nominal_income),
+                [inflation, base_year, keep_nominal_income]),
+            ("label_shocks", self.label_shocks, {"horizon": 2, "threshold": .2})
+        ]
+
+        return [(name, stage, hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16])
+            for (name, stage, inputs) in stages]
+
+    def _first_stage(self, stages, rerun_from=None):
+        """
+        Works out which stage the ingest should start from, given the stages
+        that have already been completed (and the inputs they were run with).
+        """
+        cursor = self._NLSY_db.conn.cursor()
+        self._create_checkpoints_table(cursor)
+        cursor.execute("SELECT stage, inputs FROM {}".format(self._checkpoints_table))
+        completed = dict(cursor.fetchall())
+
+        names = [name for (name, stage, inputs) in stages]
+        first_stage = len(stages)
+        if rerun_from is not None:
+            first_stage = names.index(rerun_from)
+        for (position, (name, stage, inputs)) in enumerate(stages[:first_stage]):
+            if completed.get(name) != inputs:
+                first_stage = position
+                break
+
+        # A stage that failed partway through was rolled back, so it can just
+        # be run again. One that completed has already updated the wrangled
+        # tables, though, so unless it rebuilds its tables itself (as the
+        # inflation adjustment does if nominal income was kept), they need to
+        # be rebuilt from the responses first.
+        repeatable_stages = list(REPEATABLE_STAGES)
+        if "nominal_income" in self._data_columns():
+            repeatable_stages.append("adjust_for_inflation")
+        if first_stage < len(stages) and names[first_stage] in completed and names[first_stage] not in repeatable_stages:
+            first_stage = names.index("wrangle_respondents")
+
+        # Rebuilding the wrangled tables needs the responses, which have to be
+        # reloaded if they weren't kept.
+        if 0 < first_stage <= names.index("wrangle_survey"):
+            cursor.execute("SELECT 1 FROM {} LIMIT 1".format(self._responses_table))
+            if cursor.fetchone() is None:
+                first_stage = 0
+
+        cursor.close()
+        return first_stage
+
+    def _run_stage(self, name, stage, inputs, verbose=True):
+        """
+        Runs a single pipeline stage in a span (see NLSY_database.instrumentation),
+        recording how long it took and the peak memory while it ran, and, if
+        the span is being collected, the rows in the stage's input and output
+        tables and the number of rows it changed. The stage's checkpoint is
+        written in the same transaction as its changes, so it's only recorded
+        if the stage commits; if the stage fails, its changes are rolled back,
+        leaving the database as the previous stage left it.
+        """
+        conn = self._NLSY_db.conn
+        instrumentation = self._NLSY_db.instrumentation
+        (input_table, output_table) = self._stage_tables[name]
+
+        with instrumentation.span(name, profilable=True, cohort=self._cohort_year) as span:
+            if instrumentation.enabled and input_table is not None:
+                span.set(rows_in=self._count_rows(input_table))
+
+            conn.execute("""INSERT OR REPLACE INTO {checkpoints} (stage, inputs, completed)
+                VALUES (?, ?, datetime('now'))""".format(checkpoints = self._checkpoints_table), (name, inputs))
+            changes = conn.total_changes
+            try:
+                stage()
+            except BaseException:
+                conn.rollback()
+                raise
+
+            if instrumentation.enabled:
+                span.set(rows_out=self._count_rows(output_table), rows_changed=conn.total_changes - changes)
+
+        self._stage_timings[name] = span.seconds
+        self._stage_memory[name] = span.peak_memory
+        conn.execute("UPDATE {checkpoints} SET seconds = ? WHERE stage = ?".format(
+            checkpoints = self._checkpoints_table), (self._stage_timings[name], name))
+        conn.commit()
         if verbose:
-            print("Ingesting {} survey data...".format(self._cohort_year))
+            print("    {} took {:.2f} seconds".format(name, self._stage_timings[name]))
+
+    def _count_rows(self, table):
+        cursor = self._NLSY_db.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM {}".format(table))
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+
+    def _load_responses(self, rnum_path, qname_path, responses_path, keep_responses=True, chunksize=1000, all_columns=False, verbose=False):
+        """
+        Loads the RNUM, question, and response data into the cohort's tables,
+        replacing anything loaded previously. Unless `all_columns` is set, only
+        the responses to the questions we use are loaded.
+        """
+        cursor = self._NLSY_db.conn.cursor()
+        responses_schema = "main" if keep_responses else "temp"
+        for table in (self._rnums_table, self._responses_table):
+            self._drop_indexes(cursor, table)
+        for table in (self._rnums_table, self._questions_table, self._responses_table):
+            cursor.execute("DELETE FROM main.{}".format(table))
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = ?", (self._responses_table, ))
+
+        rnums = self._read_rnums(rnum_path, qname_path)
+        cursor.executemany("""INSERT INTO
+                    {} (rnum, question_name, year)
+                    VALUES (?, ?, ?)
+                    """.format(self._rnums_table), rnums)
+        cursor.executemany("""INSERT OR IGNORE INTO
+                    {} (question_name)
+                    VALUES (?)
+                    """.format(self._questions_table), ((question_name, ) for (rnum, question_name, year) in rnums))
+
+        # A temporary table of the same name shadows the on-disk responses
+        # table until it's dropped at the end of the ingest.
+        if not keep_responses:
+            cursor.execute("DROP TABLE IF EXISTS temp.{}".format(self._responses_table))
+            cursor.execute("""CREATE TEMP TABLE {} (
+                response_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                rnum TEXT NOT NULL,
+                case_id INTEGER NOT NULL,
+                response INTEGER NOT NULL
+            )""".format(self._responses_table))
+
+        usecols = None if all_columns else self._required_rnums(rnums)
+        self._column_projection = self._project_columns(responses_path, usecols)
+        if verbose:
+            print("    reading {columns_read} of {columns} columns ({columns_skipped} skipped, about {mb_skipped:.1f} MB)".format(
+                mb_skipped = self._column_projection["bytes_skipped"] / 2 ** 20, **self._column_projection))
+
+        for responses in self._read_responses(responses_path, chunksize, usecols):
+            _insert_rows(cursor, self._responses_table, ("rnum", "case_id", "response"), responses)
+
+        self._create_indexes(cursor, self._rnums_table)
+        self._create_indexes(cursor, self._responses_table, responses_schema)
+
+        self._NLSY_db.conn.commit()
+        cursor.close()
+
+    def _read_rnums(self, rnum_path, qname_path):
+        """
+        Returns the RNUMs in an extract as (rnum, question_name, year) rows.
+        """
+        # The RNUMs and associated question names are stored on equivalent line numbers in two different files.
+        rnums = []
         with open(rnum_path, 'r') as rnum_file:
             with open(qname_path, 'r') as qname_file:
                 for rnum in rnum_file:
                     rnum = rnum.strip()
                     qname_content = qname_file.readline().strip()
                     (question_name, year) = qname_content.split(",")
+                    rnums.append((rnum, question_name, year))
+        return rnums
 
-                    cursor.execute("""INSERT INTO
-                                {} (rnum, question_name, year)
-                                VALUES (?, ?, ?)
-                                """.format(self._rnums_table), (rnum, question_name, year))
-                    cursor.execute("""INSERT OR IGNORE INTO
-                                {} (question_name)
-                                VALUES (?)
-                                """.format(self._questions_table), (question_name, ))
-
-        with open(responses_path) as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=',')
-            for row in csv_reader:
-
-                # R0000100 is a special value indicating the respondent's case ID.
-                case_id = row["R0000100"]
-
-                # Now, save all the variable response to the "responses" table.
-                for rnum, response in row.items():
-                    cursor.execute("""INSERT INTO
-                        {} (rnum, case_id, response)
-                        VALUES (?, ?, ?)
-                        """.format(self._responses_table), (rnum, case_id, response))
+    def _question_names(self):
+        """
+        Returns the names of the questions that are wrangled into the cohort's
+        data.
+        """
+        cohort_year = str(self._cohort_year)
+        return set(self._dictionary["static_question_names"][cohort_year]) | set(self._dictionary["dynamic_question_names"][cohort_year])
 
-        self._NLSY_db.conn.commit()
-        cursor.close
+    def _required_rnums(self, rnums):
+        """
+        Returns the RNUMs (from the (rnum, question_name, year) rows of the
+        RNUM and question name files) that are used downstream: those of the
+        questions in translate.json, plus the case ID.
+        """
+        question_names = self._question_names()
+        required = set(rnum for (rnum, question_name, year) in rnums if question_name in question_names)
+        required.add("R0000100")
+        return required
 
-        # Now that the data is in the database, the following steps wrangle it
-        # into shape, including separating responses out by year, normalizing
-        # survey codes to match our codebook, adjusting for inflation, and
-        # labeling income shocks.
-        if verbose:
-            print("Restructuring {} data into longitudinal form...".format(self._cohort_year))
-        self._wrangle_respondents_data()
-        self._wrangle_survey_data()
-        if verbose:
-            print("Updating {} data to match codebook...".format(self._cohort_year))
-        self._translate_respondents_data()
-        self._translate_survey_data()
-        self._translate_employer_data()
-        self._adjust_for_inflation()
-        if verbose:
-            print("Labeling income shocks for {} cohort...".format(self._cohort_year))
-        self._label_shocks()
+    def _project_columns(self, responses_path, usecols=None):
+        """
+        Works out how many of the response file's columns will be read, given
+        the RNUMs in `usecols` (or all of them, if it's None). The bytes
+        skipped are estimated from the file's size, assuming every column
+        takes up about the same space.
+        """
+        columns = pd.read_csv(responses_path, nrows=0).columns
+        columns_read = len(columns) if usecols is None else int(columns.isin(list(usecols)).sum())
+        columns_skipped = len(columns) - columns_read
+        return {
+            "columns": len(columns),
+            "columns_read": columns_read,
+            "columns_skipped": columns_skipped,
+            "bytes_skipped": int(os.path.getsize(responses_path) * columns_skipped / len(columns))
+        }
+
+    def _read_responses(self, responses_path, chunksize, usecols=None):
+        """
+        Reads the wide response file (one row per respondent, one column per
+        RNUM) in chunks, yielding each chunk in long form as an array of
+        (rnum, case_id, response) rows, respondent by respondent. If `usecols`
+        is given, only the RNUMs in it are read.
+        """
+        if usecols is not None:
+            # A callable, since RNUMs that aren't in this extract are skipped
+            # rather than being an error.
+            usecols = usecols.__contains__
+
+        # Responses are kept as strings, exactly as they appear in the file, and
+        # SQLite's column affinity takes care of the conversion to integers.
+        for chunk in pd.read_csv(responses_path, dtype=str, na_filter=False, chunksize=chunksize, usecols=usecols, engine="c"):
+            (n_respondents, n_rnums) = chunk.shape
+            responses = np.empty((n_respondents * n_rnums, 3), dtype=object)
+
+            # R0000100 is a special value indicating the respondent's case ID.
+            responses[:, 0] = np.tile(chunk.columns.values, n_respondents)
+            responses[:, 1] = np.repeat(chunk["R0000100"].values, n_rnums)
+            responses[:, 2] = chunk.values.ravel()
+
+            yield responses
 
     def _wrangle_respondents_data(self):
         """
@@ -270,6 +1139,7 @@ class Cohort(object):
         """
         cursor = self._NLSY_db.conn.cursor()
         respondents_fields = self._NLSY_db.db_structure["wrangled_respondents_fields"]
+        cursor.execute("DELETE FROM {}".format(self._wrangled_respondents_table))
 
         for field in respondents_fields:
             # The field provided here is the standard code (i.e., "race"), so
@@ -280,18 +1150,7 @@ class Cohort(object):
 
             # Pull all of the data for a specific static field (e.g., race, sex)
             # for the cohort.
-            cursor.execute("""SELECT {responses}.case_id, {responses}.response
-            	FROM {questions} INNER JOIN {rnums}
-            		ON {questions}.question_name = "{question_name}"
-                    AND {questions}.question_name = {rnums}.question_name
-            	INNER JOIN {responses}
-            		ON {rnums}.rnum = {responses}.rnum""".format(
-                        responses = self._responses_table,
-                        rnums = self._rnums_table,
-                        questions = self._questions_table,
-                        question_name = question_name
-                        )
-                    )
+            cursor.execute(self._static_field_query(), (question_name, ))
 
             # Now, write all that data into the wrangled respondents table.
             rows = cursor.fetchall()
@@ -310,77 +1169,84 @@ class Cohort(object):
         self._NLSY_db.conn.commit()
         cursor.close()
 
-    def _wrangle_survey_data(self, verbose=True):
-        """
-        Adds the data that varies by year, such as survey responses, to the
-        wrangled_data table.
-        """
-
-        cursor = self._NLSY_db.conn.cursor()
-        respondents_fields = self._NLSY_db.db_structure["wrangled_respondents_fields"]
+    def _static_field_query(self):
+        return """SELECT {responses}.case_id, {responses}.response
+            FROM {questions} INNER JOIN {rnums}
+                ON {questions}.question_name = ?
+                AND {questions}.question_name = {rnums}.question_name
+            INNER JOIN {responses}
+                ON {rnums}.rnum = {responses}.rnum""".format(
+                    responses = self._responses_table,
+                    rnums = self._rnums_table,
+                    questions = self._questions_table
+                    )
 
-        cursor.execute("""SELECT {respondents}.case_id, {rnums}.year,  {rnums}.question_name, {responses}.response
-            FROM {respondents}
-                INNER JOIN {responses} ON {respondents}.case_id = {responses}.case_id
-                INNER JOIN {rnums} ON {responses}.rnum = {rnums}.rnum
-            ORDER BY {respondents}.case_id, {rnums}.year""".format(
+    def _survey_data_query(self, responses=None):
+        return """SELECT case_id, rnum, response FROM {responses}
+            WHERE case_id IN (SELECT case_id FROM {respondents})
+            ORDER BY response_id""".format(
                 respondents = self._wrangled_respondents_table,
-                rnums = self._rnums_table,
-                responses = self._responses_table
+                responses = responses or self._responses_table
                 )
-            )
-
-        rows = cursor.fetchall()
-        curr_year = 0
-        curr_case_id = 0
-        curr_data_id = 0
-
-        for row in rows:
-            (case_id, year, question_name, response) = row
 
-            if case_id != curr_case_id:
-                if verbose and case_id % 1000 == 0:
-                    print("{} respondents completed...".format(case_id))
-                curr_case_id = case_id
-                data_id = {}
+    def _wrangle_survey_data(self, verbose=True, chunksize=500000):
+        """
+        Adds the data that varies by year, such as survey responses, to the
+        wrangled_data table.
 
-            if not question_name in self._dictionary["dynamic_question_names"][str(self._cohort_year)]:
-                continue
+        Responses are read from the database `chunksize` at a time and pivoted
+        into one row per respondent and year, so only the wrangled data (rather
+        than every individual response) is ever held in memory. The result is
+        written to the wrangled_data table in a single bulk load.
+        """
+        cursor = self._NLSY_db.conn.cursor()
+        self._drop_indexes(cursor, self._wrangled_data_table)
+        cursor.execute("DELETE FROM {}".format(self._wrangled_data_table))
 
-            # If the year has changed, insert in a new record and record its ID.
-            if year != curr_year and year != "XRND":
-                curr_year = year
-                cursor.execute("""INSERT INTO
-                    {data} (case_id, year)
-                    VALUES (?, ?)""".format(
-                        data = self._wrangled_data_table
-                    ),
-                    (case_id, year)
-                )
-                data_id[year] = cursor.lastrowid
-
-            # The 1997 cohort data uses "XRND" as the year for constructed variables.
-            if year == "XRND":
-                last_two_digits = question_name[-2:]
-                # If the last two digits begin with "9" (e.g., "97", "98", it's the 1990s...
-                if last_two_digits[0] == "9":
-                    year = int("19{}".format(last_two_digits))
-                else:
-                    year = int("20{}".format(last_two_digits))
-
-            question_name = self._dictionary["dynamic_question_names"][str(self._cohort_year)][question_name]
-            cursor.execute("""UPDATE {data}
-                SET {question_name} = ?
-                WHERE data_id = {data_id}""".format(
-                    data = self._wrangled_data_table,
-                    question_name = question_name,
-                    data_id = data_id[year]),
-                (response, )
-            )
+        data = self._survey_rows(self._responses_table, verbose, chunksize)
+        data_fields = [field for field in self._NLSY_db.db_structure["wrangled_data_fields"] if field in data.columns]
+        _insert_rows(cursor, self._wrangled_data_table, data_fields, data[data_fields].values)
+        self._create_indexes(cursor, self._wrangled_data_table)
 
         self._NLSY_db.conn.commit()
         cursor.close()
 
+    def _survey_rows(self, responses_table, verbose=True, chunksize=500000):
+        """
+        Pivots the survey responses in `responses_table` into a DataFrame with
+        one row per respondent and year, in case_id and year order.
+        """
+        conn = self._NLSY_db.conn
+        question_names = self._dictionary["dynamic_question_names"][str(self._cohort_year)]
+
+        # Work out which year and wrangled field each of the cohort's RNUMs
+        # belongs to, ignoring any questions we don't use.
+        questions = pd.read_sql("SELECT rnum, question_name, year FROM {rnums}".format(
+            rnums = self._rnums_table), conn, index_col="rnum")
+        questions = questions[questions["question_name"].isin(list(question_names))].copy()
+        questions["field"] = questions["question_name"].map(question_names)
+        questions["constructed"] = questions["year"] == "XRND"
+        questions["year"] = _survey_years(questions)
+
+        pieces = []
+        for responses in pd.read_sql(self._survey_data_query(responses_table), conn, chunksize=chunksize):
+            responses = responses.join(questions[["year", "field", "constructed"]], on="rnum", how="inner")
+            piece = responses.groupby(["case_id", "year", "field"], sort=False)["response"].last().unstack("field")
+
+            # Constructed variables only fill in years that the respondent has
+            # regular survey data for.
+            piece["observed"] = ~responses.groupby(["case_id", "year"])["constructed"].all()
+            pieces.append(piece)
+
+            if verbose:
+                print("{} respondents completed...".format(responses["case_id"].max()))
+
+        # A respondent's responses can straddle two chunks, so their pieces
+        # are combined before writing the data out in case_id and year order.
+        data = pd.concat(pieces, sort=False)
+        observed = data.pop("observed").groupby(level=["case_id", "year"]).max()
+        return data.groupby(level=["case_id", "year"]).last()[observed].reset_index()
+
     def _translate_respondents_data(self):
         """
         Update all static respondent characteristics to conform to our standard codebook.
@@ -388,20 +1254,13 @@ class Cohort(object):
         cursor = self._NLSY_db.conn.cursor()
         fields_to_translate = self._dictionary["static_question_values"][str(self._cohort_year)]
 
-        for question_name, translate_dict in fields_to_translate.items():
-            for key, value in translate_dict.items():
-                cursor.execute("""UPDATE {respondents}
-                    SET {question_name} = ?
-                    WHERE {question_name} = ?""".format(
-                        respondents = self._wrangled_respondents_table,
-                        question_name = question_name),
-                    (value, key)
-                )
+        for translator in codebook.codebook_translators(fields_to_translate):
+            translator.apply(cursor, self._wrangled_respondents_table, by_year=False)
 
         self._NLSY_db.conn.commit()
         cursor.close()
 
-    def _translate_survey_data(self):
+    def _translate_survey_data(self, table=None):
         """
         Update all survey responses (other than industry and occupation data,
         which are handled separately) to conform to our standard codebook.
@@ -409,326 +1268,499 @@ class Cohort(object):
         cursor = self._NLSY_db.conn.cursor()
         fields_to_translate = self._dictionary["dynamic_question_values"][str(self._cohort_year)]
 
-        for question_name, translate_dict in fields_to_translate.items():
-            for key, value in translate_dict.items():
-                # If the translation value is a dictionary, that means that different
-                # translations must be performed for each year.
-                if isinstance(value, dict):
-                    year = key
-                    for find_value, replace_value in value.items():
-                        cursor.execute("""UPDATE {data}
-                            SET {question_name} = ?
-                            WHERE {question_name} = ?
-                            AND YEAR = ?""".format(
-                                data = self._wrangled_data_table,
-                                question_name = question_name),
-                            (replace_value, find_value, year)
-                        )
-                # Otherwise, simply make the same translation for all responses
-                # to this question, regardless of year.
-                else:
-                    cursor.execute("""UPDATE {data}
-                        SET {question_name} = ?
-                        WHERE {question_name} = ?""".format(
-                            data = self._wrangled_data_table,
-                            question_name = question_name),
-                        (value, key)
-                    )
+        for translator in codebook.codebook_translators(fields_to_translate):
+            translator.apply(cursor, table or self._wrangled_data_table)
 
         self._NLSY_db.conn.commit()
         cursor.close()
 
-    def _translate_employer_data(self, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv"):
+    def _translate_employer_data(self, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv", table=None):
         """
         Update industry and occupation responses to conform to our standard codebook.
         """
         cursor = self._NLSY_db.conn.cursor()
-        industry_crosswalk = pd.read_csv(industry_file)
-        occupation_crosswalk = pd.read_csv(occupation_file)
-
-        # Update industry data...
-        for index, row in industry_crosswalk.iterrows():
-            # The 1979 data is coded using two different sets of census codes, depending on the year.
-            if self.cohort_year == 1979:
-                if not pd.isna(row["1970"]):
-                    cursor.execute("""UPDATE {data}
-                                        SET industry = ?
-                                        WHERE industry = ?
-                                        AND YEAR <= 2002""".format(
-                                            data = self._wrangled_data_table),
-                                        (row["IND1990"], row["1970"]))
-
-                if not pd.isna(row["ACS 2003-"]):
-                    cursor.execute("""UPDATE {data}
-                                        SET industry = ?
-                                        WHERE industry = ?
-                                        AND YEAR > 2002""".format(
-                                            data = self._wrangled_data_table),
-                                        (row["IND1990"], row["ACS 2003-"]))
-
-            if self.cohort_year == 1997:
-                if not pd.isna(row["ACS 2003-"]):
-                    cursor.execute("""UPDATE {data}
-                                        SET industry = ?
-                                        WHERE industry = ?""".format(
-                                            data = self._wrangled_data_table),
-                                        (row["IND1990"], row["ACS 2003-"]))
-
-        # Update ocupation data...
-        for index, row in occupation_crosswalk.iterrows():
-            # The 1979 data is coded using two different sets of census codes, depending on the year.
-            if self.cohort_year == 1979:
-                if not pd.isna(row["1970"]):
-                    cursor.execute("""UPDATE {data}
-                                        SET occupation = ?
-                                        WHERE occupation = ?
-                                        AND YEAR < 2002""".format(
-                                            data = self._wrangled_data_table),
-                                        (row["OCC2010"], row["1970"]))
-
-                if not pd.isna(row["2000"]):
-                    cursor.execute("""UPDATE {data}
-                                        SET occupation = ?
-                                        WHERE occupation = ?
-                                        AND YEAR >= 2002""".format(
-                                            data = self._wrangled_data_table),
-                                        (row["OCC2010"], row["2000"]))
-
-            if self.cohort_year == 1997:
-                if not pd.isna(row["ACS 2003-2009"]):
-                    cursor.execute("""UPDATE {data}
-                                        SET occupation = ?
-                                        WHERE occupation = ?""".format(
-                                            data = self._wrangled_data_table),
-                                        (row["OCC2010"], row["ACS 2003-2009"]))
+        industry_crosswalk = reference_data.registry.crosswalk(industry_file)
+        occupation_crosswalk = reference_data.registry.crosswalk(occupation_file)
 
+        for translator in codebook.crosswalk_translators(self._cohort_year, industry_crosswalk, occupation_crosswalk):
+            translator.apply(cursor, table or self._wrangled_data_table)
 
         self._NLSY_db.conn.commit()
         cursor.close()
 
-    def _adjust_for_inflation(self):
+    def adjust_for_inflation(self, base_year=None, keep_nominal_income=False):
         """
-        Update all income figures to account for inflation.
+        Update all income figures to account for inflation, in terms of
+        `base_year` dollars (by default, the last year in the years table).
+
+        If `keep_nominal_income` is set, the unadjusted figures are kept in a
+        nominal_income column. Once they are, adjusted_income is always
+        recomputed from them, so this can be called again to re-base the
+        cohort's income on a different year without reingesting it (followed
+        by label_shocks(), as prior_income is in adjusted dollars).
         """
         cursor = self._NLSY_db.conn.cursor()
-        inflation_dict = {}
+        deflators = self.deflators(base_year)
+        if base_year is None:
+            base_year = max(deflators)
+
+        columns = self._data_columns()
+        if keep_nominal_income and "nominal_income" not in columns:
+            cursor.execute("""ALTER TABLE {data}
+                ADD COLUMN nominal_income INTEGER""".format(
+                    data = self._wrangled_data_table
+                )
+            )
+            columns.append("nominal_income")
+
+        self._apply_deflators(cursor, self._wrangled_data_table, deflators, "nominal_income" in columns)
+
+        # Later survey rounds are adjusted to the same base year (see
+        # append_survey_round()).
+        self._set_setting(cursor, "base_year", base_year)
+
+        self._NLSY_db.conn.commit()
+        cursor.close()
 
+    def _apply_deflators(self, cursor, table, deflators, nominal_income=False):
+        # Until it's been adjusted, adjusted_income holds the nominal figures
+        # (including after the wrangled data's been rebuilt).
+        income = "adjusted_income"
+        if nominal_income:
+            cursor.execute("""UPDATE {data}
+                SET nominal_income = adjusted_income
+                WHERE nominal_income IS NULL""".format(
+                    data = table
+                )
+            )
+            income = "nominal_income"
+
+        # Every year's deflator is applied in a single UPDATE, joined against
+        # a temporary table.
+        self._create_deflators_table(cursor)
+        cursor.executemany("INSERT INTO temp.deflators VALUES (?, ?)", deflators.items())
+        cursor.execute(self._inflation_query(income, table))
+        cursor.execute("DROP TABLE temp.deflators")
+
+    def deflators(self, base_year=None):
+        """
+        Returns a dictionary of each year in the years table and the factor
+        that converts its dollars into `base_year` dollars (by default, the
+        last year in the years table).
+        """
+        cursor = self._NLSY_db.conn.cursor()
         cursor.execute("""SELECT year, inflation
             FROM {years} ORDER BY year""".format(
                 years = self._NLSY_db.years_table
                 )
             )
+        (years, inflation) = zip(*cursor.fetchall())
+        cursor.close()
 
-        rows = cursor.fetchall()
-        for row in rows:
-             year = row[0]
-             inflation_rate = row[1]
-             inflation_dict[year] = inflation_rate
-
-        # Adjust for inflation.
-        adjust_year = year
-        for year, inflation_rate in inflation_dict.items():
-            inflation_adjustment = 1
-            for inflation_year in range(year, adjust_year):
-                inflation_adjustment *= (1 + inflation_dict[inflation_year])
-            cursor.execute("""UPDATE {data}
-                SET adjusted_income = ROUND(adjusted_income * {inflation}, 0)
-                WHERE adjusted_income > 0 AND year = {year}""".format(
-                    data = self._wrangled_data_table,
-                    inflation = inflation_adjustment,
-                    year = year
-                )
+        if base_year is None:
+            base_year = years[-1]
+        if base_year not in years:
+            raise ValueError("No inflation data for base year {}".format(base_year))
+
+        # Each year's price level relative to the first year's is the
+        # cumulative product of the inflation rates up to it (a year's rate
+        # being the change from it to the next year).
+        price_level = np.cumprod(np.concatenate([[1.], 1 + np.array(inflation[:-1])]))
+        deflators = price_level[years.index(base_year)] / price_level
+
+        return dict(zip(years, deflators.tolist()))
+
+    def _create_deflators_table(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS temp.deflators")
+        cursor.execute("""CREATE TEMP TABLE deflators (
+            year INTEGER PRIMARY KEY,
+            deflator REAL NOT NULL
+        )""")
+
+    def _inflation_query(self, income="adjusted_income", table=None):
+        return """UPDATE {data}
+            SET adjusted_income = ROUND({income} * (SELECT deflator FROM temp.deflators WHERE deflators.year = {data}.year), 0)
+            WHERE {income} > 0 AND year IN (SELECT year FROM temp.deflators)""".format(
+                data = table or self._wrangled_data_table,
+                income = income
             )
 
-        self._NLSY_db.conn.commit()
+    def _data_columns(self):
+        cursor = self._NLSY_db.conn.cursor()
+        cursor.execute("PRAGMA table_info({data})".format(data = self._wrangled_data_table))
+        columns = [row[1] for row in cursor.fetchall()]
         cursor.close()
+        return columns
 
-    def _label_shocks(self):
+    def label_shocks(self, horizon=2, threshold=.2, since_year=None):
         """
-        Identify all income shocks in the data.
+        Identify all income shocks in the data: a respondent suffers a shock
+        if their inflation-adjusted income falls by more than `threshold` over
+        the following `horizon` years. Each row's prior_income is the income
+        `horizon` years earlier.
+
+        Labels are computed in one pass with a self-join on case_id and year,
+        so they can be recomputed with different parameters without
+        reingesting the cohort. If `since_year` is given, only the rows whose
+        labels depend on data from that year on (those from `horizon` years
+        before it) are relabeled, e.g., after a survey round is appended.
         """
         cursor = self._NLSY_db.conn.cursor()
 
-        cursor.execute("""ALTER TABLE {data}
-            ADD COLUMN shock INTEGER DEFAULT -1""".format(
-                data = self._wrangled_data_table
-            )
-        )
-
-        cursor.execute("""ALTER TABLE {data}
-            ADD COLUMN prior_income INTEGER DEFAULT -10""".format(
-                data = self._wrangled_data_table
+        columns = self._data_columns()
+        if "shock" not in columns:
+            cursor.execute("""ALTER TABLE {data}
+                ADD COLUMN shock INTEGER DEFAULT -1""".format(
+                    data = self._wrangled_data_table
+                )
             )
-        )
-
-        for curr_year in range(self._cohort_year, 2018):
-            future_year = curr_year + 2
-            cursor.execute("""SELECT a.data_id, b.data_id, a.case_id, a.adjusted_income, b.adjusted_income
-                FROM {data} AS a INNER JOIN {data} AS b ON a.case_id = b.case_id
-                WHERE a.year = {curr_year} AND b.year = {future_year}""".format(
-                    data = self._wrangled_data_table,
-                    curr_year = curr_year,
-                    future_year = future_year
+        if "prior_income" not in columns:
+            cursor.execute("""ALTER TABLE {data}
+                ADD COLUMN prior_income INTEGER DEFAULT -10""".format(
+                    data = self._wrangled_data_table
                 )
             )
 
-            rows = cursor.fetchall()
+        # Rows are matched with the row exactly `horizon` years later (rather
+        # than simply the next row), as the survey isn't always annual. Shocks
+        # are left unlabeled (-1) if either income is missing, and
+        # prior_income defaults to -10 if there's no earlier row.
+        self._create_shock_labels_table(cursor)
+        cursor.execute(self._shock_labels_query(), {
+            "ratio": 1 - threshold,
+            "horizon": horizon,
+            "first_year": int(self._cohort_year),
+            "since_year": codebook.FIRST_YEAR if since_year is None else since_year - horizon
+        })
+        cursor.execute(self._shock_update_query())
+        cursor.execute("DROP TABLE temp.shock_labels")
 
-            for index, row in enumerate(rows):
-                (first_year_data_id, second_year_data_id, case_id, first_year_income, second_year_income) = row
-                cursor.execute("UPDATE {data} SET prior_income = {income} WHERE data_id = {data_id}".format(
-                    data = self._wrangled_data_table,
-                    income = first_year_income,
-                    data_id = second_year_data_id
-                    )
+        self._NLSY_db.conn.commit()
+        cursor.close()
+
+    def _create_shock_labels_table(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS temp.shock_labels")
+        cursor.execute("""CREATE TEMP TABLE shock_labels (
+            data_id INTEGER PRIMARY KEY,
+            shock INTEGER,
+            prior_income INTEGER
+        )""")
+
+    def _shock_labels_query(self):
+        return """INSERT INTO temp.shock_labels (data_id, shock, prior_income)
+            SELECT curr.data_id,
+                CASE
+                    WHEN future.data_id IS NULL THEN -1
+                    WHEN curr.adjusted_income < 0 OR future.adjusted_income < 0 THEN -1
+                    WHEN future.adjusted_income < :ratio * curr.adjusted_income THEN 1
+                    WHEN future.adjusted_income >= :ratio * curr.adjusted_income THEN 0
+                    ELSE -1
+                END,
+                CASE
+                    WHEN prior.data_id IS NULL THEN -10
+                    ELSE prior.adjusted_income
+                END
+            FROM {data} AS curr
+                LEFT JOIN {data} AS future ON future.case_id = curr.case_id
+                    AND future.year = curr.year + :horizon
+                    AND curr.year >= :first_year
+                LEFT JOIN {data} AS prior ON prior.case_id = curr.case_id
+                    AND prior.year = curr.year - :horizon
+                    AND prior.year >= :first_year
+            WHERE curr.year >= :since_year""".format(
+                data = self._wrangled_data_table
                 )
-                if first_year_income < 0 or second_year_income < 0:
-                    pass
-                elif second_year_income < .8 * first_year_income:
-                    cursor.execute("UPDATE {data} SET shock = 1 WHERE data_id = {data_id}".format(
-                        data = self._wrangled_data_table,
-                        data_id = first_year_data_id
-                        )
-                    )
-                else:
-                    cursor.execute("UPDATE {data} SET shock = 0 WHERE data_id = {data_id}".format(
-                        data = self._wrangled_data_table,
-                        data_id =first_year_data_id
-                        )
-                    )
 
-        self._NLSY_db.conn.commit()
+    def _shock_update_query(self):
+        return """UPDATE {data} SET
+            shock = (SELECT shock FROM temp.shock_labels WHERE shock_labels.data_id = {data}.data_id),
+            prior_income = (SELECT prior_income FROM temp.shock_labels WHERE shock_labels.data_id = {data}.data_id)
+            WHERE data_id IN (SELECT data_id FROM temp.shock_labels)""".format(
+                data = self._wrangled_data_table
+            )
+
+    def explain(self, verbose=True):
+        """
+        Returns SQLite's query plan for each of the main queries run by the
+        cohort's ingest and by data(), as a dictionary of query name and plan
+        lines, printing them if `verbose` is set. Lines starting with "SCAN"
+        are full passes over a table (or index), as opposed to index lookups
+        ("SEARCH"), so they're the ones to look out for.
+        """
+        cursor = self._NLSY_db.conn.cursor()
+        cohort_year = str(self._cohort_year)
+
+        # Queries against temporary tables are planned against empty stand-ins.
+        codebook.Translator.create_table(cursor)
+        self._create_shock_labels_table(cursor)
+        self._create_deflators_table(cursor)
+
+        shock_parameters = {"ratio": .8, "horizon": 2, "first_year": int(self._cohort_year), "since_year": codebook.FIRST_YEAR}
+        queries = [
+            ("wrangle_respondents", self._static_field_query(), (list(self._dictionary["static_question_names"][cohort_year])[0], )),
+            ("wrangle_survey", self._survey_data_query(), ())
+        ]
+        for translator in codebook.codebook_translators(self._dictionary["static_question_values"][cohort_year])[:1]:
+            queries.append(("translate_respondents", translator.update_query(self._wrangled_respondents_table, by_year=False), ()))
+        for translator in codebook.codebook_translators(self._dictionary["dynamic_question_values"][cohort_year])[:1]:
+            queries.append(("translate_survey", translator.update_query(self._wrangled_data_table), ()))
+        queries.extend([
+            ("translate_employer", codebook.Translator("industry").update_query(self._wrangled_data_table), ()),
+            ("adjust_for_inflation", self._inflation_query(), ()),
+            ("label_shocks", self._shock_labels_query(), shock_parameters),
+            ("label_shocks (update)", self._shock_update_query(), ()),
+            ("data", self._data_query(), ())
+        ])
+
+        plans = {}
+        for (name, sql_query, parameters) in queries:
+            cursor.execute("EXPLAIN QUERY PLAN {}".format(sql_query), parameters)
+
+            # Each step of the plan is indented under its parent.
+            depths = {0: -1}
+            plans[name] = []
+            for (step_id, parent_id, unused, detail) in cursor.fetchall():
+                depths[step_id] = depths.get(parent_id, -1) + 1
+                plans[name].append("{}{}".format("    " * depths[step_id], detail))
+
+            if verbose:
+                print("{}:".format(name))
+                for line in plans[name]:
+                    print("    {}".format(line))
+
+        cursor.execute("DROP TABLE temp.translation")
+        cursor.execute("DROP TABLE temp.shock_labels")
+        cursor.execute("DROP TABLE temp.deflators")
         cursor.close()
 
-    def data(self, impute_values=True, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv"):
-        conn = self._NLSY_db.conn
-        cursor = conn.cursor()
+        return plans
+
+    def data(self, impute_values=True, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv", cache_dir=None, compact=False, sparse_dummies=False, verbose=False):
+        """
+        Returns the cohort's data as a DataFrame, with one row per respondent
+        and year, ready for modeling.
+
+        If `cache_dir` is given, the DataFrame is cached there (see
+        feature_cache.FeatureCache) and later calls load it from disk, until
+        the database, codebook, or crosswalks change.
 
+        If `compact` is True, the DataFrame uses the smallest dtypes that fit
+        its values (see compact_frame), and if `sparse_dummies` is also True,
+        its dummy columns are stored sparsely. If `verbose` is True, the
+        DataFrame's memory footprint is reported.
+        """
+        with self._NLSY_db.instrumentation.span("data", cohort=self._cohort_year, cached=cache_dir is not None) as span:
+            if cache_dir is not None:
+                df = feature_cache.FeatureCache(cache_dir).data(self, impute_values, industry_file, occupation_file)
+            else:
+                df = self._build_data(impute_values, industry_file, occupation_file)
+            span.set(rows_out=len(df), columns=len(df.columns))
+
+        if verbose:
+            print("{} data: {} rows x {} columns, {:.1f} MB".format(self._cohort_year, df.shape[0], df.shape[1], memory_footprint(df) / 2 ** 20))
+        if compact:
+            df = compact_frame(df, sparse_dummies)
+            if verbose:
+                print("{} data, compacted: {:.1f} MB".format(self._cohort_year, memory_footprint(df) / 2 ** 20))
+
+        return df
+
+    def iter_data(self, chunksize=10000, impute_values=True, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv", categories=None):
+        """
+        Yields the cohort's data (as returned by data()) as DataFrames of
+        about `chunksize` rows each, so the whole cohort never has to be held
+        in memory. Each respondent's rows are kept together in one chunk, and
+        rows are ordered by case ID and year.
+
+        Every chunk has the same columns: a dummy variable is included for
+        each category found anywhere in the cohort's data, or, if
+        `categories` is given (a dict of lists, like the one returned by
+        data_categories()), for each category listed there, which lets
+        several cohorts share their columns. Dummy variables are uint8, and
+        columns that data() would return as objects are float64.
+        """
+        if categories is None:
+            categories = self.data_categories(impute_values, industry_file, occupation_file, chunksize)
+
+        binner = reference_data.registry.binner(self._dictionary_path, industry_file, occupation_file)
+        statistics = self._data_statistics() if impute_values else None
+
+        columns = None
+        for df in self._data_chunks(chunksize):
+            df = self._transform_data(df, binner, impute_values, statistics)
+            if df.empty:
+                continue
+
+            non_dummies_df = df[CATEGORICAL_VARIABLES]
+            df = pd.get_dummies(df, columns=CATEGORICAL_VARIABLES)
+            if columns is None:
+                base_columns = [col for col in df.columns if col not in dummy_columns(df)]
+                dummies = ["{}_{}".format(variable, value) for variable in CATEGORICAL_VARIABLES for value in categories[variable]]
+                columns = base_columns + dummies
+
+            unlisted = [col for col in dummy_columns(df) if col not in set(columns)]
+            if unlisted:
+                raise ValueError("{} data has categories that weren't listed: {}".format(self._cohort_year, ", ".join(unlisted)))
+
+            df = df.reindex(columns=columns, fill_value=0)
+            df[dummies] = df[dummies].astype("uint8")
+            for col in df.columns:
+                if df[col].dtype == object:
+                    df[col] = pd.to_numeric(df[col]).astype("float64")
+            yield pd.concat([df, non_dummies_df], axis=1)
+
+    def data_categories(self, impute_values=True, industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv", chunksize=10000):
+        """
+        Returns the values of each of the categorical variables in the
+        cohort's data, as a dict of sorted lists.
+        """
+        binner = reference_data.registry.binner(self._dictionary_path, industry_file, occupation_file)
+        statistics = self._data_statistics() if impute_values else None
+
+        categories = {variable: set() for variable in CATEGORICAL_VARIABLES}
+        for df in self._data_chunks(chunksize):
+            df = self._transform_data(df, binner, impute_values, statistics)
+            for variable in CATEGORICAL_VARIABLES:
+                categories[variable].update(df[variable].unique().tolist())
+
+        return {variable: sorted(values) for (variable, values) in categories.items()}
+
+    def _data_query(self, columns=None, order=False):
         # We're using the prior year's economic data to account for the fact that
         # accurate data often isn't available until after the end of a given year.
-        sql_query = """SELECT * FROM {respondents}
+        sql_query = """SELECT {columns} FROM {respondents}
             INNER JOIN {data} ON {data}.case_id = {respondents}.case_id
             INNER JOIN {years} ON {data}.year = ({years}.year + 1)
             INNER JOIN {region} ON {region}.region = {data}.region AND
                 {region}.year = ({data}.year - 1)""".format(
+                columns = "*" if columns is None else ", ".join("{}.{}".format(self._wrangled_data_table, col) for col in columns),
                 respondents = self._wrangled_respondents_table,
                 data = self._wrangled_data_table,
                 years = self._NLSY_db.years_table,
                 region = self._NLSY_db.region_table
                 )
+        if order:
+            sql_query += " ORDER BY {data}.case_id, {data}.year".format(data = self._wrangled_data_table)
+        return sql_query
 
-        df = pd.read_sql(sql_query, conn)
+    def _data_chunks(self, chunksize):
+        """
+        Yields the results of the data query in chunks, holding back each
+        chunk's last respondent for the next one, so that no respondent's
+        rows are split between chunks.
+        """
+        carry = None
+        for chunk in pd.read_sql(self._data_query(order=True), self._NLSY_db.conn, chunksize=chunksize):
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+
+            # case_id appears once for each table it's in.
+            case_ids = chunk["case_id"]
+            if isinstance(case_ids, pd.DataFrame):
+                case_ids = case_ids.iloc[:, 0]
+
+            last_respondent = (case_ids == case_ids.iloc[-1]).values
+            carry = chunk[last_respondent].reset_index(drop=True)
+            chunk = chunk[~last_respondent].reset_index(drop=True)
+            if not chunk.empty:
+                yield chunk
+
+        if carry is not None and not carry.empty:
+            yield carry
+
+    def _data_statistics(self, df=None):
+        """
+        Returns the summary statistics used to impute hours and weeks worked,
+        which are taken over the whole cohort. They're calculated from `df`
+        (the results of the data query) if it's given, and otherwise queried.
+        """
+        if df is None:
+            df = pd.read_sql(self._data_query(columns=["shock", "hours_worked_last_year", "weeks_worked_last_year"]), self._NLSY_db.conn)
+        df = df[~(df["shock"] < 0)]
+
+        hours_worked = df["hours_worked_last_year"]
+        max_hours_worked = int(hours_worked.mean() + 3 * hours_worked.std())
+        return {
+            "max_hours_worked": max_hours_worked,
+            "default_hours_worked": int(hours_worked.mask(hours_worked > max_hours_worked, max_hours_worked).median()),
+            "default_weeks_worked": int(df["weeks_worked_last_year"].median())
+        }
+
+    def _build_data(self, impute_values, industry_file, occupation_file):
+        with self._NLSY_db.instrumentation.span("data_query", cohort=self._cohort_year) as span:
+            df = pd.read_sql(self._data_query(), self._NLSY_db.conn)
+            span.set(rows_out=len(df))
+
+        # Bin highest grade, industry and occupation, with the industry and
+        # occupation bins based on the crosswalk files.
+        binner = reference_data.registry.binner(self._dictionary_path, industry_file, occupation_file)
+        statistics = self._data_statistics(df.loc[:,~df.columns.duplicated()]) if impute_values else None
+        df = self._transform_data(df, binner, impute_values, statistics)
+
+        non_dummies_df = df[CATEGORICAL_VARIABLES]
+        df = pd.get_dummies(df, columns=CATEGORICAL_VARIABLES)
+        df = pd.concat([df, non_dummies_df], axis=1)
 
-        # Get rid of the duplicate columns, as well as data_id, which is useful
-        # only in the SQL database.
-        df = df.loc[:,~df.columns.duplicated()]
-        df.drop(['data_id'], axis=1, inplace=True)
-        df.drop(df[df.shock < 0].index, inplace=True)
-
-
-        # Create bins for industry and occupation based on the crosswalk files.
-        industry_crosswalk = pd.read_csv(industry_file)
-        occupation_crosswalk = pd.read_csv(occupation_file)
-        self._dictionary["binned_values"]["industry"] = {"-10": "UNKNOWN"}
-        self._dictionary["binned_values"]["occupation"] = {"-10": "UNKNOWN"}
-
-        bin_bottom = False
-        reset_bin = False
-        for index, row in industry_crosswalk.iterrows():
-            if reset_bin and row["IND1990"] != "#":
-                reset_bin = False
-                bin_bottom = row["IND1990"]
-            if row["IND1990"] == "#" and row["Industry category description"].isupper():
-                reset_bin = True
-                if bin_bottom:
-                    self._dictionary["binned_values"]["industry"][bin_bottom] = curr_description
-                curr_description = row["Industry category description"].strip()
-        self._dictionary["binned_values"]["industry"][bin_bottom] = curr_description
-
-        industry_keys = list(self._dictionary["binned_values"]["industry"].keys()) + [99999]
-        for index, bin_bottom in enumerate(industry_keys):
-            if bin_bottom == 99999:
-                break
-            bin_top = int(industry_keys[index + 1]) - 1
-            self._dictionary["binned_values"]["industry"]["{}~{}".format(bin_bottom, bin_top)] = self._dictionary["binned_values"]["industry"].pop(bin_bottom)
-
-        bin_bottom = False
-        reset_bin = False
-        for index, row in occupation_crosswalk.iterrows():
-            if reset_bin and row["OCC2010"] != "#":
-                reset_bin = False
-                bin_bottom = row["OCC2010"]
-            if row["OCC2010"] == "#" and row["Occupation category description"].isupper():
-                reset_bin = True
-                if bin_bottom:
-                    self._dictionary["binned_values"]["occupation"][bin_bottom] = curr_description
-                curr_description = row["Occupation category description"].strip()
-        self._dictionary["binned_values"]["occupation"][bin_bottom] = curr_description
-
-        occupation_keys = list(self._dictionary["binned_values"]["occupation"].keys()) + [99999]
-        for index, bin_bottom in enumerate(occupation_keys):
-            if bin_bottom == 99999:
-                break
-            bin_top = int(occupation_keys[index + 1]) - 1
-            self._dictionary["binned_values"]["occupation"]["{}~{}".format(bin_bottom, bin_top)] = self._dictionary["binned_values"]["occupation"].pop(bin_bottom)
-
-        for col, bin_dict in self._dictionary["binned_values"].items():
-            for bin_range, bin_name in bin_dict.items():
-                (bin_bottom, bin_top) = bin_range.split("~")
-                bin_bottom = int(bin_bottom)
-                bin_top = int(bin_top)
-                df.loc[(df[col] >= bin_bottom) & (df[col] <= bin_top), col] = bin_bottom
-
-
-        # Add the "income_change" variable.
-        for index, row in df.iterrows():
-            if row["prior_income"] < 0:
-                df.at[index, "prior_income"] = row["adjusted_income"]
-                row["prior_income"] = row["adjusted_income"]
-
-            if row["adjusted_income"] == 0:
-                if row["prior_income"] == 0:
-                    df.at[index, "income_change"] = 0
-                else:
-                    df.at[index, "income_change"] = -1
-            elif row["adjusted_income"] > 0:
-                if row["prior_income"] <= 0:
-                    # Income growth is undefined, so set to 500%, equal to the 99.5th percentile value in our data.
-                    df.at[index, "income_change"] = 5
-                else:
-                    df.at[index, "income_change"] = min(row["adjusted_income"] / row ["prior_income"] - 1, 5)
-            else:
-                df.at[index, "income_change"] = 0
+        return df
 
+    def _transform_data(self, df, binner, impute_values, statistics):
+        """
+        Turns the results of the data query into the cohort's data, short of
+        its dummy variables. Every respondent's rows must be included, since
+        missing values are filled in from the respondent's earlier responses.
+        """
+        # Get rid of the duplicate columns, as well as data_id, which is useful
+        # only in the SQL database, and nominal income, if it's been kept.
+        df = df.loc[:,~df.columns.duplicated()].copy()
+        df = df.drop(['data_id'], axis=1)
+        if 'nominal_income' in df.columns:
+            df = df.drop(['nominal_income'], axis=1)
+        df = df.drop(df[df.shock < 0].index)
+
+        df = binner.transform(df)
+
+        # Add the "income_change" variable. Where there's no prior income on
+        # record, the current income stands in for it.
+        missing_prior_income = df["prior_income"] < 0
+        df.loc[missing_prior_income, "prior_income"] = df.loc[missing_prior_income, "adjusted_income"]
+
+        adjusted_income = df["adjusted_income"]
+        prior_income = df["prior_income"]
+        df["income_change"] = np.select(
+            [
+                (adjusted_income == 0) & (prior_income == 0),
+                adjusted_income == 0,
+                # Income growth is undefined, so set to 500%, equal to the 99.5th percentile value in our data.
+                (adjusted_income > 0) & (prior_income <= 0),
+                adjusted_income > 0
+            ],
+            [0, -1, 5, np.minimum(adjusted_income / prior_income - 1, 5)],
+            default=0
+        )
 
+        # Regional unemployment data isn't available for every year, so fall
+        # back on the national figure.
+        missing_regional_unemployment = df["regional_unemployment"] == ""
+        df.loc[missing_regional_unemployment, "regional_unemployment"] = df.loc[missing_regional_unemployment, "unemployment"]
 
         if impute_values:
-            df["curr_pregnant"].fillna(0, inplace=True)
+            df["curr_pregnant"] = df["curr_pregnant"].fillna(0)
             df.loc[df["curr_pregnant"] < 0, "curr_pregnant"] = 0
-            df["work_kind_limited"].fillna(0, inplace=True)
-            df["work_amount_limited"].fillna(0, inplace=True)
-            default_values = {"case_id": 0, "number_of_kids": 0, "family_size": 1, "marital_status": 0, "work_kind_limited": 0, "work_amount_limited": 0, "highest_grade": 0, "urban_or_rural": -1}
-            last_values = default_values
-            for index, row in df.iterrows():
-                if row["case_id"] != last_values["case_id"]:
-                    last_values = default_values
-                    last_values["case_id"] = row["case_id"]
-                for key, value in last_values.items():
-                    if pd.isna(row[key]) or row[key] < 0:
-                        df.at[index, key] = value
-                    else:
-                        last_values[key] = row[key]
-                if row["regional_unemployment"] == "":
-                    df.at[index, "regional_unemployment"] = row["unemployment"]
-
-            max_hours_worked = int(df["hours_worked_last_year"].mean() + 3 * df["hours_worked_last_year"].std())
+            df["work_kind_limited"] = df["work_kind_limited"].fillna(0)
+            df["work_amount_limited"] = df["work_amount_limited"].fillna(0)
+
+            # Missing (or negative) values are filled in with the respondent's
+            # most recent valid response, or a default if there isn't one.
+            default_values = {"number_of_kids": 0, "family_size": 1, "marital_status": 0, "work_kind_limited": 0, "work_amount_limited": 0, "highest_grade": 0, "urban_or_rural": -1}
+            chronological = df.sort_values(["case_id", "year"])
+            for col, default_value in default_values.items():
+                valid_values = chronological[col].where(chronological[col] >= 0)
+                df[col] = valid_values.groupby(chronological["case_id"]).ffill().fillna(default_value)
+
+            max_hours_worked = statistics["max_hours_worked"]
             df.loc[df["hours_worked_last_year"] > max_hours_worked, "hours_worked_last_year"] = max_hours_worked
-
-            default_hours_worked = int(df["hours_worked_last_year"].median())
-            df.loc[df["hours_worked_last_year"] < 0, "hours_worked_last_year"] = default_hours_worked
-
-            default_weeks_worked = int(df["weeks_worked_last_year"].median())
-            df.loc[df["weeks_worked_last_year"] < 0, "weeks_worked_last_year"] = default_weeks_worked
+            df.loc[df["hours_worked_last_year"] < 0, "hours_worked_last_year"] = statistics["default_hours_worked"]
+            df.loc[df["weeks_worked_last_year"] < 0, "weeks_worked_last_year"] = statistics["default_weeks_worked"]
 
             df.loc[df["urban_or_rural"] == 2, "urban_or_rural"] = 1
         else:
@@ -736,19 +1768,16 @@ class Cohort(object):
             # that we're imputing them even for the "non-imputed" version of the data.
 
             df.loc[df["urban_or_rural"] == 2, "urban_or_rural"] = -1
-            df["curr_pregnant"].fillna(0, inplace=True)
+            df["curr_pregnant"] = df["curr_pregnant"].fillna(0)
             df.loc[df["curr_pregnant"] < 0, "curr_pregnant"] = 0
-            df["work_kind_limited"].fillna(0, inplace=True)
-            df["work_amount_limited"].fillna(0, inplace=True)
-            for index, row in df.iterrows():
-                if row["regional_unemployment"] == "":
-                    df.at[index, "regional_unemployment"] = row["unemployment"]
-            df.dropna(inplace=True)
+            df["work_kind_limited"] = df["work_kind_limited"].fillna(0)
+            df["work_amount_limited"] = df["work_amount_limited"].fillna(0)
+            df = df.dropna()
             for col in df.columns.tolist()[1:]:
                 if col != "industry" and col != "occupation":
                     try:
-                        df = df.ix[df[col] >= 0]
-                    except:
+                        df = df.loc[df[col] >= 0]
+                    except TypeError:
                         pass
 
         # Force data into numeric types where applicable.
@@ -759,15 +1788,10 @@ class Cohort(object):
 
         # Create a variable to represent any variety of work limitation.
         df["work_limited"] = df["work_kind_limited"] + df["work_amount_limited"]
-        df["work_limited"].replace(2, 1, inplace=True)
+        df["work_limited"] = df["work_limited"].replace(2, 1)
 
         # Combine the various unknown/inapplicable codes for industry and occupation.
-        df["occupation"].replace([-10, 0], 9920, inplace=True)
-        df["industry"].replace([-10, 0], 992, inplace=True)
-
-        categorical_variables = ["region", "highest_grade", "industry", "occupation", "marital_status", "race"]
-        non_dummies_df = df[categorical_variables]
-        df = pd.get_dummies(df, columns=categorical_variables)
-        df = pd.concat([df, non_dummies_df], axis=1)
+        df["occupation"] = df["occupation"].replace([-10, 0], 9920)
+        df["industry"] = df["industry"].replace([-10, 0], 992)
 
         return df
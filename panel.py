@@ -0,0 +1,306 @@
+import os
+import json
+import errno
+import shutil
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+
+import nlsy
+import feature_cache
+
+# Survey years are all below this, so a (case_id, year) pair can be packed
+# into a single integer that sorts the same way.
+YEAR_BASE = 10000
+
+# Case IDs are looked up in a dense array indexed by case ID, unless it would
+# be more than this many times the number of respondents, in which case
+# they're binary searched.
+MAX_INDEX_RATIO = 16
+
+
+def _compact(values):
+    """
+    Returns a column's values in the smallest dtype that holds them exactly:
+    integers are downcast, and columns with missing values are stored as
+    float32 where that doesn't lose any precision.
+    """
+    if np.issubdtype(values.dtype, np.integer):
+        return pd.to_numeric(pd.Series(values), downcast="integer").values
+    values = values.astype(np.float64)
+    single = values.astype(np.float32)
+    if np.array_equal(single.astype(np.float64), values, equal_nan=True):
+        return single
+    return values
+
+
+def _fingerprint(cohort):
+    # As it'd be read back from a saved panel's manifest.
+    fingerprint = feature_cache.table_fingerprint(cohort.NLSY_db.conn, cohort.wrangled_data_table)
+    return json.loads(json.dumps(fingerprint, default=str))
+
+
+class Panel(object):
+    """
+    A cohort's wrangled data, with one row per respondent and year, held as a
+    NumPy array per column rather than a DataFrame. The rows are sorted by
+    case_id and year, so each respondent's history is a contiguous slice of
+    every column, found through an index of where each respondent's rows
+    start without searching the data.
+
+    A panel can be saved to a directory of .npy files (see save()) and loaded
+    back memory-mapped, so only the columns and rows that are used are read
+    from disk.
+    """
+
+    def __init__(self, columns, case_ids, offsets, cohort_year=None, fingerprint=None):
+        self._columns = columns
+        self._case_ids = case_ids
+        self._offsets = offsets
+        self._cohort_year = cohort_year
+        self._fingerprint = fingerprint
+
+        # Where each respondent's rows are, by case ID.
+        self._positions = None
+        if len(case_ids) and case_ids[0] >= 0 and case_ids[-1] < MAX_INDEX_RATIO * len(case_ids):
+            self._positions = np.full(int(case_ids[-1]) + 1, -1, dtype=np.int64)
+            self._positions[case_ids] = np.arange(len(case_ids))
+
+        self._keys = None
+        self._sections = None
+
+    @classmethod
+    def from_cohort(cls, cohort, columns=None):
+        """
+        Builds a panel from a cohort's wrangled data table, with all of its
+        columns (other than data_id), or only `columns` (case_id and year are
+        always included).
+        """
+        conn = cohort.NLSY_db.conn
+        table = cohort.wrangled_data_table
+        df = pd.read_sql("SELECT {columns} FROM {data} ORDER BY case_id, year".format(
+            columns = "*" if columns is None else ", ".join(["case_id", "year"] + [column for column in columns if column not in ("case_id", "year")]),
+            data = table
+            ), conn)
+        df = df.drop(columns=["data_id"], errors="ignore")
+        columns = ["case_id", "year"] + [column for column in df.columns if column not in ("case_id", "year")]
+
+        (case_ids, starts) = np.unique(df["case_id"].values, return_index=True)
+        offsets = np.append(starts, len(df)).astype(np.int64)
+        arrays = dict((column, _compact(df[column].values)) for column in columns)
+
+        return cls(arrays, case_ids.astype(np.int64), offsets, cohort.cohort_year, _fingerprint(cohort))
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Loads a saved panel. With the default mmap_mode, its arrays are
+        memory-mapped rather than read into memory up front.
+        """
+        with open(os.path.join(directory, "panel.json")) as json_file:
+            manifest = json.load(json_file)
+
+        columns = dict((column, np.load(os.path.join(directory, "{}.npy".format(column)), mmap_mode=mmap_mode))
+            for column in manifest["columns"])
+        case_ids = np.load(os.path.join(directory, "case_ids.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode=mmap_mode)
+        return cls(columns, case_ids, offsets, manifest["cohort"], manifest["fingerprint"])
+
+    @classmethod
+    def load_or_build(cls, cohort, directory, columns=None):
+        """
+        Loads the cohort's panel from `directory`, or, if it hasn't been saved
+        there or the wrangled data's changed since, builds and saves it first.
+        """
+        if os.path.exists(os.path.join(directory, "panel.json")):
+            panel = cls.load(directory)
+            if panel.fingerprint == _fingerprint(cohort) and (columns is None or set(columns) <= set(panel.columns)):
+                return panel
+
+        panel = cls.from_cohort(cohort, columns)
+        panel.save(directory)
+        return cls.load(directory)
+
+    def save(self, directory):
+        """
+        Saves the panel to a directory, as a .npy file per array and a
+        panel.json manifest. It's written to a temporary directory first, so a
+        half-written panel is never picked up.
+        """
+        partial_dir = "{}.{}.{}.partial".format(directory, os.getpid(), threading.get_ident())
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        os.makedirs(partial_dir)
+
+        for (column, values) in self._columns.items():
+            np.save(os.path.join(partial_dir, "{}.npy".format(column)), values)
+        np.save(os.path.join(partial_dir, "case_ids.npy"), self._case_ids)
+        np.save(os.path.join(partial_dir, "offsets.npy"), self._offsets)
+
+        with open(os.path.join(partial_dir, "panel.json"), "w") as json_file:
+            json.dump({"cohort": self._cohort_year, "rows": len(self), "columns": self.columns,
+                "dtypes": [str(values.dtype) for values in self._columns.values()],
+                "fingerprint": self._fingerprint}, json_file)
+
+        # An existing panel is moved aside before it's deleted, so there's
+        # never a half-deleted one in its place, even if another builder is
+        # saving the panel at the same time.
+        while True:
+            try:
+                os.rename(partial_dir, directory)
+                return
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+            stale_dir = "{}.{}.{}.stale".format(directory, os.getpid(), threading.get_ident())
+            try:
+                os.rename(directory, stale_dir)
+            except OSError:
+                continue
+            shutil.rmtree(stale_dir, ignore_errors=True)
+
+    @property
+    def cohort_year(self):
+        return self._cohort_year
+
+    @property
+    def fingerprint(self):
+        """
+        The fingerprint of the wrangled data table the panel was built from
+        (see feature_cache.table_fingerprint()).
+        """
+        return self._fingerprint
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def case_ids(self):
+        return self._case_ids
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self._columns.values()) + self._case_ids.nbytes + self._offsets.nbytes
+
+    def __len__(self):
+        return int(self._offsets[-1]) if len(self._offsets) else 0
+
+    def __contains__(self, case_id):
+        return self._position(case_id) >= 0
+
+    def __getitem__(self, column):
+        return self._columns[column]
+
+    def _position(self, case_id):
+        if self._positions is not None:
+            if 0 <= case_id < len(self._positions):
+                return int(self._positions[case_id])
+            return -1
+        position = int(np.searchsorted(self._case_ids, case_id))
+        if position < len(self._case_ids) and self._case_ids[position] == case_id:
+            return position
+        return -1
+
+    def rows(self, case_id):
+        """
+        Returns the slice of rows holding a respondent's history.
+        """
+        position = self._position(case_id)
+        if position < 0:
+            raise KeyError("No respondent with case ID {} in the panel".format(case_id))
+        return slice(int(self._offsets[position]), int(self._offsets[position + 1]))
+
+    def history(self, case_id, columns=None):
+        """
+        Returns a respondent's year-by-year history as a dict of arrays (views
+        of the panel's, so nothing's copied), with all the panel's columns or
+        only `columns`.
+        """
+        rows = self.rows(case_id)
+        return dict((column, self._columns[column][rows]) for column in (self._columns if columns is None else columns))
+
+    def cross_section(self, year, columns=None):
+        """
+        Returns every respondent's row for a given year as a dict of arrays,
+        in case ID order, with all the panel's columns or only `columns`.
+        """
+        if self._sections is None:
+            # The rows sorted by year (and case ID within a year), and where
+            # each year's rows start.
+            order = np.argsort(self._columns["year"], kind="stable")
+            (years, starts) = np.unique(self._columns["year"][order], return_index=True)
+            self._sections = (order, years, np.append(starts, len(order)))
+
+        (order, years, starts) = self._sections
+        position = int(np.searchsorted(years, year))
+        if position == len(years) or years[position] != year:
+            rows = order[:0]
+        else:
+            rows = order[starts[position]:starts[position + 1]]
+        return dict((column, self._columns[column][rows]) for column in (self._columns if columns is None else columns))
+
+    def lag(self, column, years=2):
+        """
+        Returns, for each row, the respondent's value of `column` from
+        `years` years earlier (NaN if they have no row for that year), as
+        label_shocks() pairs rows up. The survey's been biennial since 1994,
+        so a lag of one year is often missing.
+        """
+        if self._keys is None:
+            self._keys = self._columns["case_id"].astype(np.int64) * YEAR_BASE + self._columns["year"]
+
+        targets = self._keys - years
+        matches = np.searchsorted(self._keys, targets)
+        found = matches < len(self._keys)
+        found[found] = self._keys[matches[found]] == targets[found]
+
+        values = np.full(len(self._keys), np.nan)
+        values[found] = self._columns[column][matches[found]]
+        return values
+
+    def lead(self, column, years=2):
+        """
+        Returns, for each row, the respondent's value of `column` from
+        `years` years later (NaN if they have no row for that year).
+        """
+        return self.lag(column, -years)
+
+
+def build_panels(NLSY_db, output_dir="panels", cohort_years=None, verbose=True):
+    """
+    Builds (or loads, if they're up to date) each of the database's cohorts'
+    panels (or only those in `cohort_years`) in `output_dir`, as panel79,
+    panel97, etc. Returns the panels by cohort year.
+    """
+    cohorts = [cohort for cohort in NLSY_db.cohorts if cohort_years is None or str(cohort.cohort_year) in [str(year) for year in cohort_years]]
+    if not cohorts:
+        raise ValueError("No cohorts to build panels for")
+
+    panels = {}
+    for cohort in cohorts:
+        directory = os.path.join(output_dir, "panel{}".format(str(cohort.cohort_year)[2:]))
+        panel = Panel.load_or_build(cohort, directory)
+        if verbose:
+            print("{} panel: {} respondents, {} rows, {:.1f} MB, in {}".format(cohort.cohort_year,
+                len(panel.case_ids), len(panel), panel.nbytes / 2 ** 20, directory))
+        panels[str(cohort.cohort_year)] = panel
+
+    return panels
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Builds array-backed panels of each cohort's wrangled data, and looks up respondents' histories.")
+    parser.add_argument("--db", default="data.db", help="database to build the panels from (default: data.db)")
+    parser.add_argument("--cohorts", nargs="+", help="cohort years to build panels for (default: all of them)")
+    parser.add_argument("--output-dir", default="panels", help="directory to save the panels in (default: panels)")
+    parser.add_argument("--case-id", type=int, help="print this respondent's history from each panel")
+    args = parser.parse_args()
+
+    panels = build_panels(nlsy.NLSY_database(args.db, read_only=True), args.output_dir, args.cohorts)
+    if args.case_id is not None:
+        for (cohort_year, panel) in panels.items():
+            if args.case_id in panel:
+                print("{} cohort, case ID {}:".format(cohort_year, args.case_id))
+                print(pd.DataFrame(panel.history(args.case_id)).to_string(index=False))
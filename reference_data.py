@@ -0,0 +1,133 @@
+import os
+import csv
+import json
+import hashlib
+import threading
+import pandas as pd
+
+import codebook
+
+
+class FrozenDict(dict):
+    """
+    A dict that can't be changed once it's created, so reference data can be
+    shared without one caller's changes leaking into another's. Copy it with
+    dict() to get a version that can be changed.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("{} is read-only".format(type(self).__name__))
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self), ))
+
+
+def freeze(value):
+    """
+    Returns a read-only copy of parsed JSON, with dicts as FrozenDicts and
+    lists as tuples.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for (key, item) in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class ReferenceData(object):
+    """
+    Loads the reference files the pipeline reads (translate.json,
+    db_structure.json, the industry and occupation crosswalks, years.csv and
+    regions.csv) and what's derived from them (such as the Binner), once per
+    process rather than once per cohort or call. Everything it returns is
+    read-only.
+
+    Entries are keyed on a hash of the files' contents, so a file that changes
+    on disk is reloaded. The hash is only recomputed when a file's size or
+    modification time changes. Loading is thread-safe, and forked workers
+    inherit whatever's already been loaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._digests = {}
+        self._entries = {}
+        if hasattr(os, "register_at_fork"):
+            # A lock held by another thread at the time of a fork would never
+            # be released in the child.
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.RLock()
+
+    def digest(self, path):
+        """
+        Returns the SHA-256 hash of a file's contents.
+        """
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        key = os.path.abspath(path)
+        with self._lock:
+            cached = self._digests.get(key)
+            if cached is None or cached[0] != signature:
+                digest = hashlib.sha256()
+                with open(path, "rb") as input_file:
+                    for block in iter(lambda: input_file.read(1 << 20), b""):
+                        digest.update(block)
+                cached = (signature, digest.hexdigest())
+                self._digests[key] = cached
+            return cached[1]
+
+    def _entry(self, key, load):
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = load()
+            return self._entries[key]
+
+    def json_file(self, path):
+        """
+        Returns a JSON file's contents (e.g., translate.json), frozen.
+        """
+        def load():
+            with open(path) as json_file:
+                return freeze(json.load(json_file))
+        return self._entry(("json", self.digest(path)), load)
+
+    def crosswalk(self, path):
+        """
+        Returns a census crosswalk as a read-only dict of each column's values.
+        """
+        def load():
+            crosswalk = pd.read_csv(path)
+            return FrozenDict((col, tuple(crosswalk[col].tolist())) for col in crosswalk.columns)
+        return self._entry(("crosswalk", self.digest(path)), load)
+
+    def csv_rows(self, path, columns):
+        """
+        Returns the given columns of a CSV file (e.g., years.csv) as a tuple of
+        rows, with the values as they appear in the file.
+        """
+        def load():
+            with open(path) as csv_file:
+                return tuple(tuple(row[col] for col in columns) for row in csv.DictReader(csv_file, delimiter=','))
+        return self._entry(("csv", self.digest(path), tuple(columns)), load)
+
+    def binner(self, dictionary="translate.json", industry_file="industry_crosswalk.csv", occupation_file="occupation_crosswalk.csv"):
+        """
+        Returns the Binner for the binned_values in `dictionary`, with the
+        industry and occupation bins derived from the crosswalk files.
+        """
+        key = ("binner", self.digest(dictionary), self.digest(industry_file), self.digest(occupation_file))
+        return self._entry(key, lambda: codebook.Binner.from_crosswalks(self.json_file(dictionary)["binned_values"],
+            self.crosswalk(industry_file), self.crosswalk(occupation_file)))
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+            self._entries.clear()
+
+
+# The registry shared by everything in the process.
+registry = ReferenceData()
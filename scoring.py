@@ -0,0 +1,308 @@
+import os
+import time
+import json
+import pickle
+import sqlite3
+import argparse
+import functools
+import numpy as np
+import pandas as pd
+
+MODEL_PATH = "finalized_model.sav"
+SCHEMA_PATH = "feature_schema.json"
+
+# Columns in Cohort.data()'s output that aren't used as predictors (as in
+# Cross-Validation.ipynb): identifiers, the label, variables that are only
+# used in their dummy form, and a few others that weren't predictive.
+NON_PREDICTORS = ["case_id", "sample_id", "year", "shock", "urban_or_rural", "family_size", "work_kind_limited",
+    "work_amount_limited", "region", "highest_grade", "industry", "occupation", "marital_status", "race",
+    "region_1", "region_2", "region_3", "region_4", "Unnamed: 0"]
+
+ID_COLUMNS = ["case_id", "year"]
+
+
+class FeatureSchema(object):
+    """
+    The predictors a model was trained on, in order. Aligns new data to them:
+    dummy variables that get_dummies didn't emit (because a category didn't
+    appear in the data) are filled in with zeros, or derived from the
+    original categorical column if it's there, and columns the model doesn't
+    use are dropped. Missing values are filled with zeros, as in training.
+    """
+
+    def __init__(self, predictors, categorical_variables):
+        self._predictors = list(predictors)
+        self._categorical_variables = list(categorical_variables)
+
+        # Each dummy column's variable and the value it indicates.
+        self._dummies = {}
+        for predictor in self._predictors:
+            for variable in self._categorical_variables:
+                if predictor.startswith("{}_".format(variable)):
+                    self._dummies[predictor] = (variable, float(predictor[len(variable) + 1:]))
+        self._variable_dummies = dict((variable, [col for (col, (dummy_variable, value)) in self._dummies.items()
+            if dummy_variable == variable]) for variable in self._categorical_variables)
+
+        # Lookups for aligning individual records.
+        self._positions = dict((col, position) for (position, col) in enumerate(self._predictors))
+        self._dummy_positions = dict((self._dummies[col], position) for (position, col) in enumerate(self._predictors)
+            if col in self._dummies)
+        self._required = [col for col in self._predictors if col not in self._dummies]
+
+    @classmethod
+    def from_file(cls, path=SCHEMA_PATH):
+        with open(path) as json_file:
+            schema = json.load(json_file)
+        return cls(schema["predictors"], schema["categorical_variables"])
+
+    @classmethod
+    def from_frame(cls, df, categorical_variables=("highest_grade", "industry", "occupation", "marital_status", "race")):
+        """
+        Creates a schema from training data in the form Cohort.data() returns.
+        """
+        return cls([col for col in df.columns if col not in NON_PREDICTORS], categorical_variables)
+
+    def save(self, path=SCHEMA_PATH):
+        with open(path, "w") as json_file:
+            json.dump({"categorical_variables": self._categorical_variables, "predictors": self._predictors}, json_file, indent=2)
+
+    @property
+    def predictors(self):
+        return self._predictors
+
+    @property
+    def categorical_variables(self):
+        return self._categorical_variables
+
+    def input_columns(self):
+        """
+        Returns the columns that align() can make use of.
+        """
+        return self._predictors + self._categorical_variables
+
+    def unknown_columns(self, df):
+        """
+        Returns any dummy columns in the data for categories the model wasn't
+        trained on. Rows in those categories are scored as if they were in
+        none of the categories the model knows about.
+        """
+        return [col for col in df.columns if col not in self._dummies and
+            any(col.startswith("{}_".format(variable)) for variable in self._categorical_variables)]
+
+    def align(self, df):
+        """
+        Returns the data as a float32 array, with one column per predictor.
+        Raises a ValueError if any non-dummy predictors are missing.
+        """
+        # A categorical variable is only missing if neither it nor any of its dummies are there.
+        missing = [col for col in self._predictors if col not in df.columns and col not in self._dummies]
+        missing.extend(variable for (variable, dummies) in self._variable_dummies.items() if dummies and
+            variable not in df.columns and not any(col in df.columns for col in dummies))
+        if missing:
+            raise ValueError("Data is missing predictors: {}".format(", ".join(missing)))
+
+        features = np.zeros((len(df), len(self._predictors)), dtype=np.float32)
+        for (position, col) in enumerate(self._predictors):
+            if col in df.columns:
+                features[:, position] = df[col].fillna(0).values
+            elif col in self._dummies:
+                (variable, value) = self._dummies[col]
+                if variable in df.columns:
+                    features[:, position] = df[variable].values == value
+
+        return features
+
+    def align_records(self, records):
+        """
+        Aligns a list of records (dictionaries of column and value), as align()
+        does for a DataFrame, but without the overhead of building one. Each
+        categorical variable can be given either as dummies or as its value
+        (e.g., "race": 2); any dummies that aren't given are zero.
+        """
+        features = np.zeros((len(records), len(self._predictors)), dtype=np.float32)
+        for (row, record) in enumerate(records):
+            missing = [col for col in self._required if col not in record]
+            if missing:
+                raise ValueError("Record is missing predictors: {}".format(", ".join(missing)))
+
+            for (col, value) in record.items():
+                if value is None:
+                    continue
+                if col in self._positions:
+                    features[row, self._positions[col]] = value
+                elif col in self._variable_dummies:
+                    position = self._dummy_positions.get((col, float(value)))
+                    if position is not None:
+                        features[row, position] = 1
+
+        return features
+
+
+# Unpickling the model is slow, so it's only done once per file (and again
+# if it changes on disk).
+@functools.lru_cache(maxsize=None)
+def _load_model(path, mtime):
+    with open(path, "rb") as model_file:
+        return pickle.load(model_file)
+
+
+def load_model(path=MODEL_PATH):
+    return _load_model(path, os.path.getmtime(path))
+
+
+def read_chunks(path, chunksize=100000, columns=None, table=None, query=None):
+    """
+    Reads a CSV, Parquet, or SQLite file `chunksize` rows at a time, yielding
+    each chunk as a DataFrame. For CSV and Parquet files, only `columns` (if
+    given) are read. For SQLite databases, either a `table` or a `query` is
+    needed.
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in (".parquet", ".pq"):
+        import pyarrow.parquet
+
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        if columns is not None:
+            columns = [col for col in parquet_file.schema_arrow.names if col in columns]
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+
+    elif extension in (".db", ".sqlite", ".sqlite3"):
+        if query is None:
+            if table is None:
+                raise ValueError("A table or query is needed to score data from a SQLite database")
+            query = "SELECT * FROM {}".format(table)
+        conn = sqlite3.connect(path)
+        try:
+            for chunk in pd.read_sql(query, conn, chunksize=chunksize):
+                yield chunk
+        finally:
+            conn.close()
+
+    else:
+        usecols = None
+        if columns is not None:
+            columns = set(columns)
+            usecols = lambda col: col in columns
+        for chunk in pd.read_csv(path, chunksize=chunksize, usecols=usecols):
+            yield chunk
+
+
+class Scorer(object):
+    """
+    Scores data with the income shock model, returning each row's predicted
+    probability of a shock. The model is loaded once, and data is aligned to
+    the model's feature schema before scoring.
+
+    Large data sets can be scored in chunks with score_chunks() or
+    score_file(), which are generators, so only one chunk is held in memory
+    at a time. The number of rows scored and the time taken (including
+    reading the data) are tracked in rows_scored, seconds, and
+    rows_per_second.
+
+    Note that the model was trained only on rows with an adjusted_income over
+    $1,000; other rows are scored all the same.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, schema_path=SCHEMA_PATH):
+        self._model = load_model(model_path)
+        self._schema = FeatureSchema.from_file(schema_path)
+
+        n_features = getattr(self._model, "n_features_", getattr(self._model, "n_features_in_", None))
+        if n_features is not None and n_features != len(self._schema.predictors):
+            raise ValueError("The model expects {} features, but the schema lists {}".format(n_features, len(self._schema.predictors)))
+
+        self._rows_scored = 0
+        self._seconds = 0.
+        self._unknown_columns = set()
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def schema(self):
+        return self._schema
+
+    @property
+    def rows_scored(self):
+        return self._rows_scored
+
+    @property
+    def seconds(self):
+        return self._seconds
+
+    @property
+    def rows_per_second(self):
+        return self._rows_scored / self._seconds if self._seconds else 0.
+
+    @property
+    def unknown_columns(self):
+        return sorted(self._unknown_columns)
+
+    def score(self, df):
+        """
+        Returns each row's probability of an income shock as an array.
+        """
+        self._unknown_columns.update(self._schema.unknown_columns(df))
+        return self._model.predict_proba(self._schema.align(df))[:, 1]
+
+    def score_frame(self, df, id_columns=ID_COLUMNS):
+        """
+        Returns a DataFrame of each row's ID columns (those present) and its
+        shock_probability.
+        """
+        scores = df[[col for col in id_columns if col in df.columns]].copy()
+        scores["shock_probability"] = self.score(df)
+        return scores
+
+    def score_chunks(self, chunks, id_columns=ID_COLUMNS):
+        """
+        Scores an iterable of DataFrames, yielding score_frame() for each.
+        """
+        chunks = iter(chunks)
+        while True:
+            start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            scores = self.score_frame(chunk, id_columns)
+            self._seconds += time.time() - start
+            self._rows_scored += len(chunk)
+            yield scores
+
+    def score_file(self, path, chunksize=100000, id_columns=ID_COLUMNS, table=None, query=None):
+        """
+        Scores a CSV, Parquet, or SQLite file (see read_chunks()) in chunks,
+        reading only the columns that are needed where possible.
+        """
+        columns = list(id_columns) + self._schema.input_columns()
+        return self.score_chunks(read_chunks(path, chunksize, columns, table, query), id_columns)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Scores data in the form Cohort.data() returns with the income shock model.")
+    parser.add_argument("input", help="CSV, Parquet, or SQLite file to score")
+    parser.add_argument("output", help="CSV file to write scores to")
+    parser.add_argument("--table", help="table to score, for SQLite input")
+    parser.add_argument("--query", help="query returning the data to score, for SQLite input")
+    parser.add_argument("--chunksize", type=int, default=100000,
+        help="number of rows to score at a time")
+    parser.add_argument("--model", default=MODEL_PATH,
+        help="path of the pickled model (default: {})".format(MODEL_PATH))
+    parser.add_argument("--schema", default=SCHEMA_PATH,
+        help="path of the model's feature schema (default: {})".format(SCHEMA_PATH))
+    args = parser.parse_args()
+
+    scorer = Scorer(args.model, args.schema)
+    with open(args.output, "w") as output_file:
+        for (position, scores) in enumerate(scorer.score_file(args.input, args.chunksize, table=args.table, query=args.query)):
+            scores.to_csv(output_file, header=(position == 0), index=False)
+            print("{} rows scored...".format(scorer.rows_scored))
+
+    print("Scored {} rows in {:.2f} seconds ({:.0f} rows/sec)".format(scorer.rows_scored, scorer.seconds, scorer.rows_per_second))
+    if scorer.unknown_columns:
+        print("Categories the model wasn't trained on: {}".format(", ".join(scorer.unknown_columns)))
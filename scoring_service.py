@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+import scoring
+import tree_ensemble
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+class BatchScorer(object):
+    """
+    Scores records with a compiled ensemble, batching together the records
+    from requests that arrive while the previous batch is being scored (or
+    within `max_wait` seconds of each other), up to `max_batch` records.
+    """
+
+    def __init__(self, ensemble, schema, max_batch=256, max_wait=0.):
+        self._ensemble = ensemble
+        self._schema = schema
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._queue = None
+        self._stats = {"requests": 0, "records": 0, "batches": 0, "seconds": 0.}
+
+    @property
+    def ensemble(self):
+        return self._ensemble
+
+    @property
+    def stats(self):
+        return self._stats
+
+    async def score(self, records):
+        """
+        Returns each record's probability of an income shock.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((records, future))
+        return await future
+
+    async def run(self):
+        self._queue = asyncio.Queue()
+        while True:
+            pending = [await self._queue.get()]
+            if self._max_wait:
+                await asyncio.sleep(self._max_wait)
+            n_records = len(pending[0][0])
+            while n_records < self._max_batch and not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+                n_records += len(pending[-1][0])
+
+            self._score_batch(pending)
+
+    def _score_batch(self, pending):
+        start = time.perf_counter()
+
+        # A request with bad records fails on its own, without holding up the rest of the batch.
+        features = []
+        requests = []
+        for (records, future) in pending:
+            try:
+                features.append(self._schema.align_records(records))
+                requests.append((len(records), future))
+            except (ValueError, TypeError) as error:
+                future.set_exception(ValueError(str(error)))
+
+        if requests:
+            probabilities = self._ensemble.predict_proba(np.concatenate(features))[:, 1].tolist()
+            offset = 0
+            for (n_records, future) in requests:
+                future.set_result(probabilities[offset:offset + n_records])
+                offset += n_records
+
+        self._stats["requests"] += len(pending)
+        self._stats["records"] += sum(n_records for (n_records, future) in requests)
+        self._stats["batches"] += 1
+        self._stats["seconds"] += time.perf_counter() - start
+
+
+class ScoringService(object):
+    """
+    A small HTTP service for scoring individual records (or small batches of
+    them) with low latency. POST a JSON record, or a list of them, to /score
+    to get back their shock_probability. GET /health and /stats report on
+    the service.
+    """
+
+    def __init__(self, batch_scorer):
+        self._batch_scorer = batch_scorer
+
+    async def route(self, method, path, body):
+        if path == "/score":
+            if method != "POST":
+                return (405, {"error": "Use POST to score records"})
+            try:
+                records = json.loads(body.decode("utf-8"))
+                if isinstance(records, dict):
+                    probabilities = await self._batch_scorer.score([records])
+                    return (200, {"shock_probability": probabilities[0]})
+                probabilities = await self._batch_scorer.score(records)
+                return (200, {"shock_probability": probabilities})
+            except ValueError as error:
+                return (400, {"error": str(error)})
+
+        if path == "/health":
+            return (200, {"status": "ok", "trees": self._batch_scorer.ensemble.n_trees})
+
+        if path == "/stats":
+            return (200, self._batch_scorer.stats)
+
+        return (404, {"error": "No such endpoint: {}".format(path)})
+
+    async def handle(self, reader, writer):
+        """
+        Handles the requests on a single (keep-alive) HTTP/1.1 connection.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                (method, path, version) = request_line.decode("latin-1").split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    (name, value) = line.decode("latin-1").split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                (status, payload) = await self.route(method, path, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+                content = json.dumps(payload).encode("utf-8")
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                    status, STATUS_TEXT[status], len(content), "keep-alive" if keep_alive else "close").encode("latin-1") + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        batcher = asyncio.ensure_future(self._batch_scorer.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Scoring records on http://{}:{}/score".format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def load_ensemble(model_path=scoring.MODEL_PATH, compiled_path=None):
+    """
+    Loads a compiled ensemble if there is one, compiling the pickled model
+    otherwise.
+    """
+    if compiled_path is not None and os.path.exists(compiled_path):
+        return tree_ensemble.CompiledEnsemble.load(compiled_path)
+    return tree_ensemble.CompiledEnsemble.from_model(scoring.load_model(model_path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serves low-latency income shock predictions over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default=scoring.MODEL_PATH,
+        help="path of the pickled model (default: {})".format(scoring.MODEL_PATH))
+    parser.add_argument("--compiled",
+        help="path of a compiled ensemble (see tree_ensemble.py), used instead of the pickled model if it exists")
+    parser.add_argument("--schema", default=scoring.SCHEMA_PATH,
+        help="path of the model's feature schema (default: {})".format(scoring.SCHEMA_PATH))
+    parser.add_argument("--max-batch", type=int, default=256,
+        help="most records to score in one batch")
+    parser.add_argument("--max-wait", type=float, default=0.,
+        help="milliseconds to wait for more requests to batch together (default: 0, i.e., only batch requests that are already waiting)")
+    args = parser.parse_args()
+
+    batch_scorer = BatchScorer(load_ensemble(args.model, args.compiled), scoring.FeatureSchema.from_file(args.schema),
+        args.max_batch, args.max_wait / 1000.)
+    try:
+        asyncio.run(ScoringService(batch_scorer).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Exiting...")
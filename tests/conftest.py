@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+import benchmark
+import ingest_data
+import nlsy
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    # translate.json, the crosswalks, and data/ are all found relative to the
+    # working directory, as they are when the scripts are run.
+    monkeypatch.chdir(REPO_DIR)
+
+
+@pytest.fixture
+def database(repo_dir, tmp_path):
+    """
+    A new database with the years and region data loaded.
+    """
+    NLSY_db = nlsy.NLSY_database(str(tmp_path / "test.db"), True)
+    NLSY_db.add_years_data(ingest_data.YEAR_PATH)
+    NLSY_db.add_region_data(ingest_data.REGION_PATH)
+    yield NLSY_db
+    NLSY_db.close()
+
+
+@pytest.fixture
+def extract_1997(repo_dir, tmp_path):
+    """
+    A small synthetic extract of the 1997 cohort (see benchmark.generate_cohort()).
+    """
+    return benchmark.generate_cohort(1997, str(tmp_path / "extract"), n_respondents=150)
@@ -0,0 +1,242 @@
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import codebook
+
+
+def _survey_table(fields, years, values, seed=0):
+    """
+    An in-memory table of survey responses, with every field drawn from
+    `values` in every year.
+    """
+    random_state = np.random.RandomState(seed)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE data (data_id INTEGER PRIMARY KEY, year INTEGER, {})".format(
+        ", ".join("{} INTEGER".format(field) for field in fields)))
+    rows = [[int(year)] + [int(value) for value in random_state.choice(values, len(fields))]
+        for year in years for repeat in range(20)]
+    conn.executemany("INSERT INTO data (year, {}) VALUES ({})".format(", ".join(fields), ", ".join("?" * (len(fields) + 1))), rows)
+    return conn
+
+
+def _table(conn):
+    return pd.read_sql("SELECT * FROM data ORDER BY data_id", conn)
+
+
+def _translate_survey_data(cursor, fields_to_translate):
+    # Cohort._translate_survey_data() as it was, with an UPDATE per rule.
+    for question_name, translate_dict in fields_to_translate.items():
+        for key, value in translate_dict.items():
+            if isinstance(value, dict):
+                year = key
+                for find_value, replace_value in value.items():
+                    cursor.execute("""UPDATE data
+                        SET {question_name} = ?
+                        WHERE {question_name} = ?
+                        AND YEAR = ?""".format(question_name = question_name),
+                        (replace_value, find_value, year)
+                    )
+            else:
+                cursor.execute("""UPDATE data
+                    SET {question_name} = ?
+                    WHERE {question_name} = ?""".format(question_name = question_name),
+                    (value, key)
+                )
+
+
+def _translate_employer_data(cursor, cohort_year, industry_crosswalk, occupation_crosswalk):
+    # Cohort._translate_employer_data() as it was, with an UPDATE per rule.
+    for index, row in industry_crosswalk.iterrows():
+        if cohort_year == 1979:
+            if not pd.isna(row["1970"]):
+                cursor.execute("UPDATE data SET industry = ? WHERE industry = ? AND YEAR <= 2002",
+                    (row["IND1990"], row["1970"]))
+            if not pd.isna(row["ACS 2003-"]):
+                cursor.execute("UPDATE data SET industry = ? WHERE industry = ? AND YEAR > 2002",
+                    (row["IND1990"], row["ACS 2003-"]))
+        if cohort_year == 1997:
+            if not pd.isna(row["ACS 2003-"]):
+                cursor.execute("UPDATE data SET industry = ? WHERE industry = ?",
+                    (row["IND1990"], row["ACS 2003-"]))
+
+    for index, row in occupation_crosswalk.iterrows():
+        if cohort_year == 1979:
+            if not pd.isna(row["1970"]):
+                cursor.execute("UPDATE data SET occupation = ? WHERE occupation = ? AND YEAR < 2002",
+                    (row["OCC2010"], row["1970"]))
+            if not pd.isna(row["2000"]):
+                cursor.execute("UPDATE data SET occupation = ? WHERE occupation = ? AND YEAR >= 2002",
+                    (row["OCC2010"], row["2000"]))
+        if cohort_year == 1997:
+            if not pd.isna(row["ACS 2003-2009"]):
+                cursor.execute("UPDATE data SET occupation = ? WHERE occupation = ?",
+                    (row["OCC2010"], row["ACS 2003-2009"]))
+
+
+def _crosswalk_bins(crosswalk, code_column, description_column):
+    # The bins Cohort.data() derived from a crosswalk, as it was.
+    bins = {"-10": "UNKNOWN"}
+    bin_bottom = False
+    reset_bin = False
+    for index, row in crosswalk.iterrows():
+        if reset_bin and row[code_column] != "#":
+            reset_bin = False
+            bin_bottom = row[code_column]
+        if row[code_column] == "#" and row[description_column].isupper():
+            reset_bin = True
+            if bin_bottom:
+                bins[bin_bottom] = curr_description
+            curr_description = row[description_column].strip()
+    bins[bin_bottom] = curr_description
+
+    keys = list(bins.keys()) + [99999]
+    for index, bin_bottom in enumerate(keys):
+        if bin_bottom == 99999:
+            break
+        bin_top = int(keys[index + 1]) - 1
+        bins["{}~{}".format(bin_bottom, bin_top)] = bins.pop(bin_bottom)
+    return bins
+
+
+def _bin(df, binned_values):
+    # The binning in Cohort.data() as it was, with a mask per bin.
+    for col, bin_dict in binned_values.items():
+        for bin_range, bin_name in bin_dict.items():
+            (bin_bottom, bin_top) = bin_range.split("~")
+            bin_bottom = int(bin_bottom)
+            bin_top = int(bin_top)
+            df.loc[(df[col] >= bin_bottom) & (df[col] <= bin_top), col] = bin_bottom
+    return df
+
+
+@pytest.fixture
+def translations():
+    with open("translate.json") as json_file:
+        return json.load(json_file)
+
+
+@pytest.fixture
+def crosswalks():
+    return (pd.read_csv("industry_crosswalk.csv"), pd.read_csv("occupation_crosswalk.csv"))
+
+
+def test_lookup_table_chains_rules():
+    translator = codebook.Translator("field")
+    translator.add_rule(1, 2)
+    translator.add_rule(2, 3)
+    translator.add_rule(3, 1, first_year=2000, last_year=2000)
+    translator.add_rule(4, 4)
+
+    assert sorted(translator.lookup_table()) == sorted([
+        (codebook.FIRST_YEAR, 1999, 1, 3), (codebook.FIRST_YEAR, 1999, 2, 3),
+        (2000, 2000, 2, 1), (2000, 2000, 3, 1),
+        (2001, codebook.LAST_YEAR, 1, 3), (2001, codebook.LAST_YEAR, 2, 3)
+    ])
+
+
+def test_lookup_table_matches_rule_by_rule():
+    random_state = np.random.RandomState(0)
+    rules = []
+    for position in range(200):
+        first_year = random_state.choice([codebook.FIRST_YEAR, 1990, 1995, 2000])
+        last_year = random_state.choice([1994, 2000, 2005, codebook.LAST_YEAR])
+        rules.append((random_state.randint(0, 30), random_state.randint(0, 30), first_year, max(first_year, last_year)))
+
+    conn = _survey_table(["field"], range(1985, 2010), range(0, 30))
+    expected = conn.cursor()
+    for (find_value, replace_value, first_year, last_year) in rules:
+        expected.execute("UPDATE data SET field = ? WHERE field = ? AND year BETWEEN ? AND ?",
+            (replace_value, find_value, int(first_year), int(last_year)))
+    expected = _table(conn)
+
+    conn = _survey_table(["field"], range(1985, 2010), range(0, 30))
+    translator = codebook.Translator("field")
+    for (find_value, replace_value, first_year, last_year) in rules:
+        translator.add_rule(find_value, replace_value, first_year, last_year)
+    translator.apply(conn.cursor(), "data")
+
+    pd.testing.assert_frame_equal(_table(conn), expected)
+
+
+@pytest.mark.parametrize("cohort_year", [1979, 1997])
+def test_codebook_translators_match_rule_by_rule(translations, cohort_year):
+    fields_to_translate = translations["dynamic_question_values"][str(cohort_year)]
+    fields = list(fields_to_translate)
+    values = set()
+    for translate_dict in fields_to_translate.values():
+        for (key, value) in translate_dict.items():
+            pairs = value.items() if isinstance(value, dict) else [(key, value)]
+            values.update(int(codebook._normalize(code)) for pair in pairs for code in pair)
+    values = sorted(values) + [0, 1, 2]
+
+    conn = _survey_table(fields, range(1979, 2017), values)
+    _translate_survey_data(conn.cursor(), fields_to_translate)
+    expected = _table(conn)
+
+    conn = _survey_table(fields, range(1979, 2017), values)
+    for translator in codebook.codebook_translators(fields_to_translate):
+        translator.apply(conn.cursor(), "data")
+
+    pd.testing.assert_frame_equal(_table(conn), expected)
+
+
+@pytest.mark.parametrize("cohort_year", [1979, 1997])
+def test_crosswalk_translators_match_rule_by_rule(crosswalks, cohort_year):
+    (industry_crosswalk, occupation_crosswalk) = crosswalks
+    codes = pd.concat([industry_crosswalk[column] for column in ("IND1990", "1970", "ACS 2003-")] +
+        [occupation_crosswalk[column] for column in ("OCC2010", "1970", "2000", "ACS 2003-2009")])
+    values = sorted(set(pd.to_numeric(codes, errors="coerce").dropna().astype(int))) + [-10, -1]
+
+    conn = _survey_table(["industry", "occupation"], range(1979, 2017), values)
+    _translate_employer_data(conn.cursor(), cohort_year, industry_crosswalk, occupation_crosswalk)
+    expected = _table(conn)
+
+    conn = _survey_table(["industry", "occupation"], range(1979, 2017), values)
+    for translator in codebook.crosswalk_translators(cohort_year, industry_crosswalk, occupation_crosswalk):
+        translator.apply(conn.cursor(), "data")
+
+    pd.testing.assert_frame_equal(_table(conn), expected)
+
+
+def test_binner_matches_bin_by_bin(translations, crosswalks):
+    binner = codebook.Binner.from_crosswalks(translations["binned_values"], *crosswalks)
+
+    # Each bin's edges, and the values either side of them.
+    values = set([-11, -10, -9, -5, -1, 0, 99998, 99999, 100000])
+    for col in binner.columns:
+        for (bin_bottom, bin_name) in binner.labels(col).items():
+            values.update([bin_bottom - 1, bin_bottom, bin_bottom + 1])
+    values = sorted(values)
+    df = pd.DataFrame(dict((col, values) for col in binner.columns))
+    df.loc[len(df)] = np.nan
+
+    binned_values = dict(translations["binned_values"])
+    binned_values["industry"] = _crosswalk_bins(crosswalks[0], "IND1990", "Industry category description")
+    binned_values["occupation"] = _crosswalk_bins(crosswalks[1], "OCC2010", "Occupation category description")
+
+    pd.testing.assert_frame_equal(binner.transform(df.copy()), _bin(df.copy(), binned_values))
+
+
+def test_binner_edges(translations, crosswalks):
+    binner = codebook.Binner.from_crosswalks(translations["binned_values"], *crosswalks)
+
+    # Unknown and missing employer codes all fall in the UNKNOWN bin, which
+    # runs up to the first code in the crosswalk.
+    for col in ("industry", "occupation"):
+        assert binner.labels(col)[-10] == "UNKNOWN"
+        assert binner.bin_values(col, np.array([-10, -5, -1])).tolist() == [-10, -10, -10]
+        # The last bin runs up to 99998; anything outside the bins is left alone.
+        assert binner.bin_values(col, np.array([-11, 99998, 99999])).tolist() == [-11, max(binner.labels(col)), 99999]
+
+    grades = binner.bin_values("highest_grade", pd.Series([-3., 0., 4., 5., 12., 13., 16., 17., 100., 101., np.nan]))
+    assert grades.iloc[:-1].tolist() == [-3., 0., 0., 5., 12., 13., 16., 17., 17., 101.]
+    assert np.isnan(grades.iloc[-1])
+
+
+def test_binner_rejects_overlapping_bins():
+    with pytest.raises(ValueError):
+        codebook.Binner({"highest_grade": {"0~4": "Low", "4~8": "High"}})
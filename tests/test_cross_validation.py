@@ -0,0 +1,39 @@
+import os
+import threading
+
+import numpy as np
+
+import cross_validation
+
+
+def test_fold_cache_shared_by_concurrent_builders(tmp_path):
+    cache = cross_validation.FoldCache(str(tmp_path / "cv_cache"))
+    random_state = np.random.RandomState(0)
+    (X, y) = (random_state.normal(size=(500, 4)), random_state.randint(0, 2, 500))
+
+    entry_dirs = []
+    threads = [threading.Thread(target=lambda: entry_dirs.append(cache.entry_dir(X, y, 5, scale=True))) for position in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(entry_dirs) == 4 and len(set(entry_dirs)) == 1
+    assert os.listdir(str(tmp_path / "cv_cache")) == [os.path.basename(entry_dirs[0])]
+    for fold in range(5):
+        (X_train, X_test, y_train, y_test) = cross_validation.FoldCache.load_fold(entry_dirs[0], fold)
+        assert len(X_train) + len(X_test) == len(X)
+
+
+def test_fold_cache_replaces_broken_entry(tmp_path):
+    cache = cross_validation.FoldCache(str(tmp_path / "cv_cache"))
+    random_state = np.random.RandomState(0)
+    (X, y) = (random_state.normal(size=(100, 3)), random_state.randint(0, 2, 100))
+
+    entry_dir = os.path.join(str(tmp_path / "cv_cache"), cache.key(X, y, 3))
+    os.makedirs(entry_dir)
+    open(os.path.join(entry_dir, "X_train_0.npy"), "w").close()
+
+    assert cache.entry_dir(X, y, 3) == entry_dir
+    assert os.path.exists(os.path.join(entry_dir, "folds.json"))
+    assert os.listdir(str(tmp_path / "cv_cache")) == [os.path.basename(entry_dir)]
@@ -0,0 +1,55 @@
+import multiprocessing
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import benchmark
+import ingest_data
+import instrumentation
+import nlsy
+
+
+def test_parallel_ingest(database, tmp_path):
+    # As ingest_data.py --jobs 2 runs it, with the tracer sent to each worker.
+    log = instrumentation.JSONLinesLog(str(tmp_path / "trace.jsonl"))
+    tracer = instrumentation.Instrumentation([log])
+    jobs = []
+    for cohort_year in (1979, 1997):
+        (rnum_path, qname_path, responses_path) = benchmark.generate_cohort(cohort_year, str(tmp_path / str(cohort_year)), n_respondents=50)
+        jobs.append({"db_path": database.path, "cohort_year": cohort_year, "rnum_path": rnum_path, "qname_path": qname_path,
+            "responses_path": responses_path, "verbose": False, "instrumentation": tracer})
+
+    with multiprocessing.Pool(2) as pool:
+        results = pool.map(ingest_data._ingest_cohort, jobs)
+
+    for (job, (staging_path, stage_timings, elapsed, column_projection)) in zip(jobs, results):
+        assert sorted(stage_timings) == sorted(nlsy.PIPELINE_STAGES)
+        cohort = database.merge_cohort(staging_path, job["cohort_year"])
+        os.remove(staging_path)
+        assert database.query("SELECT COUNT(*) FROM {}".format(cohort.wrangled_respondents_table)).iloc[0, 0] == 50
+
+    records = pd.read_json(log.path, lines=True)
+    assert set(records[records["span"] == "ingest"]["cohort"]) == set([1979, 1997])
+
+
+def test_failed_merge_is_rolled_back(database, extract_1997, tmp_path):
+    (staging_path, stage_timings, elapsed, column_projection) = ingest_data.ingest_cohort(database.path, 1997, *extract_1997,
+        verbose=False, staging_dir=str(tmp_path))
+    staging_db = nlsy.NLSY_database(staging_path)
+    indexes = staging_db.query("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name GLOB '*_1997'")["name"]
+    staging_db.close()
+
+    # The cohort's tables are copied before its indexes, so this fails once
+    # they have been.
+    database.conn.execute("CREATE TABLE blocker (value INTEGER)")
+    database.conn.execute("CREATE INDEX {} ON blocker (value)".format(indexes.iloc[-1]))
+    database.conn.commit()
+    with pytest.raises(sqlite3.OperationalError):
+        database.merge_cohort(staging_path, 1997)
+    assert database.query("SELECT name FROM sqlite_master WHERE tbl_name GLOB '*_1997'").empty
+
+    database.conn.execute("DROP TABLE blocker")
+    cohort = database.merge_cohort(staging_path, 1997)
+    assert database.query("SELECT COUNT(*) FROM {}".format(cohort.wrangled_respondents_table)).iloc[0, 0] == 150
@@ -0,0 +1,33 @@
+import pickle
+import threading
+
+import instrumentation
+
+
+def test_instrumentation_pickles_without_open_spans(tmp_path):
+    tracer = instrumentation.Instrumentation([instrumentation.JSONLinesLog(str(tmp_path / "trace.jsonl"))],
+        profile=["load_responses"])
+    with tracer.span("ingest"):
+        copy = pickle.loads(pickle.dumps(tracer))
+
+    assert copy.sinks[0].path == tracer.sinks[0].path
+    assert copy._stack == []
+    with copy.span("merge_cohort") as span:
+        pass
+    assert span.parent is None
+
+
+def test_spans_nest_per_thread():
+    collector = instrumentation.MemoryCollector()
+    tracer = instrumentation.Instrumentation([collector])
+
+    def run():
+        with tracer.span("reader"):
+            pass
+
+    with tracer.span("ingest"):
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+    assert dict((record["span"], record["parent"]) for record in collector.records) == {"reader": None, "ingest": None}
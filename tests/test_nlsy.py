@@ -0,0 +1,146 @@
+import os
+
+import pandas as pd
+import pytest
+
+import benchmark
+import ingest_data
+import nlsy
+
+
+def _split_extract(paths, output_dir, first_year):
+    """
+    Splits an extract into one with the survey rounds before `first_year`
+    and one with the rest, each with the static questions too.
+    """
+    (rnum_path, qname_path, responses_path) = paths
+    with open(rnum_path) as rnum_file:
+        rnums = [line.strip() for line in rnum_file if line.strip()]
+    with open(qname_path) as qname_file:
+        questions = [line.strip() for line in qname_file if line.strip()]
+    responses = pd.read_csv(responses_path)
+
+    extracts = []
+    for (name, later) in (("before", False), ("after", True)):
+        columns = []
+        for (rnum, question) in zip(rnums, questions):
+            year = benchmark._question_year(*question.split(","))
+            if rnum == "R0000100" or year is None or (year >= first_year) == later:
+                columns.append((rnum, question))
+
+        os.makedirs(os.path.join(output_dir, name))
+        extract = [os.path.join(output_dir, name, os.path.basename(path)) for path in paths]
+        with open(extract[0], "w") as rnum_file:
+            rnum_file.writelines("{}\n".format(rnum) for (rnum, question) in columns)
+        with open(extract[1], "w") as qname_file:
+            qname_file.writelines("{}\n".format(question) for (rnum, question) in columns)
+        responses[[rnum for (rnum, question) in columns]].to_csv(extract[2], index=False)
+        extracts.append(extract)
+
+    return extracts
+
+
+def _tables(cohort):
+    conn = cohort.NLSY_db.conn
+    data = pd.read_sql("SELECT * FROM {} ORDER BY case_id, year".format(cohort.wrangled_data_table), conn)
+    respondents = pd.read_sql("SELECT * FROM {} ORDER BY case_id".format(cohort.wrangled_respondents_table), conn)
+    return (data.drop(columns=["data_id"]), respondents)
+
+
+def test_existing_database_is_not_replaced(database):
+    with pytest.raises(ValueError):
+        nlsy.NLSY_database(database.path, True)
+    assert database.cohorts == []
+
+
+def test_deflators_match_compounded_inflation(database):
+    # Cohort._adjust_for_inflation() as it was, compounding each year's
+    # inflation up to the last year in the years table.
+    inflation_dict = dict(database.query("SELECT year, inflation FROM {} ORDER BY year".format(database.years_table)).values)
+    adjust_year = max(inflation_dict)
+    expected = {}
+    for year in inflation_dict:
+        inflation_adjustment = 1
+        for inflation_year in range(int(year), int(adjust_year)):
+            inflation_adjustment *= (1 + inflation_dict[inflation_year])
+        expected[year] = inflation_adjustment
+
+    cohort = database.add_cohort(1997)
+    deflators = cohort.deflators()
+    assert sorted(deflators) == sorted(expected)
+    assert deflators == pytest.approx(expected, rel=1e-12)
+    assert deflators[adjust_year] == 1.
+
+    rebased = cohort.deflators(2000)
+    assert rebased[2000] == 1.
+    assert rebased == pytest.approx(dict((year, deflator / deflators[2000]) for (year, deflator) in deflators.items()), rel=1e-12)
+
+    with pytest.raises(ValueError):
+        cohort.deflators(1900)
+
+
+def test_append_survey_round_matches_full_ingest(database, extract_1997, tmp_path):
+    (before, after) = _split_extract(extract_1997, str(tmp_path / "split"), 2011)
+
+    full_db = nlsy.NLSY_database(str(tmp_path / "full.db"), True)
+    full_db.add_years_data(ingest_data.YEAR_PATH)
+    full_db.add_region_data(ingest_data.REGION_PATH)
+    full = full_db.add_cohort(1997)
+    full.add_cohort_data(*extract_1997, verbose=False)
+
+    cohort = database.add_cohort(1997)
+    cohort.add_cohort_data(*before, verbose=False)
+    years = cohort.append_survey_round(*after, verbose=False)
+
+    (data, respondents) = _tables(cohort)
+    (full_data, full_respondents) = _tables(full)
+    assert years == sorted(year for year in full_data["year"].unique() if year >= 2011)
+    pd.testing.assert_frame_equal(data, full_data)
+    pd.testing.assert_frame_equal(respondents, full_respondents)
+
+    # There's nothing left to append.
+    with pytest.raises(ValueError):
+        cohort.append_survey_round(*after, verbose=False)
+    full_db.close()
+
+
+@pytest.mark.parametrize("keep_responses", [True, False])
+def test_first_stage(database, extract_1997, keep_responses):
+    cohort = database.add_cohort(1997)
+    cohort.add_cohort_data(*extract_1997, verbose=False, keep_responses=keep_responses)
+    stages = cohort._pipeline(*extract_1997, keep_responses=keep_responses, chunksize=1000, verbose=False)
+    names = [name for (name, stage, inputs) in stages]
+
+    # Nothing's changed since the ingest.
+    assert cohort._first_stage(stages) == len(stages)
+
+    # Stages that rebuild their own output are just rerun, while the others
+    # need the wrangled tables rebuilt first, which needs the responses.
+    rebuild = names.index("wrangle_respondents") if keep_responses else 0
+    assert cohort._first_stage(stages, "label_shocks") == names.index("label_shocks")
+    assert cohort._first_stage(stages, "translate_survey") == rebuild
+    assert cohort._first_stage(stages, "adjust_for_inflation") == rebuild
+    assert cohort._first_stage(stages, "wrangle_survey") == (names.index("wrangle_survey") if keep_responses else 0)
+    assert cohort._first_stage(stages, "load_responses") == 0
+
+    # A stage whose inputs have changed is rerun, as is one that never
+    # completed.
+    conn = database.conn
+    conn.execute("UPDATE checkpoints_1997 SET inputs = 'changed' WHERE stage = 'translate_employer'")
+    assert cohort._first_stage(stages) == rebuild
+    assert cohort._first_stage(stages, "label_shocks") == rebuild
+    conn.execute("UPDATE checkpoints_1997 SET inputs = ? WHERE stage = 'translate_employer'",
+        [inputs for (name, stage, inputs) in stages if name == "translate_employer"])
+    conn.execute("DELETE FROM checkpoints_1997 WHERE stage = 'label_shocks'")
+    assert cohort._first_stage(stages) == names.index("label_shocks")
+
+
+def test_first_stage_with_nominal_income(database, extract_1997):
+    cohort = database.add_cohort(1997)
+    cohort.add_cohort_data(*extract_1997, verbose=False, keep_nominal_income=True)
+    stages = cohort._pipeline(*extract_1997, keep_responses=True, chunksize=1000, verbose=False, keep_nominal_income=True)
+    names = [name for (name, stage, inputs) in stages]
+
+    # With nominal income kept, the inflation adjustment can be rerun in place.
+    assert cohort._first_stage(stages, "adjust_for_inflation") == names.index("adjust_for_inflation")
+    assert cohort._first_stage(stages, "translate_employer") == names.index("wrangle_respondents")
@@ -0,0 +1,49 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn.datasets import make_classification
+from sklearn.ensemble import GradientBoostingClassifier
+
+import tree_ensemble
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    # More rows than BLOCK_SIZE, so they're evaluated in several blocks.
+    return make_classification(n_samples=tree_ensemble.BLOCK_SIZE + 1000, n_features=12, n_informative=6, random_state=0)
+
+
+@pytest.mark.parametrize("loss", ["log_loss", "exponential"])
+def test_predict_proba_matches_model(dataset, loss):
+    (X, y) = dataset
+    model = GradientBoostingClassifier(loss=loss, n_estimators=40, max_depth=4, random_state=0).fit(X, y)
+    ensemble = tree_ensemble.CompiledEnsemble.from_model(model)
+
+    assert ensemble.n_trees == 40
+    assert np.array_equal(ensemble.predict_proba(X), model.predict_proba(X))
+    assert np.array_equal(ensemble.decision_function(X), model.decision_function(X))
+
+
+def test_saved_ensemble_matches_model(dataset, tmp_path):
+    (X, y) = dataset
+    model = GradientBoostingClassifier(n_estimators=20, max_depth=None, max_leaf_nodes=12, random_state=0).fit(X, y)
+    path = str(tmp_path / "ensemble.npz")
+    tree_ensemble.CompiledEnsemble.from_model(model).save(path)
+
+    assert np.array_equal(tree_ensemble.CompiledEnsemble.load(path).predict_proba(X), model.predict_proba(X))
+
+
+def test_finalized_model():
+    with open("finalized_model.sav", "rb") as model_file:
+        model = pickle.load(model_file)
+    X = np.random.RandomState(0).normal(size=(1000, model.n_features_in_)).round(1)
+
+    assert np.array_equal(tree_ensemble.CompiledEnsemble.from_model(model).predict_proba(X), model.predict_proba(X))
+
+
+def test_multiclass_model_is_rejected():
+    (X, y) = make_classification(n_samples=200, n_classes=3, n_informative=4, random_state=0)
+    model = GradientBoostingClassifier(n_estimators=5, random_state=0).fit(X, y)
+    with pytest.raises(ValueError):
+        tree_ensemble.CompiledEnsemble.from_model(model)
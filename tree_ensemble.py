@@ -0,0 +1,150 @@
+import argparse
+import numpy as np
+from scipy.special import expit
+
+# The scale applied to the raw score before the logistic function, by the
+# class of the model's loss function.
+RAW_SCALES = {"BinomialDeviance": 1., "ExponentialLoss": 2.}
+
+# Large batches are evaluated this many rows at a time, which keeps the
+# working arrays small enough to stay in cache.
+BLOCK_SIZE = 4096
+
+
+class CompiledEnsemble(object):
+    """
+    A binary GradientBoostingClassifier flattened into plain arrays, so it can
+    be evaluated with a handful of NumPy operations rather than sklearn's
+    per-call input validation and per-tree loop. Predictions are identical
+    (bit for bit) to the model's predict_proba.
+
+    Every tree's nodes are stored in the same arrays, with each tree's root
+    at `roots`. Leaves point back to themselves, so all the trees can be
+    walked down together, one level at a time, for max_depth steps.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, init_score, learning_rate, max_depth, raw_scale=1.):
+        self._feature = np.asarray(feature, dtype=np.intp)
+        self._threshold = np.asarray(threshold, dtype=np.float64)
+        self._left = np.asarray(left, dtype=np.intp)
+        self._right = np.asarray(right, dtype=np.intp)
+        self._value = np.asarray(value, dtype=np.float64)
+        self._roots = np.asarray(roots, dtype=np.intp)
+        self._init_score = float(init_score)
+        self._learning_rate = float(learning_rate)
+        self._max_depth = int(max_depth)
+        self._raw_scale = float(raw_scale)
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Compiles a fitted binary GradientBoostingClassifier.
+        """
+        if model.estimators_.shape[1] != 1:
+            raise ValueError("Only binary classifiers can be compiled")
+
+        loss = model._loss if hasattr(model, "_loss") else getattr(model, "loss_", None)
+        if type(loss).__name__ not in RAW_SCALES:
+            raise ValueError("Can't compile a model with a {} loss".format(type(loss).__name__))
+
+        # The initial score is the same for every row. The method that computes
+        # it was renamed in sklearn 0.21.
+        n_features = getattr(model, "n_features_in_", getattr(model, "n_features_", None))
+        row = np.zeros((1, n_features), dtype=np.float32)
+        if hasattr(model, "_raw_predict_init"):
+            init_score = model._raw_predict_init(row)[0, 0]
+        else:
+            init_score = model._init_decision_function(row)[0, 0]
+
+        (feature, threshold, left, right, value, roots) = ([], [], [], [], [], [])
+        offset = 0
+        max_depth = 0
+        for estimator in model.estimators_[:, 0]:
+            tree = estimator.tree_
+            is_leaf = tree.children_left < 0
+            nodes = np.arange(tree.node_count) + offset
+
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, 0., tree.threshold))
+            left.append(np.where(is_leaf, nodes, tree.children_left + offset))
+            right.append(np.where(is_leaf, nodes, tree.children_right + offset))
+            value.append(tree.value[:, 0, 0])
+            roots.append(offset)
+
+            offset += tree.node_count
+            max_depth = max(max_depth, tree.max_depth)
+
+        return cls(np.concatenate(feature), np.concatenate(threshold), np.concatenate(left), np.concatenate(right),
+            np.concatenate(value), roots, init_score, model.learning_rate, max_depth, RAW_SCALES[type(loss).__name__])
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(arrays["feature"], arrays["threshold"], arrays["left"], arrays["right"], arrays["value"], arrays["roots"],
+            arrays["init_score"], arrays["learning_rate"], arrays["max_depth"], arrays["raw_scale"])
+
+    def save(self, path):
+        """
+        Saves the compiled ensemble as a .npz file, which can be loaded (and
+        evaluated) without sklearn.
+        """
+        np.savez(path, feature=self._feature, threshold=self._threshold, left=self._left, right=self._right,
+            value=self._value, roots=self._roots, init_score=self._init_score, learning_rate=self._learning_rate,
+            max_depth=self._max_depth, raw_scale=self._raw_scale)
+
+    @property
+    def n_trees(self):
+        return len(self._roots)
+
+    def apply(self, X):
+        """
+        Returns the index of the leaf each row ends up in, for each tree.
+        """
+        # Like sklearn, features are compared as float32s.
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        (n_rows, n_features) = X.shape
+        row_starts = (np.arange(n_rows) * n_features)[:, np.newaxis]
+        values = X.ravel()
+
+        nodes = np.tile(self._roots, (n_rows, 1))
+        for depth in range(self._max_depth):
+            go_left = values[row_starts + self._feature[nodes]] <= self._threshold[nodes]
+            nodes = np.where(go_left, self._left[nodes], self._right[nodes])
+        return nodes
+
+    def decision_function(self, X):
+        """
+        Returns the ensemble's raw score for each row.
+        """
+        if len(X) > BLOCK_SIZE:
+            return np.concatenate([self.decision_function(X[start:start + BLOCK_SIZE]) for start in range(0, len(X), BLOCK_SIZE)])
+
+        leaves = self.apply(X)
+
+        # sklearn adds each tree's (scaled) contribution to the initial score
+        # in turn, and a cumulative sum adds them up in exactly the same order.
+        scores = np.empty((leaves.shape[0], leaves.shape[1] + 1), dtype=np.float64)
+        scores[:, 0] = self._init_score
+        np.multiply(self._learning_rate, self._value[leaves], out=scores[:, 1:])
+        return np.cumsum(scores, axis=1)[:, -1]
+
+    def predict_proba(self, X):
+        scores = self.decision_function(X)
+        proba = np.ones((scores.shape[0], 2), dtype=np.float64)
+        proba[:, 1] = expit(scores * self._raw_scale if self._raw_scale != 1. else scores)
+        proba[:, 0] -= proba[:, 1]
+        return proba
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compiles a pickled GradientBoostingClassifier into a flat-array ensemble.")
+    parser.add_argument("model", nargs="?", default="finalized_model.sav", help="pickled model (default: finalized_model.sav)")
+    parser.add_argument("output", nargs="?", default="finalized_model.npz", help="compiled ensemble (default: finalized_model.npz)")
+    args = parser.parse_args()
+
+    import scoring
+
+    ensemble = CompiledEnsemble.from_model(scoring.load_model(args.model))
+    ensemble.save(args.output)
+    print("Compiled {} trees into {}".format(ensemble.n_trees, args.output))